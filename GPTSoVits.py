@@ -1,7 +1,196 @@
 import common
+import config
 import requests
+import requests.adapters
+import urllib3.util.retry
 import urllib.parse
 import subprocess
+import threading
+import time
+import typing
+import asyncio
+import contextlib
+
+
+sessions: dict[str, requests.Session] = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(api_url: str) -> requests.Session:
+    """
+    Get the pooled keep-alive session of the given api server, shared by every client in the process.
+
+    Args:
+        api_url (str): Url of the GPTSoVits API.
+
+    Returns:
+        requests.Session: The pooled session.
+    """
+    with sessions_lock:
+        session = sessions.get(api_url)
+        if session is None:
+            # an inference may have run when the connection failed after sending it, /tts is
+            # only retried on connect errors, only the weight swaps are retried on read and status
+            # errors, tts_v1 and change_ref are POSTs and never retried
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=config.gpt_sovits_pool_size,
+                max_retries=urllib3.util.retry.Retry(
+                    total=config.gpt_sovits_max_retries,
+                    connect=config.gpt_sovits_max_retries,
+                    read=0,
+                    status=0,
+                    backoff_factor=config.gpt_sovits_retry_backoff,
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False),
+                pool_block=True)
+            weights_adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=1,
+                max_retries=urllib3.util.retry.Retry(
+                    total=config.gpt_sovits_max_retries,
+                    connect=config.gpt_sovits_max_retries,
+                    read=config.gpt_sovits_max_retries,
+                    status=config.gpt_sovits_max_retries,
+                    backoff_factor=config.gpt_sovits_retry_backoff,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False),
+                pool_block=True)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # requests picks the adapter of the longest matching prefix
+            session.mount(f'{api_url}/set_gpt_weights', weights_adapter)
+            session.mount(f'{api_url}/set_sovits_weights', weights_adapter)
+            # the api servers are local, never route them through a proxy
+            session.trust_env = False
+            sessions[api_url] = session
+        return session
+
+
+class LatencyStats():
+    """
+    Thread-safe per-call latency accounting shared by the sync and async clients.
+    """
+
+    def __init__(self) -> None:
+        self.stats: dict[str, dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, call: str, elapsed: float, failed: bool = False) -> None:
+        """
+        Record one call.
+
+        Args:
+            call (str): Name of the call.
+            elapsed (float): Latency of the call in seconds.
+            failed (bool, optional): Whether the call raised. Defaults to False.
+        """
+        with self.lock:
+            stat = self.stats.setdefault(call, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            stat['count'] += 1
+            stat['errors'] += 1 if failed else 0
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        """
+        Get a copy of the recorded stats.
+
+        Returns:
+            dict[str, dict[str, float]]: Mapping of call name to its count, errors, total, mean and max latency in seconds.
+        """
+        with self.lock:
+            return {call: {**stat, 'mean': stat['total'] / stat['count'] if stat['count'] else 0.0} for call, stat in self.stats.items()}
+
+
+class ModelTracker():
+    """
+    Process-wide tracker of the weights loaded on each api server, so that clients can skip redundant reloads.
+
+    Methods:
+        lock(api_url: str) -> threading.Lock: Lock serializing weight swaps on the given api server.
+        lock_async(api_url: str) -> typing.AsyncContextManager[None]: Hold the same lock from a coroutine without blocking the event loop.
+        loaded(api_url: str) -> tuple[str, str]: The `(ckpt, pth)` pair currently loaded, with None for unknown weights.
+        record_hit(api_url: str) -> None: Record a skipped reload.
+        record_swap(api_url: str, ckpt_path: str, pth_path: str, elapsed: float) -> None: Record a weight swap.
+        invalidate(api_url: str) -> None: Forget what is loaded, e.g. after a restart.
+        metrics() -> dict[str, dict[str, typing.Any]]: Swap counts and latency per api server.
+    """
+
+    def __init__(self) -> None:
+        self.endpoints: dict[str, dict[str, typing.Any]] = {}
+        self.locks: dict[str, threading.Lock] = {}
+        self.meta_lock = threading.Lock()
+
+
+    def endpoint(self, api_url: str) -> dict[str, typing.Any]:
+        with self.meta_lock:
+            if api_url not in self.endpoints:
+                self.endpoints[api_url] = {'ckpt': None, 'pth': None, 'swaps': 0, 'hits': 0, 'swap_total': 0.0, 'swap_max': 0.0}
+                self.locks[api_url] = threading.Lock()
+            return self.endpoints[api_url]
+
+
+    def lock(self, api_url: str) -> threading.Lock:
+        self.endpoint(api_url)
+        return self.locks[api_url]
+
+
+    @contextlib.asynccontextmanager
+    async def lock_async(self, api_url: str) -> typing.AsyncIterator[None]:
+        lock = self.lock(api_url)
+        acquire = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+        try:
+            await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # the thread still takes the lock, give it back once it has
+            acquire.add_done_callback(lambda future: lock.release() if not future.cancelled() and future.exception() is None else None)
+            raise
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+    def loaded(self, api_url: str) -> tuple[str, str]:
+        endpoint = self.endpoint(api_url)
+        return endpoint['ckpt'], endpoint['pth']
+
+
+    def record_hit(self, api_url: str) -> None:
+        endpoint = self.endpoint(api_url)
+        with self.meta_lock:
+            endpoint['hits'] += 1
+
+
+    def record_swap(self, api_url: str, ckpt_path: str, pth_path: str, elapsed: float) -> None:
+        endpoint = self.endpoint(api_url)
+        with self.meta_lock:
+            endpoint['ckpt'], endpoint['pth'] = ckpt_path, pth_path
+            endpoint['swaps'] += 1
+            endpoint['swap_total'] += elapsed
+            endpoint['swap_max'] = max(endpoint['swap_max'], elapsed)
+
+
+    def invalidate(self, api_url: str) -> None:
+        endpoint = self.endpoint(api_url)
+        with self.meta_lock:
+            endpoint['ckpt'], endpoint['pth'] = None, None
+
+
+    def metrics(self) -> dict[str, dict[str, typing.Any]]:
+        with self.meta_lock:
+            return {api_url: {
+                **endpoint,
+                'swap_mean': endpoint['swap_total'] / endpoint['swaps'] if endpoint['swaps'] else 0.0
+            } for api_url, endpoint in self.endpoints.items()}
+
+
+model_tracker = ModelTracker()
 
 
 class GPTSoVitsAPI():
@@ -19,6 +208,7 @@ class GPTSoVitsAPI():
         tts(ref_audio: str, ref_text: str, text: str, ref_language: str = 'auto', text_language: str = 'auto') -> requests.Response: Run TTS inference based on the API version.
         changeReferenceAudio(ref_audio: str, ref_text: str, ref_language: str = 'auto') -> None: Change reference audio.
         control(command: str): Restart or exit.
+        latency_stats() -> dict[str, dict[str, float]]: Per-call latency accounting of this client.
     """
 
     def __init__(self, api_url: str, isTTSv3: bool = False, ckpt_path: str = None, pth_path: str = None) -> None:
@@ -32,31 +222,83 @@ class GPTSoVitsAPI():
         """
         self.api_url = api_url
         self.usingV3 = isTTSv3
+        self.session = get_session(api_url)
+        self.timeout = (config.gpt_sovits_connect_timeout, config.gpt_sovits_read_timeout)
+        self.stats = LatencyStats()
         if isTTSv3:
             common.log('Using v3 API from the fast_inference_ branch')
-            self.set_models(ckpt_path, pth_path)
+            if ckpt_path is not None and pth_path is not None:
+                self.set_models(ckpt_path, pth_path)
         else:
             common.log('Using classic v1 API from the main branch')
 
 
-    def set_models(self, ckpt_path: str, pth_path: str) -> None:
+    def request(self, call: str, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session and account its latency.
+
+        Args:
+            call (str): Name of the call for latency accounting.
+            method (str): HTTP method.
+            path (str): Path relative to the api url.
+
+        Returns:
+            requests.Response: Response object from the API.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        failed = False
+        try:
+            return self.session.request(method, f'{self.api_url}{path}', **kwargs)
+        except requests.exceptions.RequestException:
+            failed = True
+            raise
+        finally:
+            self.stats.record(call, time.perf_counter() - start, failed)
+
+
+    def latency_stats(self) -> dict[str, dict[str, float]]:
+        """
+        Get the per-call latency accounting of this client. For streamed calls the latency is measured up to the response headers.
+
+        Returns:
+            dict[str, dict[str, float]]: Mapping of call name to its count, errors, total, mean and max latency in seconds.
+        """
+        return self.stats.snapshot()
+
+
+    def set_models(self, ckpt_path: str, pth_path: str, force: bool = False) -> None:
         """
-        Set the models for the v3 API.
+        Set the models for the v3 API. Weights already loaded on the server are not reloaded.
 
         Args:
             ckpt_path (str): Path to the TTS model checkpoint.
             pth_path (str): Path to the TTS model state dict.
+            force (bool, optional): Whether to reload the weights even if they are loaded. Defaults to False.
         """
-        a = requests.get(f'{self.api_url}/set_gpt_weights', params={
-            'weights_path': ckpt_path
-        })
-        b = requests.get(f'{self.api_url}/set_sovits_weights', params={
-            'weights_path': pth_path
-        })
-        if a.status_code == 200 and b.status_code == 200:
-            common.log('Successfully set models for v3 API')
-        else:
-            common.panic(f'Failed to set models for v3 API: {a.content} {b.content}')
+        with model_tracker.lock(self.api_url):
+            loaded_ckpt, loaded_pth = model_tracker.loaded(self.api_url)
+            if not force and (loaded_ckpt, loaded_pth) == (ckpt_path, pth_path):
+                model_tracker.record_hit(self.api_url)
+                return
+
+            start = time.perf_counter()
+            a = b = None
+            if force or loaded_ckpt != ckpt_path:
+                a = self.request('set_gpt_weights', 'GET', '/set_gpt_weights', params={
+                    'weights_path': ckpt_path
+                })
+            if force or loaded_pth != pth_path:
+                b = self.request('set_sovits_weights', 'GET', '/set_sovits_weights', params={
+                    'weights_path': pth_path
+                })
+            if (a is None or a.status_code == 200) and (b is None or b.status_code == 200):
+                model_tracker.record_swap(self.api_url, ckpt_path, pth_path, time.perf_counter() - start)
+                common.log('Successfully set models for v3 API')
+            else:
+                # the server may be left with only one of the weights swapped
+                model_tracker.invalidate(self.api_url)
+                common.panic(f'Failed to set models for v3 API: {a.content if a is not None else ""} {b.content if b is not None else ""}')
 
 
     # text to speech function for v1 API
@@ -74,7 +316,7 @@ class GPTSoVitsAPI():
         Returns:
             requests.Response: Response object from the API.
         """
-        return requests.post(f'{self.api_url}/', json={
+        return self.request('tts_v1', 'POST', '/', json={
             "refer_wav_path": ref_audio,
             "prompt_text": ref_text,
             "prompt_language": ref_language,
@@ -105,7 +347,7 @@ class GPTSoVitsAPI():
             "prompt_lang": ref_language,
             "media_type": "aac",
             "streaming_mode": True,
-            "parallel_infer": False,
+            "parallel_infer": config.gpt_sovits_parallel_infer,
             "tts_infer_yaml_path": self.ttsInferYamlPath
         })}'''
 
@@ -124,7 +366,7 @@ class GPTSoVitsAPI():
         Returns:
             requests.Response: Response object from the API.
         """
-        return requests.get(f'{self.api_url}/tts', params={
+        return self.request('tts_v3', 'GET', '/tts', params={
             "text": text,
             "text_lang": text_language,
             "ref_audio_path": ref_audio,
@@ -132,7 +374,7 @@ class GPTSoVitsAPI():
             "prompt_lang": ref_language,
             "media_type": "aac",
             "streaming_mode": True,
-            "parallel_infer": False
+            "parallel_infer": config.gpt_sovits_parallel_infer
         }, stream=streamed)
 
     def tts(self, ref_audio: str, ref_text: str, text: str, ref_language: str = 'auto', text_language: str = 'auto', streamed: bool = False) -> requests.Response:
@@ -157,7 +399,7 @@ class GPTSoVitsAPI():
 
     # change reference audio
     def changeReferenceAudio(self, ref_audio: str, ref_text: str, ref_language: str = 'auto') -> None:
-        r = requests.post(f'{self.api_url}/change_ref', json={
+        r = self.request('change_ref', 'POST', '/change_ref', json={
             "refer_wav_path": ref_audio,
             "prompt_text": ref_text,
             "prompt_language": ref_language
@@ -169,9 +411,291 @@ class GPTSoVitsAPI():
 
     # restart or exit
     def control(self, command: str):
-        requests.post(f'{self.api_url}/control', json={
+        model_tracker.invalidate(self.api_url)
+        self.request('control', 'POST', '/control', json={
             "command": command})
 
+class TTSRequest(typing.NamedTuple):
+    ref_audio: str
+    ref_text: str
+    text: str
+    ref_language: str = 'auto'
+    text_language: str = 'auto'
+
+
+class AsyncTTSResponse():
+    """
+    Response of the async client, mirroring the parts of `requests.Response` AIDub uses.
+
+    Attributes:
+        status_code (int): HTTP status code.
+        headers (dict[str, str]): Response headers.
+        content (bytes): Response body, None for streamed responses until `read()` is awaited.
+
+    Methods:
+        read() -> bytes: Read the whole body.
+        iter_content(chunk_size: int = 10240) -> typing.AsyncIterator[bytes]: Iterate the body as it arrives.
+        release() -> None: Return the connection to the pool.
+    """
+
+    def __init__(self, response, content: bytes = None) -> None:
+        self.response = response
+        self.status_code: int = response.status
+        self.headers: dict[str, str] = dict(response.headers)
+        self.content = content
+
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace') if self.content is not None else ''
+
+
+    async def read(self) -> bytes:
+        if self.content is None:
+            try:
+                self.content = await self.response.read()
+            finally:
+                self.release()
+        return self.content
+
+
+    async def iter_content(self, chunk_size: int = 10 * 1024) -> typing.AsyncIterator[bytes]:
+        if self.content is not None:
+            for i in range(0, len(self.content), chunk_size):
+                yield self.content[i:i + chunk_size]
+            return
+        try:
+            async for chunk in self.response.content.iter_chunked(chunk_size):
+                yield chunk
+        finally:
+            self.release()
+
+
+    def release(self) -> None:
+        self.response.release()
+
+
+class AsyncGPTSoVitsAPI():
+    """
+    Asyncio-native counterpart of `GPTSoVitsAPI`, built on aiohttp.
+
+    Use it as an async context manager, the models are set on enter:
+
+        async with AsyncGPTSoVitsAPI(api_url, True, ckpt, pth) as api:
+            async for index, result in api.tts_many(tts_requests):
+                ...
+
+    Attributes:
+        api_url (str): Url of the GPTSoVits API.
+        usingV3 (bool): whether using APIv3.py from the fast_inference_ branch.
+        concurrency (int): Maximum number of requests in flight in `tts_many`.
+
+    Methods:
+        set_models(ckpt_path: str, pth_path: str) -> None: Set the models for the v3 API.
+        tts(ref_audio: str, ref_text: str, text: str, ref_language: str = 'auto', text_language: str = 'auto', streamed: bool = False) -> AsyncTTSResponse: Run TTS inference based on the API version.
+        tts_many(tts_requests: list[TTSRequest]) -> typing.AsyncIterator[tuple[int, AsyncTTSResponse | Exception]]: Run many TTS inferences, yielding results as they finish.
+        changeReferenceAudio(ref_audio: str, ref_text: str, ref_language: str = 'auto') -> None: Change reference audio.
+        latency_stats() -> dict[str, dict[str, float]]: Per-call latency accounting of this client.
+    """
+
+    def __init__(self, api_url: str, isTTSv3: bool = False, ckpt_path: str = None, pth_path: str = None, concurrency: int = None) -> None:
+        """
+        Initialize the AsyncGPTSoVitsAPI.
+
+        Args:
+            api_url (str): Url of the GPTSoVits API.
+            isTTSv3 (bool): whether using APIv3.py from the fast_inference_ branch. Defaults to False.
+            ckpt_path (str, optional): Path to the TTS model checkpoint, set on enter.
+            pth_path (str, optional): Path to the TTS model state dict, set on enter.
+            concurrency (int, optional): Maximum number of requests in flight in `tts_many`. Defaults to `config.gpt_sovits_pool_size`.
+        """
+        self.api_url = api_url
+        self.usingV3 = isTTSv3
+        self.ckpt_path = ckpt_path
+        self.pth_path = pth_path
+        self.concurrency = concurrency if concurrency is not None else config.gpt_sovits_pool_size
+        self.session = None
+        self.stats = LatencyStats()
+
+
+    async def __aenter__(self) -> 'AsyncGPTSoVitsAPI':
+        import aiohttp
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.gpt_sovits_pool_size),
+            timeout=aiohttp.ClientTimeout(connect=config.gpt_sovits_connect_timeout, sock_read=config.gpt_sovits_read_timeout),
+            trust_env=False)
+        if self.usingV3:
+            common.log('Using v3 API from the fast_inference_ branch')
+            if self.ckpt_path is not None and self.pth_path is not None:
+                await self.set_models(self.ckpt_path, self.pth_path)
+        else:
+            common.log('Using classic v1 API from the main branch')
+        return self
+
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+    async def request(self, call: str, method: str, path: str, streamed: bool = False, retries: int = 0, connect_only: bool = False, **kwargs) -> AsyncTTSResponse:
+        """
+        Send a request and account its latency.
+
+        Args:
+            call (str): Name of the call for latency accounting.
+            method (str): HTTP method.
+            path (str): Path relative to the api url.
+            streamed (bool, optional): Whether to leave the body unread. Defaults to False.
+            retries (int, optional): Number of retries on transport errors, only for idempotent calls. Defaults to 0.
+            connect_only (bool, optional): Only retry errors raised before the request was sent, for calls too costly to run twice. Defaults to False.
+
+        Returns:
+            AsyncTTSResponse: Response object from the API.
+        """
+        import aiohttp
+        if connect_only:
+            retryable = (aiohttp.ClientConnectorError,) + ((aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, 'ConnectionTimeoutError') else ())
+        else:
+            retryable = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                response = await self.session.request(method, f'{self.api_url}{path}', **kwargs)
+                self.stats.record(call, time.perf_counter() - start)
+                result = AsyncTTSResponse(response)
+                if not streamed:
+                    await result.read()
+                return result
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.stats.record(call, time.perf_counter() - start, True)
+                if attempt >= retries or not isinstance(e, retryable):
+                    raise
+                common.log(f"Request {call} failed due to {e}, retrying...")
+                await asyncio.sleep(config.gpt_sovits_retry_backoff * (2 ** attempt))
+
+
+    async def set_models(self, ckpt_path: str, pth_path: str) -> None:
+        """
+        Set the models for the v3 API. Weights already loaded on the server are not reloaded.
+
+        Args:
+            ckpt_path (str): Path to the TTS model checkpoint.
+            pth_path (str): Path to the TTS model state dict.
+        """
+        # the same lock as the blocking client, a swap is never interleaved with another one
+        async with model_tracker.lock_async(self.api_url):
+            loaded_ckpt, loaded_pth = model_tracker.loaded(self.api_url)
+            if (loaded_ckpt, loaded_pth) == (ckpt_path, pth_path):
+                model_tracker.record_hit(self.api_url)
+                return
+
+            start = time.perf_counter()
+            a = b = None
+            try:
+                if loaded_ckpt != ckpt_path:
+                    a = await self.request('set_gpt_weights', 'GET', '/set_gpt_weights', retries=config.gpt_sovits_max_retries, params={
+                        'weights_path': ckpt_path
+                    })
+                if loaded_pth != pth_path:
+                    b = await self.request('set_sovits_weights', 'GET', '/set_sovits_weights', retries=config.gpt_sovits_max_retries, params={
+                        'weights_path': pth_path
+                    })
+            except BaseException:
+                # either may have been applied
+                model_tracker.invalidate(self.api_url)
+                raise
+            if (a is None or a.status_code == 200) and (b is None or b.status_code == 200):
+                model_tracker.record_swap(self.api_url, ckpt_path, pth_path, time.perf_counter() - start)
+                common.log('Successfully set models for v3 API')
+            else:
+                model_tracker.invalidate(self.api_url)
+                common.panic(f'Failed to set models for v3 API: {a.content if a is not None else ""} {b.content if b is not None else ""}')
+
+
+    async def tts(self, ref_audio: str, ref_text: str, text: str, ref_language: str = 'auto', text_language: str = 'auto', streamed: bool = False) -> AsyncTTSResponse:
+        """
+        Run TTS inference based on the API version.
+
+        Args:
+            ref_audio (str): Reference audio path.
+            ref_text (str): Reference text.
+            text (str): Text to be synthesized.
+            ref_language (str, optional): Reference audio language. Defaults to 'auto'.
+            text_language (str, optional): Text language. Defaults to 'auto'.
+            streamed (bool, optional): Whether to stream the response through `iter_content`. Defaults to False.
+
+        Returns:
+            AsyncTTSResponse: Response object from the API.
+        """
+        if self.usingV3:
+            return await self.request('tts_v3', 'GET', '/tts', streamed=streamed, retries=config.gpt_sovits_max_retries, connect_only=True, params={
+                "text": text,
+                "text_lang": text_language,
+                "ref_audio_path": ref_audio,
+                "prompt_text": ref_text,
+                "prompt_lang": ref_language,
+                "media_type": "aac",
+                "streaming_mode": "true",
+                "parallel_infer": "true" if config.gpt_sovits_parallel_infer else "false"
+            })
+        else:
+            return await self.request('tts_v1', 'POST', '/', streamed=streamed, json={
+                "refer_wav_path": ref_audio,
+                "prompt_text": ref_text,
+                "prompt_language": ref_language,
+                "text": text,
+                "text_language": text_language
+            })
+
+
+    async def tts_many(self, tts_requests: list[TTSRequest]) -> typing.AsyncIterator[tuple[int, AsyncTTSResponse | Exception]]:
+        """
+        Run TTS inference for many requests with at most `concurrency` in flight, yielding results as they finish.
+
+        Args:
+            tts_requests (list[TTSRequest]): The requests to synthesize.
+
+        Yields:
+            tuple[int, AsyncTTSResponse | Exception]: Index of the request and its response, or the exception it raised.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(index: int, request: TTSRequest) -> tuple[int, AsyncTTSResponse | Exception]:
+            async with semaphore:
+                try:
+                    return index, await self.tts(*request)
+                except Exception as e:
+                    return index, e
+
+        tasks = [asyncio.ensure_future(run(i, request)) for i, request in enumerate(tts_requests)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+    async def changeReferenceAudio(self, ref_audio: str, ref_text: str, ref_language: str = 'auto') -> None:
+        r = await self.request('change_ref', 'POST', '/change_ref', json={
+            "refer_wav_path": ref_audio,
+            "prompt_text": ref_text,
+            "prompt_language": ref_language
+        })
+        if r.status_code == 400:
+            raise RuntimeError(f'{__name__}: Failed to change reference audio')
+
+
+    def latency_stats(self) -> dict[str, dict[str, float]]:
+        return self.stats.snapshot()
+
+
 def run_get_text() -> subprocess.Popen:
     """
     Run the get_text.py script to get text from the user.
@@ -0,0 +1,237 @@
+"""
+SQLite store of the sentiment analysis for AIDub.
+
+Every classified sample is one row keyed by `(char, hash_id)` and indexed on
+`(char, label, score)`, so the best candidates of an emotion are a range scan and
+nothing is loaded whole. Classification results are appended batch by batch, each
+batch in its own transaction, so an interrupted run keeps everything committed so far.
+Writers bump a generation counter, and the generation of every character they touched,
+which readers poll to know what derived state to rebuild, see `prompt_selection`.
+
+A legacy `sentiment_analysis.json` is imported on first use, and written again from the
+store after every classification run for the tools which still read it.
+"""
+
+import os
+import json
+import typing
+import pathlib
+import sqlite3
+import threading
+
+import common
+import config
+
+
+labels = ["anger", "disgust", "fear", "joy", "neutral", "sadness", "surprise"]
+
+
+class AnalysisEntry(typing.NamedTuple):
+    char: str
+    hash_id: str
+    label: str
+    score: float
+    text: str
+    dest: str
+    fingerprint: str | None
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS analysis (
+    char TEXT NOT NULL,
+    hash_id TEXT NOT NULL,
+    label TEXT NOT NULL,
+    score REAL NOT NULL,
+    text TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    fingerprint TEXT,
+    PRIMARY KEY (char, hash_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS analysis_by_label ON analysis (char, label, score DESC);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+
+class AnalysisStore():
+    """
+    Analysis store class. Connections are per thread, several processes may write at once.
+
+    Attributes:
+        path (pathlib.Path): Path of the database.
+
+    Methods:
+        generation() -> int: Incremented by every write.
+        char_generations() -> dict[str, int]: Per character, incremented by every write touching its rows.
+        add(entries: list[AnalysisEntry]) -> None: Insert or replace classified samples in one transaction.
+        remove(char: str, hash_ids: typing.Iterable[str] = None) -> None: Remove samples of a character, or the whole character.
+        clear() -> None: Remove every sample.
+        set_fingerprints(char: str, fingerprints: dict[str, str]) -> None: Record the fingerprint of samples classified before they were tracked.
+        characters() -> list[str]: Characters with at least one classified sample.
+        fingerprints(char: str) -> dict[str, str | None]: Fingerprint of every classified sample of a character.
+        top_k(char: str, label: str, k: int) -> list[AnalysisEntry]: Best scored samples of an emotion.
+        entries(char: str) -> dict[str, list[AnalysisEntry]]: Classified samples of a character by emotion, best scored first.
+        count(char: str = None) -> int: Number of classified samples.
+        import_json(path: str) -> None: Import a legacy `sentiment_analysis.json`.
+        export_json(path: str) -> None: Write the store in the shape of the legacy `sentiment_analysis.json`.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = pathlib.Path(path if path is not None else config.sentiment_analysis_db_dest)
+        self.local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        created = not self.path.exists()
+        with self.connection() as conn:
+            conn.executescript(schema)
+        if created:
+            self.import_json(config.sentiment_analysis_dest)
+
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+
+    def write(self, chars: typing.Iterable[str], statements: typing.Callable[[sqlite3.Connection], None]) -> None:
+        conn = self.connection()
+        with conn:
+            statements(conn)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            conn.executemany("INSERT INTO meta (key, value) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1",
+                             [(f"generation:{char}",) for char in set(chars)])
+
+
+    def generation(self) -> int:
+        return self.connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+
+    def char_generations(self) -> dict[str, int]:
+        rows = self.connection().execute("SELECT key, value FROM meta WHERE key LIKE 'generation:%'")
+        return {key[len('generation:'):]: value for key, value in rows}
+
+
+    def add(self, entries: list[AnalysisEntry]) -> None:
+        if entries:
+            self.write([entry.char for entry in entries], lambda conn: conn.executemany("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?)", entries))
+
+
+    def remove(self, char: str, hash_ids: typing.Iterable[str] = None) -> None:
+        if hash_ids is None:
+            self.write([char], lambda conn: conn.execute("DELETE FROM analysis WHERE char = ?", (char,)))
+            return
+        rows = [(char, hash_id) for hash_id in hash_ids]
+        if rows:
+            self.write([char], lambda conn: conn.executemany("DELETE FROM analysis WHERE char = ? AND hash_id = ?", rows))
+
+
+    def clear(self) -> None:
+        self.write(self.characters(), lambda conn: conn.execute("DELETE FROM analysis"))
+
+
+    def set_fingerprints(self, char: str, fingerprints: dict[str, str]) -> None:
+        rows = [(fingerprint, char, hash_id) for hash_id, fingerprint in fingerprints.items()]
+        if rows:
+            self.write([char], lambda conn: conn.executemany("UPDATE analysis SET fingerprint = ? WHERE char = ? AND hash_id = ?", rows))
+
+
+    def characters(self) -> list[str]:
+        return [row[0] for row in self.connection().execute("SELECT DISTINCT char FROM analysis")]
+
+
+    def fingerprints(self, char: str) -> dict[str, str | None]:
+        return dict(self.connection().execute("SELECT hash_id, fingerprint FROM analysis WHERE char = ?", (char,)))
+
+
+    def top_k(self, char: str, label: str, k: int) -> list[AnalysisEntry]:
+        rows = self.connection().execute(
+            "SELECT * FROM analysis WHERE char = ? AND label = ? ORDER BY score DESC LIMIT ?", (char, label, k))
+        return [AnalysisEntry(*row) for row in rows]
+
+
+    def entries(self, char: str) -> dict[str, list[AnalysisEntry]]:
+        result = {label: [] for label in labels}
+        rows = self.connection().execute(
+            "SELECT * FROM analysis WHERE char = ? ORDER BY label, score DESC", (char,))
+        for row in rows:
+            entry = AnalysisEntry(*row)
+            result.setdefault(entry.label, []).append(entry)
+        return result
+
+
+    def count(self, char: str = None) -> int:
+        if char is None:
+            return self.connection().execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+        return self.connection().execute("SELECT COUNT(*) FROM analysis WHERE char = ?", (char,)).fetchone()[0]
+
+
+    def import_json(self, path: str) -> None:
+        """
+        Import a legacy `sentiment_analysis.json`, if it exists.
+
+        Args:
+            path (str): Path of the file.
+        """
+        if not pathlib.Path(path).exists():
+            return
+        try:
+            raw = json.loads(pathlib.Path(path).read_text())
+        except ValueError as e:
+            common.log(f"Legacy analysis file is corrupted due to {e}, not importing it")
+            return
+        entries = []
+        for char, by_label in raw.items():
+            for label, items in by_label.items():
+                for item in items:
+                    entries.append(AnalysisEntry(char, item['hash_id'], label, item['score'], item['text'], item['dest'], item.get('fingerprint')))
+        self.add(entries)
+        common.log(f"Imported {len(entries)} entries from {path}")
+
+
+    def export_json(self, path: str) -> None:
+        """
+        Write the store in the shape of the legacy `sentiment_analysis.json`, best scored first.
+
+        Args:
+            path (str): Path of the file.
+        """
+        result = {}
+        for char in self.characters():
+            result[char] = {}
+            for label, entries in self.entries(char).items():
+                result[char][label] = []
+                for entry in entries:
+                    item = {"text": entry.text, "hash_id": entry.hash_id, "score": entry.score, "dest": entry.dest}
+                    if entry.fingerprint is not None:
+                        item["fingerprint"] = entry.fingerprint
+                    result[char][label].append(item)
+        pth = pathlib.Path(path)
+        pth.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pth.with_name(pth.name + '.tmp')
+        tmp.write_text(json.dumps(result, ensure_ascii=False))
+        os.replace(tmp, pth)
+
+
+store: AnalysisStore = None
+store_lock = threading.Lock()
+
+
+def get_store() -> AnalysisStore:
+    """
+    Get the process-wide analysis store, creating the database on first use.
+
+    Returns:
+        AnalysisStore: The analysis store.
+    """
+    global store
+    with store_lock:
+        if store is None:
+            store = AnalysisStore()
+        return store
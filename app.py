@@ -5,6 +5,7 @@ import common
 import config
 import dub
 import fandom
+import fandom_crawler
 import finetune
 import voice_fetch
 import pathlib
@@ -15,7 +16,7 @@ import importlib
 import yatta
 
 
-def do_voice_collection():
+def do_voice_collection(crawled: fandom_crawler.CrawlResult = None):
     collections: dict[str, list[tuple[str, str]]] = {}
     
     for i in sources_to_fetch_voice:
@@ -24,14 +25,11 @@ def do_voice_collection():
             url = i[i.index(':')+1:]
             provider = importlib.import_module(f'customDataProviders.{providerName}')
             collections = fandom.merge_voice_collections([collections, provider.fetch_vo_urls(url, muted_characters)])
-        else:
-            quests = common.request_retry_wrapper(lambda: fandom.fetch_quest_entries(i))
-            
 
-            for quest in quests:
-                collection = fandom.fetch_target_vo_from_quest_page(quest, muted_characters)
-
-                collections = fandom.merge_voice_collections([collections, collection])
+    # every fandom source at once
+    if crawled is None:
+        crawled = fandom_crawler.crawl(sources_to_fetch_voice, [], muted_characters)
+    collections = fandom.merge_voice_collections([collections, crawled.voices])
 
     # download voices
     voice_fetch.reduce_collection(collections)
@@ -43,31 +41,27 @@ def do_voice_collection():
     pathlib.Path(dataset_manifest_file_dest).write_text(voice_fetch.serialize_collection(collections))
     
     voice_fetch.generate_text_list()
+    return crawled
     
 
-def do_subtitle_collection():
+def do_subtitle_collection(crawled: fandom_crawler.CrawlResult = None):
     collections: dict[str, list[str]] = {}
     for i in source_text_to_dub:
-        # quests = [i[i.index(':')+1:]] if i.startswith('quest:') else fandom.fetch_quest_entries(i)
-        if i.startswith('quest:'):
-            quests = [i[6:]]
-        elif i.startswith('yatta:'):
+        if i.startswith('yatta:'):
             quests = yatta.fetch_target_quests(i[6:], muted_characters)
-        else:
-            quests = fandom.fetch_quest_entries(i)
-            
-        for quest in quests:
-            collection = {}
-            if quest.startswith('yatta:'):
+            for quest in quests:
                 collection = yatta.fetch_target_subtitles_quest(quest[6:], muted_characters)
-            else:
-                collection = fandom.fetch_target_subtitles(quest, muted_characters)
-                
-            collections = fandom.merge_subtitle_collections([collections, collection])
+                collections = fandom.merge_subtitle_collections([collections, collection])
+
+    # every fandom source at once
+    if crawled is None:
+        crawled = fandom_crawler.crawl([], source_text_to_dub, muted_characters)
+    collections = fandom.merge_subtitle_collections([collections, crawled.subtitles])
 
     # with open(dub_manifest_dest, 'w') as f:
     #     f.write(dub.serialize_collection(collections))
     pathlib.Path(dub_manifest_dest).write_text(dub.serialize_collection(collections))
+    return crawled
 
 def do_finetune():
     finetune.start()
@@ -106,10 +100,16 @@ if __name__ == '__main__':
         muted_characters = common.get_muted_chars()
         common.log(f'Using middleware logic for models path: {models_path} and muted characters: {muted_characters}')
     
-    if args.voice:
-        do_voice_collection()
+    if args.voice and args.subtitle:
+        # one pass over the quest pages for both
+        crawled = fandom_crawler.crawl(sources_to_fetch_voice, source_text_to_dub, muted_characters)
+        do_voice_collection(crawled)
+        do_subtitle_collection(crawled)
+        crawled.raise_for_failures()
+    elif args.voice:
+        do_voice_collection().raise_for_failures()
     elif args.subtitle:
-        do_subtitle_collection()
+        do_subtitle_collection().raise_for_failures()
     elif args.dub_all:
         dub.dub_all(args.use_middleware_logic)
     elif args.inference_server:
@@ -0,0 +1,300 @@
+"""
+Audio metadata index for AIDub.
+
+Keeps the duration, sample rate, channel count and byte size of every dataset clip in
+`config.audio_index_dest`, next to `dataset_manifest.json`. Metadata is read from the
+container headers (MP3 frame headers with their Xing/Info/VBRI tags, RIFF chunks),
+without decoding any audio. Entries are validated against the size and modification
+time of the file and recomputed lazily when missing or stale.
+"""
+
+import os
+import json
+import struct
+import atexit
+import typing
+import pathlib
+import threading
+
+import common
+import config
+
+
+class AudioInfo(typing.NamedTuple):
+    duration: float
+    sample_rate: int
+    channels: int
+    size: int
+
+
+# kbps, indexed by [mpeg1][layer][bitrate index]
+mp3_bitrates = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Hz, indexed by version id
+mp3_sample_rates = {
+    0b11: [44100, 48000, 32000],  # MPEG1
+    0b10: [22050, 24000, 16000],  # MPEG2
+    0b00: [11025, 12000, 8000],   # MPEG2.5
+}
+
+# bytes read from the head of a file, enough for large ID3 tags with cover art to be skipped
+header_probe_size = 64 * 1024
+
+# containers left to soundfile, fandom serves ogg clips which are saved as .mp3
+other_signatures = [b'OggS', b'fLaC', b'RIFF']
+
+# bumped when probing changes, entries of an older version are probed again
+index_version = 2
+
+
+def is_other_container(head: bytes) -> bool:
+    return any(head.startswith(signature) for signature in other_signatures) or head[4:8] == b'ftyp'
+
+
+def parse_frame_header(buf: bytes, pos: int) -> tuple[int, int, int, int, int, int] | None:
+    """
+    Parse the MP3 frame header at `pos`.
+
+    Returns:
+        tuple[int, int, int, int, int, int] | None: `(version, layer, bitrate_index, sample_rate_index, channel_mode, frame_length)`, or None if there is no valid header there.
+    """
+    if pos + 4 > len(buf) or buf[pos] != 0xFF or (buf[pos + 1] & 0xE0) != 0xE0:
+        return None
+    header = struct.unpack('>I', buf[pos:pos + 4])[0]
+    version = (header >> 19) & 0b11
+    layer = 4 - ((header >> 17) & 0b11)
+    bitrate_index = (header >> 12) & 0b1111
+    sample_rate_index = (header >> 10) & 0b11
+    padding = (header >> 9) & 0b1
+    channel_mode = (header >> 6) & 0b11
+    if version == 0b01 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 0b11
+    sample_rate = mp3_sample_rates[version][sample_rate_index]
+    bitrate = mp3_bitrates[(mpeg1, layer)][bitrate_index] * 1000
+    if layer == 1:
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        frame_length = (144 if layer == 2 or mpeg1 else 72) * bitrate // sample_rate + padding
+    return version, layer, bitrate_index, sample_rate_index, channel_mode, frame_length
+
+
+def probe_mp3(f: typing.BinaryIO, size: int) -> AudioInfo | None:
+    """
+    Read the metadata of an MP3 file from its frame headers.
+
+    Args:
+        f (typing.BinaryIO): The opened file.
+        size (int): Size of the file in bytes.
+
+    Returns:
+        AudioInfo | None: The metadata, or None if the file is not an MP3 stream.
+    """
+    head = f.read(10)
+    audio_start = 0
+    if head[:3] == b'ID3' and len(head) == 10:
+        tag_size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        audio_start = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+    f.seek(audio_start)
+    buf = f.read(header_probe_size)
+
+    # find the first valid frame header, followed by a second one of the same stream
+    # so that a stray 0xFFE? byte pair in other data is not taken for a frame sync
+    for pos in range(0, len(buf) - 4):
+        frame = parse_frame_header(buf, pos)
+        if frame is None:
+            continue
+        version, layer, bitrate_index, sample_rate_index, channel_mode, frame_length = frame
+        following = parse_frame_header(buf, pos + frame_length)
+        if following is not None and following[:2] == (version, layer) and following[3] == sample_rate_index:
+            break
+    else:
+        return None
+
+    mpeg1 = version == 0b11
+    sample_rate = mp3_sample_rates[version][sample_rate_index]
+    bitrate = mp3_bitrates[(mpeg1, layer)][bitrate_index] * 1000
+    channels = 1 if channel_mode == 0b11 else 2
+    samples_per_frame = 384 if layer == 1 else (1152 if layer == 2 or mpeg1 else 576)
+
+    # VBR files carry the total frame count in a Xing/Info or VBRI tag inside the first frame
+    frames = None
+    side_info = (17 if channels == 1 else 32) if mpeg1 else (9 if channels == 1 else 17)
+    xing = pos + 4 + side_info
+    if buf[xing:xing + 4] in (b'Xing', b'Info') and len(buf) >= xing + 12:
+        flags = struct.unpack('>I', buf[xing + 4:xing + 8])[0]
+        if flags & 0x1:
+            frames = struct.unpack('>I', buf[xing + 8:xing + 12])[0]
+    vbri = pos + 4 + 32
+    if frames is None and buf[vbri:vbri + 4] == b'VBRI' and len(buf) >= vbri + 18:
+        frames = struct.unpack('>I', buf[vbri + 14:vbri + 18])[0]
+
+    if frames:
+        duration = frames * samples_per_frame / sample_rate
+    else:
+        # constant bitrate, estimate from the stream size
+        audio_size = size - audio_start - pos
+        if size >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b'TAG':
+                audio_size -= 128
+        duration = audio_size * 8 / bitrate
+
+    return AudioInfo(duration, sample_rate, channels, size)
+
+
+def probe_wav(f: typing.BinaryIO, size: int) -> AudioInfo | None:
+    """
+    Read the metadata of a RIFF/WAVE file from its chunk headers.
+
+    Args:
+        f (typing.BinaryIO): The opened file.
+        size (int): Size of the file in bytes.
+
+    Returns:
+        AudioInfo | None: The metadata, or None if the file is not a WAVE file.
+    """
+    head = f.read(12)
+    if len(head) < 12 or head[:4] != b'RIFF' or head[8:12] != b'WAVE':
+        return None
+    sample_rate = channels = byte_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size)
+            if len(fmt) < 12:
+                return None
+            channels, sample_rate, byte_rate = struct.unpack('<HII', fmt[2:12])
+            f.seek(chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if byte_rate is None or byte_rate == 0:
+                return None
+            # streamed writers may leave the data size unset
+            data_size = min(chunk_size, size - f.tell())
+            return AudioInfo(data_size / byte_rate, sample_rate, channels, size)
+        else:
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def probe(path: str) -> AudioInfo:
+    """
+    Read the metadata of an audio file without decoding it.
+
+    Args:
+        path (str): Path of the audio file.
+
+    Returns:
+        AudioInfo: The metadata.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        info = probe_wav(f, size)
+        if info is not None:
+            return info
+        f.seek(0)
+        if not is_other_container(f.read(12)):
+            f.seek(0)
+            info = probe_mp3(f, size)
+            if info is not None:
+                return info
+
+    # other containers, soundfile only parses the header here
+    import soundfile as sf
+    info = sf.info(path)
+    return AudioInfo(info.duration, info.samplerate, info.channels, size)
+
+
+class AudioIndex():
+    """
+    Audio index class.
+
+    Attributes:
+        path (pathlib.Path): Path of the persisted index.
+
+    Methods:
+        get(path: str) -> AudioInfo: Metadata of an audio file, computed lazily.
+        duration(path: str) -> float: Duration of an audio file in seconds.
+        build(paths: typing.Iterable[str]) -> None: Index the given files and persist the index.
+        save() -> None: Persist the index.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = pathlib.Path(path if path is not None else config.audio_index_dest)
+        self.lock = threading.Lock()
+        self.entries: dict[str, dict[str, typing.Any]] = {}
+        self.dirty = False
+        if self.path.exists():
+            try:
+                self.entries = json.loads(self.path.read_text())
+            except ValueError as e:
+                common.log(f"Audio index is corrupted due to {e}, starting over")
+
+
+    def get(self, path: str) -> AudioInfo:
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns and entry.get('version') == index_version:
+            return AudioInfo(entry['duration'], entry['sample_rate'], entry['channels'], entry['size'])
+
+        info = probe(path)
+        with self.lock:
+            self.entries[path] = {**info._asdict(), 'mtime_ns': st.st_mtime_ns, 'version': index_version}
+            self.dirty = True
+        return info
+
+
+    def duration(self, path: str) -> float:
+        return self.get(path).duration
+
+
+    def build(self, paths: typing.Iterable[str]) -> None:
+        indexed = 0
+        for path in paths:
+            try:
+                self.get(path)
+                indexed += 1
+            except Exception as e:
+                common.log(f"Failed to index {path}: {e}, ignoring")
+        common.log(f"Indexed {indexed} audio files")
+        self.save()
+
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, ensure_ascii=False)
+            self.dirty = False
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(data)
+            os.replace(tmp, self.path)
+
+
+index: AudioIndex = None
+index_lock = threading.Lock()
+
+
+def get_index() -> AudioIndex:
+    """
+    Get the process-wide audio index, loading it on first use.
+
+    Returns:
+        AudioIndex: The audio index.
+    """
+    global index
+    with index_lock:
+        if index is None:
+            index = AudioIndex()
+            atexit.register(index.save)
+        return index
@@ -5,19 +5,20 @@ import typing
 import config
 import common
 import fandom
+import fandom_crawler
 import voice_fetch
 import emotion
 import dub
 import importlib
 import communication
+import dataset_registry
 
 def run_gpt_sovits_server():
     os.system("cd GPT-SoVITs && python api_v2.py")
 
 
 def before_request():
-    config.models_path = common.get_available_model_path()
-    config.muted_characters = common.get_muted_chars()
+    dataset_registry.get_registry().apply()
     emotion.load_analysis_file()
 
 def makeResult(ok: bool = True, data: typing.Any = None) -> dict:
@@ -34,14 +35,10 @@ def do_voice_collection():
             url = i[i.index(':')+1:]
             provider = importlib.import_module(f'customDataProviders.{providerName}')
             collections = fandom.merge_voice_collections([collections, provider.fetch_vo_urls(url, config.muted_characters)])
-        else:
-            quests = common.request_retry_wrapper(lambda: fandom.fetch_quest_entries(i))
 
-
-            for quest in quests:
-                collection = fandom.fetch_target_vo_from_quest_page(quest, config.muted_characters)
-
-                collections = fandom.merge_voice_collections([collections, collection])
+    # every fandom source at once
+    crawled = fandom_crawler.crawl(config.sources_to_fetch_voice, [], config.muted_characters)
+    collections = fandom.merge_voice_collections([collections, crawled.voices])
 
     # download voices
     voice_fetch.reduce_collection(collections)
@@ -49,6 +46,7 @@ def do_voice_collection():
     pathlib.Path(config.dataset_manifest_file_dest).write_text(voice_fetch.serialize_collection(collections))
 
     voice_fetch.generate_text_list()
+    return crawled.failed
 
 
 def download_dataset_cli(char_names: list[str], sources_to_fetch: list[str]):
@@ -58,33 +56,51 @@ def download_dataset_cli(char_names: list[str], sources_to_fetch: list[str]):
 
     config.muted_characters = [i for i in set(char_names + config.muted_characters)]
     config.sources_to_fetch_voice = [i for i in set(sources_to_fetch + config.sources_to_fetch_voice)]
-    do_voice_collection()
+    failed = do_voice_collection()
+    if failed:
+        print(f"Error: dataset for {char_names} is incomplete, {len(failed)} pages failed to crawl, run again to retry them:")
+        for url in failed:
+            print(f"  {url}")
+        return False
 
     print(f"Dataset for {char_names} downloaded successfully.")
     return True
 
 
-def emotion_classification_cli():
-    emotion.do_classification()
+def emotion_classification_cli(full: bool = False, workers: int = None):
+    emotion.do_classification(full, workers)
     print('Emotion classification completed.')
     return True
 
 
+def emotion_verify_cli(backend: str, samples: int = None):
+    import emotion_backends
+    report = emotion_backends.verify(backend, samples)
+    passed = all(i['agreement'] >= config.emotion_min_agreement for i in report.values())
+    print(f"Emotion backend {backend} {'passed' if passed else 'failed'} verification.")
+    return passed
+
+
+def fandom_benchmark_cli(save: list[str] = None, fixtures: str = None, rounds: int = 5):
+    import fandom_parse
+    for url in save or []:
+        print(f"Saved {url} to {fandom_parse.save_fixture(url, fixtures)}")
+    report = fandom_parse.benchmark(fixtures, rounds)
+    matched = all(all(i['matches'].values()) for i in report.values())
+    print(f"Fandom parsing {'matches' if matched else 'does not match'} the reference extractors.")
+    return matched
+
+
 def dub_cli(text: str, char_name: str):
     if not text or not char_name:
         print("Error: --text and --char-name are required.")
         return False
 
-    ckpt, pth = dub.get_tts_models(char_name)
-    dub.setup_gpt_sovits_client(ckpt, pth)
-    r = dub.dub_one(text, char_name, True)
-
-    headers = r.headers
+    _, chunks = dub.stream_one(text, char_name)
     filename = f'{char_name}.aac'
-    headers['Content-Disposition'] = f'attachment; filename={filename}'
 
     with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=10*1024):
+        for chunk in chunks:
             if chunk:
                 f.write(chunk)
     print(f"Dubbing completed and saved to {filename}")
@@ -234,8 +250,21 @@ def main():
 
     # emotion_classification
     emotion_classification_parser = subparsers.add_parser("emotion_classification", help="Perform emotion classification")
+    emotion_classification_parser.add_argument("--full", action="store_true", help="Reclassify every sample instead of only new or changed ones")
+    emotion_classification_parser.add_argument("--workers", type=int, help="Number of worker processes (default: config.emotion_workers)")
+
+    # emotion_verify
+    emotion_verify_parser = subparsers.add_parser("emotion_verify", help="Compare an emotion classifier backend against the reference one")
+    emotion_verify_parser.add_argument("--backend", type=str, choices=["torch", "int8", "onnx", "onnx-int8"], help="Backend to verify", required=True)
+    emotion_verify_parser.add_argument("--samples", type=int, help="Number of dataset samples to compare on (default: config.emotion_verify_samples)")
 
     # dub
+    # fandom_benchmark
+    fandom_benchmark_parser = subparsers.add_parser("fandom_benchmark", help="Compare the fast fandom parsing against the reference one on saved pages")
+    fandom_benchmark_parser.add_argument("--save", type=str, nargs="*", help="Fandom page urls to save as fixtures first")
+    fandom_benchmark_parser.add_argument("--fixtures", type=str, help="Directory of the fixture pages (default: config.fandom_fixtures_dest)")
+    fandom_benchmark_parser.add_argument("--rounds", type=int, default=5, help="Times each page is parsed (default: 5)")
+
     dub_parser = subparsers.add_parser("dub", help="Dub text using specified character")
     dub_parser.add_argument("--text", type=str, help="Text to dub", required=True)
     dub_parser.add_argument("--char-name", type=str, help="Character name for dubbing", required=True)
@@ -278,7 +307,11 @@ def main():
         sources_to_fetch = [source.strip() for source in args.sources_to_fetch.split(',')]
         download_dataset_cli(char_names, sources_to_fetch)
     elif args.command == "emotion_classification":
-        emotion_classification_cli()
+        emotion_classification_cli(args.full, args.workers)
+    elif args.command == "emotion_verify":
+        emotion_verify_cli(args.backend, args.samples)
+    elif args.command == "fandom_benchmark":
+        fandom_benchmark_cli(args.save, args.fixtures, args.rounds)
     elif args.command == "dub":
         dub_cli(args.text, args.char_name)
     elif args.command == "preprocess_dataset":
@@ -9,14 +9,40 @@ import typing
 import asyncio
 from multiprocessing import cpu_count
 import threading
+import functools
 
 
 def panic(what: str):
     raise RuntimeError(what)
 
 
+# per-thread log listener, lets background jobs capture the logs of the work they run
+# work handed to other threads carries it with `carry_log_listener`
+log_listener = threading.local()
+
+
 def log(msg: typing.Any):
     print(datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S][AIDub] "), msg)
+    listener = getattr(log_listener, 'callback', None)
+    if listener is not None:
+        listener(str(msg))
+
+
+def carry_log_listener(func: typing.Callable) -> typing.Callable:
+    """
+    Wrap `func` to run with the log listener of the calling thread, for work handed to a worker thread.
+    """
+    callback = getattr(log_listener, 'callback', None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(log_listener, 'callback', None)
+        log_listener.callback = callback
+        try:
+            return func(*args, **kwargs)
+        finally:
+            log_listener.callback = previous
+    return wrapper
 
 
 def md5(s: str) -> str:
@@ -82,36 +108,34 @@ def run_in_parallel(func, args_list, max_workers=32):
 
 
 def check_if_audio_exceeds_10s(audio_path: str) -> bool:
-    import soundfile as sf
-    audio, sr = sf.read(audio_path)
-    log(f"Audio length: {len(audio) / sr}s")
-    return (len(audio) / sr) > 9 or (len(audio) / sr) < 4
+    # read from the audio index, missing entries are parsed from the file headers
+    import audio_index
+    duration = audio_index.get_index().duration(audio_path)
+    return duration > 9 or duration < 4
 
 
-def request_retry_wrapper(fetcher: typing.Callable, max_retries: int = 128):
-    for _ in range(max_retries):
-        try:
-            req = fetcher()
-            return req
-        except Exception as e:
-            import random
-            log(f"Failed to fetch data due to {e}, retrying...")
-            time.sleep(1 / random.randint(1, 5))
-            if _ > 5:
-                raise e
-            continue
-            
-        
-    log(f"Failed to fetch data after {max_retries} retries.")
+def request_retry_wrapper(fetcher: typing.Callable, max_retries: int = None, url: str = None):
+    """
+    Run a fetcher under the shared retry and rate limit policy, see `http_policy`.
+    Only transport errors are retried, anything else the fetcher raises is raised at once.
+    :param fetcher: The function sending the request.
+    :param max_retries: Retries before giving up. If None, use `config.http_max_retries`.
+    :param url: The url fetched, selects the rate limit of its host. If None, the default one.
+    :return: What the fetcher returned.
+    """
+    import http_policy
+    return http_policy.get_policy().call(url if url is not None else "default", fetcher, max_retries)
 
 
 def dataset_overview():
-    dataset_manifest = json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text())
+    import manifest_store
+    store = manifest_store.get_store()
+    chars = store.characters()
     log(f"File: {config.dataset_manifest_file_dest}")
-    log(f"Contain characers: {dataset_manifest.keys()}")
-    log(f"Total number of samples: {sum(len(dataset_manifest[char]) for char in dataset_manifest)}")
-    for i in dataset_manifest:
-        log(f"{i}: {len(dataset_manifest[i])} samples")
+    log(f"Contain characers: {chars}")
+    log(f"Total number of samples: {sum(len(store.samples(char)) for char in chars)}")
+    for i in chars:
+        log(f"{i}: {len(store.samples(i))} samples")
         
         
 def cached_data(key: str, data_resolver: typing.Callable):
@@ -177,12 +201,12 @@ def get_default_model_path() -> tuple[str, str]:
 
 
 def get_muted_chars() -> list[str]:
-    try:
-        s1 = [i for i in json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text()).keys()]
-        s2 = missing
-        return [i for i in set(s1 + s2)]
-    except FileNotFoundError:
+    import manifest_store
+    if not pathlib.Path(config.dataset_manifest_file_dest).exists():
         return []
+    s1 = manifest_store.get_store().characters()
+    s2 = missing
+    return [i for i in set(s1 + s2)]
 
 
 def extract_character_name(encoded_char_name: str) -> tuple[str, str]:
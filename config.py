@@ -139,10 +139,16 @@ necessary_replacements = {
 save_dest_root = "saves"
 save_dest_for_downloaded_voice = f"{save_dest_root}/downloaded_voices"
 dataset_manifest_file_dest = f"{save_dest_root}/dataset_manifest.json"
+audio_index_dest = f"{save_dest_root}/audio_index.json"
 dub_manifest_dest = f"{save_dest_root}/dub_manifest.json"
 dub_result_dest = f"{save_dest_root}/dub_result"
 dub_result_manifest_dest = f"{save_dest_root}/dub_result_manifest.json"
+dub_cache_index_dest = f"{save_dest_root}/dub_cache_index.json"
+# legacy json analysis, imported into sentiment_analysis_db_dest on first use
 sentiment_analysis_dest = f"{save_dest_root}/sentiment_analysis.json"
+sentiment_analysis_db_dest = f"{save_dest_root}/sentiment_analysis.sqlite3"
+download_ledger_dest = f"{save_dest_root}/download_ledger.sqlite3"
+emotion_text_cache_dest = f"{save_dest_root}/text_emotion_cache.json"
 screenshot_dest = f"{save_dest_root}/screenshot.png"
 
 # gpt sovits configuration
@@ -150,6 +156,123 @@ logs_dest = f"{save_dest_root}/logs"
 gpt_model_path = "thirdparty/GPTSoViTs/GPT_weights_v2"
 sovits_model_path = "thirdparty/GPTSoViTs/SoVITS_weights_v2"
 
+# bs4 tree builder of the fandom scrapers, "lxml" or "html.parser", see fandom_parse.py
+fandom_parser = "lxml"
+# pages fetched and parsed at once while crawling the fandom sources, see fandom_crawler.py
+fandom_crawler_workers = 16
+# saved pages `cli.py fandom_benchmark` runs on
+fandom_fixtures_dest = "fixtures/fandom"
+
+# retry and rate limit policy shared by every scraper and downloader, see http_policy.py
+http_max_retries = 6
+http_backoff_base = 0.5
+http_backoff_cap = 60
+# (connect, read) timeouts of http_policy.get
+http_timeout = (10, 60)
+# (requests per second, burst) of each host, matched by domain suffix, other hosts use the default
+http_rate_limits = {
+    "fandom.com": (5, 10),
+    "huggingface.co": (20, 40),
+    "yatta.moe": (5, 10),
+}
+http_default_rate_limit = (50, 100)
+# consecutive failures which open the circuit of a host, and seconds before it is probed again
+http_circuit_threshold = 10
+http_circuit_cooldown = 30
+# seconds a request waits for an open circuit to be probed and closed again before giving up
+http_circuit_max_wait = 120
+
+# voice dataset downloads, see download_engine.py
+# clips in flight across every character, and connections to a single host
+download_concurrency = 32
+download_per_host = 8
+download_chunk_size = 65536
+download_connect_timeout = 10
+download_read_timeout = 60
+# seconds between throughput reports
+download_report_interval = 5
+
+# seconds between checks of the weights folders and dataset manifest for changes, see dataset_registry
+dataset_registry_poll_interval = 1
+
+# middleware serving, see `python middleware.py --help`
+# "flask" (development server), "waitress" or "gunicorn"
+middleware_server = "waitress"
+middleware_host = "192.168.1.7"
+middleware_port = 2731
+# gunicorn worker processes, each keeps its own inference pool accounting and caches
+middleware_workers = 1
+middleware_threads = 32
+# server threads long-running routes (dataset download, classification, training) may take at once
+middleware_max_long_running = 2
+
+# background jobs of the middleware, see jobs.py
+jobs_dest = f"{save_dest_root}/jobs.json"
+jobs_max_workers = 4
+# jobs of a group running at once, so that e.g. only one job uses the gpu at a time
+jobs_group_limits = {"gpu": 1, "network": 2}
+jobs_max_log_lines = 500
+
+# gpt sovits inference backends, each one is an api_v2.py process
+# set `numa_node` to pin a backend to a cpu socket with numactl
+gpt_sovits_backends = [
+    {"host": "127.0.0.1", "port": 2372, "tts_infer_yaml": "templates/tts_infer.yaml"},
+    # {"host": "127.0.0.1", "port": 2373, "tts_infer_yaml": "templates/tts_infer.yaml", "numa_node": 1},
+]
+# seconds between backend health checks, 0 to disable the background checker
+gpt_sovits_health_check_interval = 10
+
+# gpt sovits client configuration
+# connections kept alive for each api server
+gpt_sovits_pool_size = 16
+gpt_sovits_connect_timeout = 3.05
+# generating a long line can take a while on cpu
+gpt_sovits_read_timeout = 300
+# retries only apply to idempotent calls (GET), inferences (/tts) are only retried on connect errors
+gpt_sovits_max_retries = 3
+gpt_sovits_retry_backoff = 0.5
+# let api_v2 batch the sentences of a single request, mostly useful on gpu
+gpt_sovits_parallel_infer = False
+
+# dub scheduler configuration
+# maximum number of tts requests in flight for each loaded (ckpt, pth) pair
+dub_max_inflight = 4
+# dub result cache, least recently used results are evicted above the budget
+dub_cache_max_bytes = 4 * 1024 * 1024 * 1024
+# seconds between index writes while dubbing, the index is always written on exit
+dub_cache_save_interval = 10
+# "threaded" to fan out with a thread pool, "async" to use the asyncio client
+dub_client = "threaded"
+# lines longer than this many characters are split at sentence boundaries and their
+# segments synthesized concurrently when dubbed one by one, 0 to disable
+dub_long_text_threshold = 120
+# target length of a segment in characters
+dub_segment_max_chars = 60
+
+# emotion classification configuration
+# samples per forward pass of the audio and text classifiers
+emotion_batch_size = 16
+# threads decoding and resampling audio ahead of the classifiers
+emotion_loader_workers = 4
+# sample rate the audio classifier was trained on
+emotion_sample_rate = 16000
+# worker processes classifying in parallel, each with its own model instances, 1 to classify in process
+emotion_workers = 1
+# cpu threads of each worker process, None to split the cores evenly
+emotion_threads_per_worker = None
+# samples of a character per worker shard
+emotion_shard_size = 500
+# text -> emotion results kept in memory, persisted to emotion_text_cache_dest unless it is None
+emotion_text_cache_size = 20000
+# models loaded in the background when the middleware starts, e.g. ["text_emotion", "audio_emotion"]
+prewarm_models = ["text_emotion"]
+# "torch", "int8", "onnx" or "onnx-int8", see emotion_backends, verify with `cli.py emotion_verify` first
+emotion_backend = "torch"
+emotion_onnx_dest = f"{save_dest_root}/emotion_onnx"
+# dataset samples compared against the torch backend, and the label agreement a backend needs
+emotion_verify_samples = 64
+emotion_min_agreement = 0.95
+
 # Python 3.10 adaption
 if sys.version_info.major == 3 and sys.version_info.minor <= 10:
     print("Python 3.10 detected, applying adaptions...")
@@ -6,6 +6,7 @@ import json
 import threading
 import time
 import common
+import http_policy
 import pathlib
 
 original_postfix = None # "?Expires=xxxxx&OSSAccessKeyId=xxxxx&Signature=xxxxx"
@@ -68,7 +69,7 @@ def get_data(offset, length):
             raise ValueError('Invalid cache file')
     
     url = f"{src}&offset={offset}&length={length}"
-    response = requests.get(url, stream=False)
+    response = http_policy.get(url, stream=False)
     data = json.loads(response.text)
     cache.write_text(json.dumps(data))
     return data
@@ -6,6 +6,7 @@ import json
 import threading
 import time
 import common
+import http_policy
 import pathlib
 
 # lanuage to use
@@ -66,7 +67,7 @@ def get_data(offset, length):
             pass
     
     url = f"{src}&offset={offset}&length={length}"
-    response = requests.get(url, stream=False)
+    response = http_policy.get(url, stream=False)
     data = json.loads(response.text)
     cache.write_text(json.dumps(data))
     return data
@@ -0,0 +1,109 @@
+"""
+Watched registry of the trained models and dataset characters for AIDub.
+
+`common.get_available_model_path()` walks the weights folders and parses every file
+name, and `common.get_muted_chars()` depends on the dataset manifest. The registry
+computes both once and only again when the weights folders or the manifest change,
+checked by polling their modification times at most every
+`config.dataset_registry_poll_interval` seconds. Every rebuild bumps `generation`.
+"""
+
+import os
+import time
+import typing
+import threading
+
+import common
+import config
+import manifest_store
+
+
+class DatasetRegistry():
+    """
+    Dataset registry class.
+
+    Attributes:
+        generation (int): Incremented every time the state is rebuilt.
+        models_path (dict[str, tuple[str, str]]): The `(ckpt, pth)` pair of every trained character.
+        muted_characters (list[str]): Characters to dub.
+
+    Methods:
+        refresh(force: bool = False) -> bool: Rebuild the state if the watched files changed.
+        apply() -> None: Refresh and publish the state to `config.models_path` and `config.muted_characters`.
+    """
+
+    def __init__(self, poll_interval: float = None) -> None:
+        self.poll_interval = poll_interval if poll_interval is not None else config.dataset_registry_poll_interval
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.signature: tuple[typing.Any, ...] | None = None
+        self.last_poll = 0.0
+        self.models_path: dict[str, tuple[str, str]] = {}
+        self.muted_characters: list[str] = []
+
+
+    def watched_signature(self) -> tuple[typing.Any, ...]:
+        # a folder's mtime changes when a file is added, removed or renamed in it
+        signature = []
+        for path in (config.gpt_model_path, config.sovits_model_path):
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        signature.append(manifest_store.get_store().generation)
+        return tuple(signature)
+
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Rebuild the state if the weights folders or the dataset manifest changed.
+
+        Args:
+            force (bool, optional): Rebuild even if nothing changed. Defaults to False.
+
+        Returns:
+            bool: Whether the state was rebuilt.
+        """
+        now = time.time()
+        if not force and self.signature is not None and now - self.last_poll < self.poll_interval:
+            return False
+
+        with self.lock:
+            self.last_poll = now
+            signature = self.watched_signature()
+            if not force and signature == self.signature:
+                return False
+            start = time.time()
+            # twice, characters with a model but no dataset are only muted after the first pass
+            common.get_available_model_path()
+            models_path = common.get_available_model_path()
+            muted_characters = common.get_muted_chars()
+            self.models_path, self.muted_characters = models_path, muted_characters
+            self.signature = signature
+            self.generation += 1
+            common.log(f"Loaded {len(models_path)} models and {len(muted_characters)} characters in {time.time() - start:.3f}s")
+            return True
+
+
+    def apply(self) -> None:
+        self.refresh()
+        config.models_path = self.models_path
+        config.muted_characters = self.muted_characters
+
+
+registry: DatasetRegistry = None
+registry_lock = threading.Lock()
+
+
+def get_registry() -> DatasetRegistry:
+    """
+    Get the process-wide dataset registry.
+
+    Returns:
+        DatasetRegistry: The dataset registry.
+    """
+    global registry
+    with registry_lock:
+        if registry is None:
+            registry = DatasetRegistry()
+        return registry
@@ -0,0 +1,341 @@
+"""
+Download engine of the voice datasets for AIDub.
+
+Every clip of every character goes through one asyncio event loop and one aiohttp
+session, so connections are kept alive and reused across characters. At most
+`config.download_concurrency` clips are in flight at once and at most
+`config.download_per_host` connections are opened to a single host. Responses are
+streamed to a `.part` file in chunks of `config.download_chunk_size` and renamed
+into place once complete and recognised as audio, an interrupted download never leaves
+a truncated clip. Clips are tracked in the download ledger, complete clips are skipped
+by their size and mtime alone and partial ones are resumed with a range request. An untracked
+clip, e.g. downloaded before the ledger, is only adopted once its size matches the
+`Content-Length` of the server, one truncated by an older run is resumed. The ledger is
+sqlite, its calls run in worker threads so that they never stall the event loop.
+The aggregate throughput is logged every `config.download_report_interval` seconds.
+"""
+
+import os
+import json
+import hashlib
+import time
+import typing
+import asyncio
+import pathlib
+
+import common
+import config
+import http_policy
+import download_ledger
+
+
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+
+
+class DownloadError(http_policy.RetryableError):
+    pass
+
+
+class DownloadTask(typing.NamedTuple):
+    """
+    A clip to download.
+
+    Attributes:
+        char (str): The character.
+        text (str): Text of the clip, the file is named after its md5.
+        url (str | dict[str, str]): Url of the clip, or `{'path': ...}` for clips already downloaded by a data provider.
+        fallback_url (str | None): Url of the rows page the url is refreshed from when it expired.
+        cache_path (str | None): Where the rows page is cached.
+        index (int | None): Row of the clip in the rows page.
+    """
+    char: str
+    text: str
+    url: str | dict[str, str]
+    fallback_url: str | None = None
+    cache_path: str | None = None
+    index: int | None = None
+
+
+    def dest(self) -> pathlib.Path:
+        return pathlib.Path(config.save_dest_for_downloaded_voice) / self.char / f"{common.md5(self.text)}.mp3"
+
+
+def tasks_from_collection(collection: dict[str, list[tuple]]) -> list[DownloadTask]:
+    """
+    Flatten a voice collection into download tasks.
+
+    Args:
+        collection (dict[str, list[tuple]]): For each character, `(text, url)` or `(text, url, fallback_url, cache_path, index)` tuples.
+
+    Returns:
+        list[DownloadTask]: The tasks.
+    """
+    tasks = []
+    for char in collection:
+        for voice in collection[char]:
+            tasks.append(DownloadTask(char, *voice))
+    return tasks
+
+
+def parse_total_size(response: typing.Any) -> int | None:
+    """
+    Size of the whole body, from `Content-Range` of a partial response or `Content-Length` otherwise.
+    """
+    if response.status == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    return response.content_length
+
+
+class Throughput():
+    """
+    Aggregate throughput of a download run.
+
+    Attributes:
+        total (int): Number of tasks.
+        done (int): Tasks downloaded.
+        skipped (int): Tasks already downloaded, or forbidden.
+        failed (int): Tasks which failed after every retry.
+        bytes (int): Bytes written.
+    """
+
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+
+
+    def report(self) -> str:
+        elapsed = max(time.time() - self.start, 1e-6)
+        finished = self.done + self.skipped + self.failed
+        return (f"{finished}/{self.total} clips ({self.done} downloaded, {self.skipped} skipped, {self.failed} failed), "
+                f"{self.bytes / 1048576:.1f} MiB at {self.bytes / 1048576 / elapsed:.2f} MiB/s")
+
+
+class DownloadEngine():
+    """
+    Download engine class.
+
+    Attributes:
+        concurrency (int): Maximum number of clips in flight.
+        per_host (int): Maximum number of connections to a single host.
+
+    Methods:
+        download_all(tasks: list[DownloadTask], check_cancelled: typing.Callable[[], None] = None) -> Throughput: Download every task, blocking until done.
+        run(tasks: list[DownloadTask], check_cancelled: typing.Callable[[], None] = None) -> Throughput: Coroutine behind `download_all`.
+    """
+
+    def __init__(self, concurrency: int = None, per_host: int = None) -> None:
+        self.concurrency = concurrency if concurrency is not None else config.download_concurrency
+        self.per_host = per_host if per_host is not None else config.download_per_host
+        self.session = None
+        self.ledger = download_ledger.get_ledger()
+        # rows pages already resolved in this run, by cache path
+        self.rows: dict[str, list[typing.Any]] = {}
+        self.rows_locks: dict[str, asyncio.Lock] = {}
+
+
+    def download_all(self, tasks: list[DownloadTask], check_cancelled: typing.Callable[[], None] = None) -> Throughput:
+        return asyncio.run(self.run(tasks, check_cancelled))
+
+
+    async def run(self, tasks: list[DownloadTask], check_cancelled: typing.Callable[[], None] = None) -> Throughput:
+        """
+        Download every task. `check_cancelled` is called before each download and stops the run by raising,
+        the downloads in flight are cancelled and their part files resumed by the next run.
+        """
+        import aiohttp
+        stats = Throughput(len(tasks))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(connect=config.download_connect_timeout, sock_read=config.download_read_timeout)
+
+        async def run_one(task: DownloadTask) -> None:
+            async with semaphore:
+                if check_cancelled is not None:
+                    check_cancelled()
+                try:
+                    await self.download(task, stats)
+                except Exception as e:
+                    stats.failed += 1
+                    common.log(f"Failed to download {common.md5(task.text)} for {task.char} due to {e}")
+
+        async def reporter() -> None:
+            while True:
+                await asyncio.sleep(config.download_report_interval)
+                common.log(f"Downloading: {stats.report()}")
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers={'User-Agent': user_agent}) as session:
+            self.session = session
+            report = asyncio.ensure_future(reporter())
+            running = [asyncio.ensure_future(run_one(task)) for task in tasks]
+            try:
+                await asyncio.gather(*running)
+            finally:
+                report.cancel()
+                for future in running:
+                    future.cancel()
+                await asyncio.gather(*running, return_exceptions=True)
+                self.session = None
+        common.log(f"Downloaded {stats.report()}")
+        return stats
+
+
+    async def fetch_rows(self, task: DownloadTask) -> list[typing.Any]:
+        """
+        Rows page of a task, from the cache if it was written today, otherwise refreshed from the fallback url.
+        Each page is resolved once per run however many clips it holds.
+        """
+        lock = self.rows_locks.setdefault(task.cache_path, asyncio.Lock())
+        async with lock:
+            if task.cache_path in self.rows:
+                return self.rows[task.cache_path]
+            pth = pathlib.Path(task.cache_path)
+            rows = None
+            if pth.exists() and pth.stat().st_mtime > time.time() - 86400:
+                try:
+                    rows = json.loads(pth.read_text())['rows']
+                except (ValueError, KeyError) as e:
+                    common.log(f"Failed to load cache for {task.char} due to {e}, using fallback url: {task.fallback_url}")
+            if rows is None:
+                async def get() -> str:
+                    async with self.session.get(task.fallback_url) as response:
+                        http_policy.check_status(response.status, response.headers, task.fallback_url)
+                        if response.status != 200:
+                            common.panic(f"{task.fallback_url} answered with status code {response.status}")
+                        return await response.text(encoding='utf-8')
+                content = await http_policy.get_policy().call_async(task.fallback_url, get)
+                tmp = pth.with_name(pth.name + '.tmp')
+                tmp.write_text(content)
+                os.replace(tmp, pth)
+                rows = json.loads(content)['rows']
+            self.rows[task.cache_path] = rows
+            return rows
+
+
+    async def resolve_url(self, task: DownloadTask) -> str | dict[str, str]:
+        if task.fallback_url is None:
+            return task.url
+        rows = await self.fetch_rows(task)
+        url = rows[task.index]['row']['audio'][0]['src']
+        if url == '':
+            common.panic(f"No url in row {task.index} of {task.cache_path}")
+        return url
+
+
+    async def remote_size(self, url: str) -> int | None:
+        """
+        Size of the body at `url` from the `Content-Length` of a HEAD request, None if the server does not tell.
+        """
+        async def head() -> int | None:
+            async with self.session.head(url, allow_redirects=True) as response:
+                http_policy.check_status(response.status, response.headers, url)
+                return response.content_length if response.status == 200 else None
+        return await http_policy.get_policy().call_async(url, head)
+
+
+    async def adopt_untracked(self, out: pathlib.Path, part: pathlib.Path, url: str) -> bool:
+        """
+        Adopt a clip which is not in the ledger, e.g. downloaded before it, if it is whole.
+        A clip shorter than the body on the server is moved back to its part file and resumed.
+
+        Returns:
+            bool: Whether the clip is complete.
+        """
+        # failed downloads used to be saved as the xml error page of the storage
+        if not download_ledger.sniff_audio(out):
+            return False
+        expected_size = await self.remote_size(url)
+        size = out.stat().st_size
+        if expected_size is None or size == expected_size:
+            await asyncio.to_thread(self.ledger.complete, str(out), url, None)
+            return True
+        common.log(f"{out} has {size} of {expected_size} bytes, downloading it again")
+        if size < expected_size:
+            # truncated by an older run, resumed from where it stopped
+            os.replace(out, part)
+            await asyncio.to_thread(self.ledger.start, str(out), url, expected_size, None)
+        return False
+
+
+    async def download(self, task: DownloadTask, stats: Throughput) -> None:
+        out = task.dest()
+        key = str(out)
+        if await asyncio.to_thread(self.ledger.is_complete, key):
+            stats.skipped += 1
+            return
+
+        url = await self.resolve_url(task)
+        if isinstance(url, dict):
+            # already downloaded by the data provider, nothing to compare it with
+            if download_ledger.sniff_audio(out):
+                await asyncio.to_thread(self.ledger.complete, key, None, None)
+                stats.skipped += 1
+                return
+            os.rename(url['path'], key)
+            await asyncio.to_thread(self.ledger.complete, key, None, None)
+            stats.done += 1
+            return
+
+        part = out.with_name(out.name + '.part')
+        # untracked, e.g. downloaded before the ledger, or changed since
+        if out.exists() and await self.adopt_untracked(out, part, url):
+            stats.skipped += 1
+            return
+
+        async def get() -> bool:
+            entry = await asyncio.to_thread(self.ledger.get, key)
+            offset = part.stat().st_size if part.exists() else 0
+            headers = {}
+            # resume only what the server can confirm is the same body, by ETag or else by url and size
+            if offset and entry is not None and not entry.complete and (entry.etag or (entry.url == url and entry.expected_size)):
+                headers['Range'] = f'bytes={offset}-'
+                if entry.etag:
+                    headers['If-Range'] = entry.etag
+
+            async with self.session.get(url, allow_redirects=True, headers=headers) as response:
+                if response.status == 403:
+                    common.log(f"Failed to download {url} for {task.char} with status code {response.status}, skipping it for this time")
+                    return False
+                if response.status == 416:
+                    # the part is not a prefix of the body anymore, start over
+                    part.unlink(missing_ok=True)
+                    raise DownloadError(f"status code {response.status}")
+                http_policy.check_status(response.status, response.headers, url)
+                if response.status not in (200, 206):
+                    common.panic(f"{url} answered with status code {response.status}")
+                expected_size = parse_total_size(response)
+                await asyncio.to_thread(self.ledger.start, key, url, expected_size, response.headers.get('ETag'))
+
+                checksum = hashlib.md5()
+                if response.status == 206:
+                    with open(part, 'rb') as file:
+                        for chunk in iter(lambda: file.read(config.download_chunk_size), b''):
+                            checksum.update(chunk)
+                else:
+                    offset = 0
+                with open(part, 'ab' if response.status == 206 else 'wb') as file:
+                    async for chunk in response.content.iter_chunked(config.download_chunk_size):
+                        file.write(chunk)
+                        checksum.update(chunk)
+                        offset += len(chunk)
+                        stats.bytes += len(chunk)
+
+            # a short body is kept and resumed by the next attempt
+            if expected_size is not None and offset != expected_size:
+                raise DownloadError(f"got {offset} of {expected_size} bytes")
+            if not download_ledger.sniff_audio(part):
+                part.unlink(missing_ok=True)
+                await asyncio.to_thread(self.ledger.forget, key)
+                common.panic(f"{url} for {task.char} is not an audio file")
+            os.replace(part, out)
+            await asyncio.to_thread(self.ledger.complete, key, url, checksum.hexdigest())
+            return True
+
+        if await http_policy.get_policy().call_async(url, get):
+            stats.done += 1
+        else:
+            stats.skipped += 1
@@ -0,0 +1,159 @@
+"""
+Ledger of the downloaded voice clips for AIDub.
+
+Every clip is one row keyed by its destination, recording the url it came from, the
+size and ETag announced by the server, the md5 of the body, and the size and mtime of
+the file once complete. A clip whose file still has the recorded size and mtime is
+done without opening it, so fetching a collection again only stats the files.
+Partial downloads keep their ETag and expected size so they can be resumed with an
+HTTP range request, see `download_engine`.
+"""
+
+import os
+import typing
+import pathlib
+import sqlite3
+import threading
+
+import config
+
+
+class LedgerEntry(typing.NamedTuple):
+    dest: str
+    url: str | None
+    expected_size: int | None
+    etag: str | None
+    checksum: str | None
+    size: int | None
+    mtime_ns: int | None
+    complete: bool
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS clips (
+    dest TEXT PRIMARY KEY,
+    url TEXT,
+    expected_size INTEGER,
+    etag TEXT,
+    checksum TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    complete INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+
+
+# leading bytes of the audio containers the data providers serve
+audio_signatures = [b"ID3", b"OggS", b"RIFF", b"fLaC"]
+
+
+def sniff_audio(path: str | pathlib.Path) -> bool:
+    """
+    Whether a file looks like audio, judging by its first bytes only.
+
+    Args:
+        path (str | pathlib.Path): Path of the file.
+
+    Returns:
+        bool: False for missing, empty or text files, e.g. the xml error page of a storage.
+    """
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(12)
+    except OSError:
+        return False
+    if any(head.startswith(signature) for signature in audio_signatures):
+        return True
+    # raw mpeg frame sync, or an mp4 container
+    return (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0) or head[4:8] == b"ftyp"
+
+
+class DownloadLedger():
+    """
+    Download ledger class. Connections are per thread.
+
+    Attributes:
+        path (pathlib.Path): Path of the database.
+
+    Methods:
+        get(dest: str) -> LedgerEntry | None: The entry of a clip.
+        is_complete(dest: str) -> bool: Whether a clip is complete and its file unchanged since, checking metadata only.
+        start(dest: str, url: str, expected_size: int | None, etag: str | None) -> None: Record a download in progress.
+        complete(dest: str, url: str | None, checksum: str | None) -> None: Record a complete clip with the current size and mtime of its file.
+        forget(dest: str) -> None: Remove the entry of a clip.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = pathlib.Path(path if path is not None else config.download_ledger_dest)
+        self.local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connection() as conn:
+            conn.executescript(schema)
+
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+
+    def get(self, dest: str) -> LedgerEntry | None:
+        row = self.connection().execute("SELECT * FROM clips WHERE dest = ?", (dest,)).fetchone()
+        if row is None:
+            return None
+        return LedgerEntry(*row[:-1], bool(row[-1]))
+
+
+    def is_complete(self, dest: str) -> bool:
+        entry = self.get(dest)
+        if entry is None or not entry.complete:
+            return False
+        try:
+            stat = os.stat(dest)
+        except OSError:
+            return False
+        return stat.st_size == entry.size and stat.st_mtime_ns == entry.mtime_ns
+
+
+    def start(self, dest: str, url: str, expected_size: int | None, etag: str | None) -> None:
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO clips (dest, url, expected_size, etag, complete) VALUES (?, ?, ?, ?, 0)",
+                         (dest, url, expected_size, etag))
+
+
+    def complete(self, dest: str, url: str | None, checksum: str | None) -> None:
+        stat = os.stat(dest)
+        with self.connection() as conn:
+            conn.execute("""
+                INSERT INTO clips (dest, url, checksum, size, mtime_ns, complete) VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (dest) DO UPDATE SET
+                    url = COALESCE(excluded.url, url), checksum = excluded.checksum,
+                    size = excluded.size, mtime_ns = excluded.mtime_ns, complete = 1
+            """, (dest, url, checksum, stat.st_size, stat.st_mtime_ns))
+
+
+    def forget(self, dest: str) -> None:
+        with self.connection() as conn:
+            conn.execute("DELETE FROM clips WHERE dest = ?", (dest,))
+
+
+ledger: DownloadLedger = None
+ledger_lock = threading.Lock()
+
+
+def get_ledger() -> DownloadLedger:
+    """
+    Get the process-wide download ledger, creating the database on first use.
+
+    Returns:
+        DownloadLedger: The download ledger.
+    """
+    global ledger
+    with ledger_lock:
+        if ledger is None:
+            ledger = DownloadLedger()
+        return ledger
@@ -1,46 +1,53 @@
 import emotion
 import GPTSoVits
+import inference_pool
 import common
 import config
 import os
 import json
 import pathlib
+import random
+import re
+import typing
 import requests
+import concurrent.futures
+import dub_cache
+import manifest_store
+import prompt_selection
 
 # models_path = config.models_path
 # muted_characters = config.muted_characters
 
+# language of the dubbed text, part of the dub cache key
+text_language = 'auto'
+
 def serialize_collection(collection: dict[str, list[str]]):
     return json.dumps(collection)
 
 def make_dirs():
     os.makedirs(config.dub_result_dest, exist_ok=True)
 
-def pick_random(collection: dict[str, list[str]], char: str) -> tuple[str, str]:
-    prompt_voice_lbls = [i for i in collection[char].keys()]
-    # pick 1 random key using random lib
-    import random
-    prompt_voice_lbl = random.sample(prompt_voice_lbls, 1)[0]
-    prompt_voice = collection[char][prompt_voice_lbl]
-    while common.check_if_audio_exceeds_10s(prompt_voice['dest']):
-        common.log(f"Audio exceeds 10s, picking another voice for {char}")
-        prompt_voice_lbl, prompt_voice = (random.sample(prompt_voice_lbls, 1)[0], collection[char][prompt_voice_lbl])
-        
-    return prompt_voice_lbl, prompt_voice
+def pick_random(store: manifest_store.ManifestStore, char: str, rng: random.Random = None) -> tuple[str, manifest_store.Sample]:
+    candidate = prompt_selection.get_selector().choose(char, None, rng)
+    if candidate is None:
+        return None, None
+    return candidate.sample.hash_id, candidate.sample
 
 
-def pick_by_emotion(collection: dict[str, list[str]], char: str, text: str) -> tuple[str, str]:
-    d = emotion.choose_a_voice_by_text(char, text)
+def pick_by_emotion(store: manifest_store.ManifestStore, char: str, text: str, rng: random.Random = None) -> tuple[str, manifest_store.Sample]:
+    d = emotion.choose_a_voice_by_text(char, text, rng=rng)
     if d is None:
         common.log(f"No voice found for {char} with text {text}")
         return None, None
     
-    return d['hash_id'], collection[char][d['hash_id']]
+    return d['hash_id'], store.sample(char, d['hash_id'])
 
 
 def generate_prompt_from_voice(char: str, text: str) -> tuple[str, str]:
     """
     Generates a prompt from a voice file and returns the label and text of the prompt.
+    The choice is seeded by the character and the text, so that the same line keeps
+    the same prompt and its dub result can be served from the cache.
 
     Args:
         char (str): The character to generate the prompt for.
@@ -48,85 +55,356 @@ def generate_prompt_from_voice(char: str, text: str) -> tuple[str, str]:
     Returns:
         tuple[str, str]: The text and destination of the prompt.
     """
-    # select prompt voice
-    collection = json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text())
+    # select prompt voice, the selector falls back to any usable voice of the character
+    store = manifest_store.get_store()
+    rng = random.Random(common.md5(f"{char}:{text}"))
     
-    _, voice = pick_by_emotion(collection, char, text)
+    _, voice = pick_by_emotion(store, char, text, rng)
     if voice is None:
-        common.log(f"No voice found for {char} with text {text}, fallback to random voice")
-        _, voice = pick_random(collection, char)
+        common.panic(f"No prompt voice available for {char}")
     
-    return voice['text'], voice['dest']
+    return voice.text, voice.dest
     
     
-def dub_one(text: str, char: str, raw_response: bool = False) -> tuple[str, str] | requests.Response:
-    label = common.md5(text)
-    dest_path = os.path.join(config.dub_result_dest, f"{label}.aac")
-    if os.path.exists(dest_path) and char not in ['Dan Heng']:
+def get_cache_key(text: str, char: str, prompt: tuple[str, str]) -> str:
+    """
+    Get the dub cache key of a line.
+
+    Args:
+        text (str): The text to dub.
+        char (str): The character to dub the text with.
+        prompt (tuple[str, str]): The text and destination of the prompt voice.
+
+    Returns:
+        str: The cache key.
+    """
+    ckpt, pth = get_tts_models(char)
+    return dub_cache.make_key(text, char, ckpt, pth, prompt[1], text_language)
+
+
+def lookup_line(text: str, char: str) -> tuple[tuple[str, str], str, str | None]:
+    """
+    Look a line up in the dub cache, trying the prompt chosen for it last time first,
+    so that a line already dubbed is served without the emotion classifier and the prompt selection.
+
+    Args:
+        text (str): The text to dub.
+        char (str): The character to dub the text with.
+
+    Returns:
+        tuple[tuple[str, str], str, str | None]: The prompt, the cache key and the destination of the cached result, or None on a miss.
+    """
+    cache = dub_cache.get_cache()
+    remembered = cache.prompt_for(char, text)
+    if remembered is not None:
+        key = get_cache_key(text, char, remembered)
+        dest_path = cache.lookup(key)
+        if dest_path is not None:
+            return remembered, key, dest_path
+
+    prompt = generate_prompt_from_voice(char, text)
+    cache.remember_prompt(char, text, prompt)
+    key = get_cache_key(text, char, prompt)
+    if remembered is not None and prompt == remembered:
+        # just missed
+        return prompt, key, cache.claim_legacy(char, text, key)
+    return prompt, key, cache.lookup(key) or cache.claim_legacy(char, text, key)
+
+
+def dub_one(text: str, char: str, raw_response: bool = False, client: GPTSoVits.GPTSoVitsAPI = None, prompt: tuple[str, str] = None) -> tuple[str, str] | requests.Response:
+    """
+    Dub a single line of text, serving it from the dub cache when possible.
+    Long lines are split and synthesized concurrently on the inference pool unless a client is given.
+
+    Args:
+        text (str): The text to dub.
+        char (str): The character to dub the text with.
+        raw_response (bool, optional): Whether to return the streamed response instead of writing it to disk. Cache hits are still returned as a tuple. Only supported with a client, whose backend stays busy until the response is read, use `stream_one` to stream from the inference pool. Defaults to False.
+        client (GPTSoVits.GPTSoVitsAPI, optional): The client to synthesize with. Defaults to a lease on the inference pool for the duration of the call.
+        prompt (tuple[str, str], optional): The text and destination of a pre-selected prompt voice. Defaults to None.
+
+    Returns:
+        tuple[str, str] | requests.Response: The cache key and destination of the dub result, or the raw response.
+    """
+    if raw_response and client is None:
+        # a lease ends with the call, the response would outlive it
+        common.panic("raw_response needs a client, use stream_one() to stream a dub from the inference pool")
+    if prompt is not None:
+        key = get_cache_key(text, char, prompt)
+        dest_path = dub_cache.get_cache().lookup(key) or dub_cache.get_cache().claim_legacy(char, text, key)
+    else:
+        prompt, key, dest_path = lookup_line(text, char)
+    pTexts, pDests = prompt
+    if dest_path is not None:
         common.log(f"Dub already exists for {text} for {char}")
-        return label, dest_path
-    pTexts, pDests = generate_prompt_from_voice(char, text)
+        return key, dest_path
+    if client is None and is_long_text(text):
+        return key, synthesize_long(text, char, (pTexts, pDests), key)
+    if client is None:
+        # request-scoped client, returned to the pool once the result is stored
+        with inference_pool.get_pool().lease(*get_tts_models(char)) as leased:
+            return dub_one(text, char, False, leased, (pTexts, pDests))
     
     if raw_response:
-        resp = GPTSoVitsAPI.tts(pDests, pTexts, text, 'auto', 'auto', True)
+        resp = client.tts(pDests, pTexts, text, 'auto', text_language, True)
     
         if resp.status_code != 200:
             common.panic(f"Error generating dub for {text} for {char}: {resp.text}")
             
         return resp
     else:
-        resp = GPTSoVitsAPI.tts(pDests, pTexts, text, 'auto', 'auto')
-    
-        if resp.status_code != 200:
-            common.panic(f"Error generating dub for {text} for {char}: {resp.text}")
-        
-        pathlib.Path(dest_path).write_bytes(resp.content)
-        return label, dest_path
+        return key, synthesize_one(text, char, (pTexts, pDests), key, client)
+
+
+def synthesize_one(text: str, char: str, prompt: tuple[str, str], key: str, client: GPTSoVits.GPTSoVitsAPI) -> str:
+    """
+    Synthesize a line and store it in the dub cache, without looking it up first.
+
+    Args:
+        text (str): The text to dub.
+        char (str): The character to dub the text with.
+        prompt (tuple[str, str]): The text and destination of the prompt voice.
+        key (str): The cache key of the line.
+        client (GPTSoVits.GPTSoVitsAPI): The client to synthesize with.
+
+    Returns:
+        str: Destination of the dub result.
+    """
+    pTexts, pDests = prompt
+    resp = client.tts(pDests, pTexts, text, 'auto', text_language)
+
+    if resp.status_code != 200:
+        common.panic(f"Error generating dub for {text} for {char}: {resp.text}")
+
+    return dub_cache.get_cache().store(key, resp.content, char, text)
     
     
     
+class LeasedStream():
+    """
+    Iterator over a streamed dub response which returns its inference backend once exhausted or closed.
+    The body is handed to `on_complete` if it was streamed to the end.
+    """
+
+    def __init__(self, resp: requests.Response, release: typing.Callable[[], None], chunk_size: int = 10 * 1024, on_complete: typing.Callable[[bytes], None] = None) -> None:
+        self.resp = resp
+        self.release = release
+        self.on_complete = on_complete
+        self.chunks = resp.iter_content(chunk_size=chunk_size)
+        self.received: list[bytes] = []
+        self.closed = False
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self) -> bytes:
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.close()
+            if self.on_complete is not None:
+                self.on_complete(b''.join(self.received))
+            raise
+        except BaseException:
+            self.close()
+            raise
+        self.received.append(chunk)
+        return chunk
+
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.resp.close()
+            self.release()
+
+
+# sentence and clause ends, latin ones only when followed by a space so that "3.5" stays whole
+sentence_end = re.compile(r'(?<=[.!?;])\s+|(?<=[。！？；…\n])\s*')
+clause_end = re.compile(r'(?<=[,:])\s+|(?<=[，、：])\s*')
+
+
+def split_text(text: str, max_chars: int = None) -> list[str]:
+    """
+    Split a text at sentence boundaries into segments of about `max_chars` characters.
+    Sentences longer than that are split at clause boundaries, never inside a clause.
+
+    Args:
+        text (str): The text to split.
+        max_chars (int, optional): Target length of a segment. Defaults to `config.dub_segment_max_chars`.
+
+    Returns:
+        list[str]: The segments, in order.
+    """
+    max_chars = max_chars if max_chars is not None else config.dub_segment_max_chars
+    pieces = []
+    for sentence in sentence_end.split(text):
+        if len(sentence) > max_chars:
+            pieces.extend(clause_end.split(sentence))
+        else:
+            pieces.append(sentence)
+
+    segments = []
+    current = ''
+    for piece in pieces:
+        if not piece.strip():
+            continue
+        if current and len(current) + len(piece) > max_chars:
+            segments.append(current.strip())
+            current = ''
+        current += piece if not current or current[-1].isspace() or not piece[0].isascii() else ' ' + piece
+    if current.strip():
+        segments.append(current.strip())
+    return segments
+
+
+def is_long_text(text: str) -> bool:
+    return config.dub_long_text_threshold > 0 and len(text) > config.dub_long_text_threshold
+
+
+def synthesize_segment(text: str, char: str, prompt: tuple[str, str], ckpt: str, pth: str) -> bytes:
+    with inference_pool.get_pool().lease(ckpt, pth) as client:
+        resp = client.tts(prompt[1], prompt[0], text, 'auto', text_language)
+        if resp.status_code != 200:
+            common.panic(f"Error generating dub for {text} for {char}: {resp.text}")
+        return resp.content
+
+
+class SegmentedStream():
+    """
+    Iterator over a long line synthesized segment by segment across the inference pool.
+    Segments are synthesized concurrently and yielded in order as soon as each one is ready,
+    the AAC (ADTS) segments are playable once concatenated as is.
+    The body is handed to `on_complete` if every segment was yielded.
+    """
+
+    def __init__(self, segments: list[str], char: str, prompt: tuple[str, str], on_complete: typing.Callable[[bytes], None] = None) -> None:
+        ckpt, pth = get_tts_models(char)
+        pool = inference_pool.get_pool()
+        self.on_complete = on_complete
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(segments), pool.max_inflight * len(pool.backends))))
+        self.futures = [self.executor.submit(synthesize_segment, segment, char, prompt, ckpt, pth) for segment in segments]
+        self.next = 0
+        self.received: list[bytes] = []
+        self.closed = False
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self) -> bytes:
+        if self.closed:
+            raise StopIteration
+        if self.next >= len(self.futures):
+            self.close()
+            if self.on_complete is not None:
+                self.on_complete(b''.join(self.received))
+            raise StopIteration
+        try:
+            chunk = self.futures[self.next].result()
+        except BaseException:
+            self.close()
+            raise
+        self.next += 1
+        self.received.append(chunk)
+        return chunk
+
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+
+
+def synthesize_long(text: str, char: str, prompt: tuple[str, str], key: str) -> str:
+    """
+    Synthesize a long line segment by segment across the inference pool and store it in the dub cache.
+
+    Args:
+        text (str): The text to dub.
+        char (str): The character to dub the text with.
+        prompt (tuple[str, str]): The text and destination of the prompt voice.
+        key (str): The cache key of the line.
+
+    Returns:
+        str: Destination of the dub result.
+    """
+    segments = split_text(text)
+    common.log(f"Dubbing {text} for {char} in {len(segments)} segments")
+    content = b''.join(SegmentedStream(segments, char, prompt))
+    return dub_cache.get_cache().store(key, content, char, text)
+
+
+def stream_one(text: str, char: str, chunk_size: int = 10 * 1024) -> tuple[dict[str, str], typing.Iterable[bytes]]:
+    """
+    Dub a single line of text on a backend of the inference pool and stream the result.
+
+    Args:
+        text (str): The text to dub.
+        char (str): The character to dub the text with.
+        chunk_size (int, optional): Size of the streamed chunks. Defaults to 10 KiB.
+
+    Returns:
+        tuple[dict[str, str], typing.Iterable[bytes]]: The response headers and the streamed body. Close the body to release the backend early.
+    """
+    prompt, key, dest_path = lookup_line(text, char)
+    if dest_path is not None:
+        # already dubbed, serve it from disk without touching a backend
+        common.log(f"Dub already exists for {text} for {char}")
+        content = pathlib.Path(dest_path).read_bytes()
+        return {'Content-Type': 'audio/aac'}, [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+    on_complete = lambda content: dub_cache.get_cache().store(key, content, char, text)
+    if is_long_text(text):
+        # the first sentence is streamed as soon as it is synthesized
+        segments = split_text(text)
+        common.log(f"Dubbing {text} for {char} in {len(segments)} segments")
+        return {'Content-Type': 'audio/aac'}, SegmentedStream(segments, char, prompt, on_complete)
+
+    ckpt, pth = get_tts_models(char)
+    pool = inference_pool.get_pool()
+    backend = pool.acquire(ckpt, pth)
+    release = lambda: pool.release(backend, key=(ckpt, pth))
+    try:
+        resp = backend.client.tts(prompt[1], prompt[0], text, 'auto', text_language, True)
+        if resp.status_code != 200:
+            common.panic(f"Error generating dub for {text} for {char}: {resp.text}")
+    except Exception:
+        release()
+        raise
+
+    # fresh headers, the upstream hop-by-hop ones (Transfer-Encoding, Connection) are rejected by waitress
+    return {'Content-Type': 'audio/aac'}, LeasedStream(resp, release, chunk_size, on_complete)
+
+
 def run_gpt_sovits_api_server():
-    os.system(f"python thirdparty/GPTSoVITs/api_v2.py -a 127.0.0.1 -p 2372 -c templates/tts_infer.yaml")
-    
-GPTSoVitsAPI: GPTSoVits.GPTSoVitsAPI = None
-    
-def setup_gpt_sovits_client(ckpt: str, pth: str):
-    global GPTSoVitsAPI
-    GPTSoVitsAPI = GPTSoVits.GPTSoVitsAPI('http://127.0.0.1:2372', True, ckpt, pth)
-    
+    inference_pool.run_backends()
     
     
 def get_tts_models(char: str,):
     # ckpt, pth
-    print(config.models_path)
     return config.models_path.get(char, common.get_default_model_path()) if char != "Albedo" else common.get_default_model_path()
     
     
     
 def dub_all(use_middleware_logic):
     if use_middleware_logic:
-        config.models_path = common.get_available_model_path()
-        config.models_path = common.get_available_model_path()
-        config.muted_characters = common.get_muted_chars()
-        config.muted_characters = common.get_muted_chars()
+        import dataset_registry
+        dataset_registry.get_registry().apply()
         
     make_dirs()
     emotion.load_analysis_file()
     collection = json.loads(pathlib.Path(config.dub_manifest_dest).read_text())
-    dub_result_manifest = {}
-    for char in collection:
-        ckpt, pth = get_tts_models(char)
-        setup_gpt_sovits_client(ckpt, pth)
-        for text in collection[char]:
-            common.log(f"Dubbing {text} for {char}")
-            label, dest_path = dub_one(text, char)
-            if dub_result_manifest.get(char) is None:
-                dub_result_manifest[char] = {}
-            
-            dub_result_manifest[char][label] = {
-                "dest": dest_path,
-                "text": text,
-                "label": label
-            }
+    # classify every line once up front, prompt selection then hits the text emotion cache
+    for char, lines in collection.items():
+        common.log(f"Classifying {len(lines)} lines of {char}")
+        emotion.classify_texts_batch(lines)
+    import scheduler
+    dub_result_manifest = scheduler.DubScheduler().run(collection)
 
-    pathlib.Path(config.dub_result_manifest_dest).write_text(serialize_collection(dub_result_manifest))
\ No newline at end of file
+    pathlib.Path(config.dub_result_manifest_dest).write_text(serialize_collection(dub_result_manifest))
@@ -0,0 +1,347 @@
+"""
+Content-addressed dub result cache for AIDub.
+
+A dub result is keyed on everything that changes the synthesized audio: the text,
+the character, fingerprints of the GPT and SoVITS weight files, the reference clip
+and the language. Results live in `config.dub_result_dest`, indexed by
+`config.dub_cache_index_dest` and evicted least-recently-used once the cache grows
+over `config.dub_cache_max_bytes`.
+
+The prompt chosen for each line is remembered in the index too, so that a line already
+dubbed is found again without running the emotion classifier and the prompt selection.
+Results of the previous layout, named after the md5 of their text, are adopted as the
+least recently used entries when the old result manifest names their character and text,
+so they count towards the budget and are evicted first. They are keyed on their line until
+the first lookup of the line, which moves them to its real key, see `claim_legacy`.
+"""
+
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import pathlib
+import threading
+import collections
+
+import common
+import config
+
+
+# results written before the cache, named after the md5 of their text
+legacy_name = re.compile(r'^[0-9a-f]{32}\.aac$')
+
+
+def legacy_key(char: str, text: str) -> str:
+    # key of a result of the previous layout until its line is looked up
+    return f"legacy:{common.md5(f'{char}:{text}')}"
+
+
+def fingerprint(path: str) -> str:
+    """
+    Fingerprint a file by its path, size and modification time, without reading it.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: The fingerprint, which changes whenever the file is rewritten.
+    """
+    try:
+        st = os.stat(path)
+        return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+    except OSError:
+        return f"{path}:missing"
+
+
+def make_key(text: str, char: str, ckpt: str, pth: str, ref_audio: str, language: str) -> str:
+    """
+    Make the cache key of a dub result.
+
+    Args:
+        text (str): The dubbed text.
+        char (str): The character.
+        ckpt (str): Path to the GPT checkpoint.
+        pth (str): Path to the SoVITS weights.
+        ref_audio (str): Path to the reference clip.
+        language (str): Language of the text.
+
+    Returns:
+        str: The cache key.
+    """
+    material = json.dumps([text, char, fingerprint(ckpt), fingerprint(pth), fingerprint(ref_audio), language], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class DubCache():
+    """
+    Dub cache class.
+
+    Attributes:
+        root (pathlib.Path): Directory of the cached results.
+        index_path (pathlib.Path): Path of the on-disk index.
+        max_bytes (int): Size budget of the cache.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups not served from the cache.
+        evictions (int): Number of results evicted.
+
+    Methods:
+        path_for(key: str) -> str: Destination path of the result with the given key.
+        lookup(key: str) -> str | None: Destination path of the cached result, or None on a miss.
+        claim_legacy(char: str, text: str, key: str) -> str | None: Move the result of the previous layout for a line to its key.
+        prompt_for(char: str, text: str) -> tuple[str, str] | None: The prompt last chosen for a line.
+        remember_prompt(char: str, text: str, prompt: tuple[str, str]) -> None: Record the prompt chosen for a line.
+        store(key: str, content: bytes, char: str, text: str) -> str: Store a result and return its destination path.
+        save() -> None: Persist the index.
+        stats() -> dict[str, int]: Hit, miss and eviction counters and the cache size.
+    """
+
+    def __init__(self, root: str = None, index_path: str = None, max_bytes: int = None) -> None:
+        self.root = pathlib.Path(root if root is not None else config.dub_result_dest)
+        self.index_path = pathlib.Path(index_path if index_path is not None else config.dub_cache_index_dest)
+        self.max_bytes = max_bytes if max_bytes is not None else config.dub_cache_max_bytes
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # ordered from least to most recently used
+        self.entries: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        # prompt chosen for each line, by md5 of the character and the text
+        self.prompts: dict[str, list[str]] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False
+        self.last_save = 0.0
+        self.load()
+
+
+    def load(self) -> None:
+        if self.index_path.exists():
+            try:
+                index = json.loads(self.index_path.read_text())
+                entries = index['entries']
+                self.prompts = index.get('prompts', {})
+            except (ValueError, KeyError) as e:
+                common.log(f"Dub cache index is corrupted due to {e}, starting over")
+                entries = {}
+            for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_access']):
+                self.entries[key] = entry
+                self.total_bytes += entry['size']
+        self.adopt_legacy()
+
+
+    def legacy_lines(self) -> dict[str, tuple[str, str]]:
+        """
+        Character and text of the results of the previous layout, by md5 of their text, from its result manifest.
+        A text dubbed for several characters shared one file, which is left out as it cannot be told whose it is.
+        """
+        path = pathlib.Path(config.dub_result_manifest_dest)
+        if not path.exists():
+            return {}
+        try:
+            manifest = json.loads(path.read_text())
+        except ValueError as e:
+            common.log(f"Dub result manifest is corrupted due to {e}, not adopting the previous dub results")
+            return {}
+        lines: dict[str, tuple[str, str] | None] = {}
+        for char, results in manifest.items():
+            for label, result in results.items():
+                if label in lines and lines[label] != (char, result['text']):
+                    lines[label] = None
+                else:
+                    lines[label] = (char, result['text'])
+        return {label: line for label, line in lines.items() if line is not None}
+
+
+    def adopt_legacy(self) -> None:
+        """
+        Index the results of the previous layout as the least recently used entries, then evict over budget.
+        Results the old result manifest does not name cannot be matched to a line and are left alone.
+        """
+        if not self.root.is_dir():
+            return
+        known = {entry['dest'] for entry in self.entries.values()}
+        lines = None
+        legacy = []
+        for file in os.scandir(self.root):
+            if legacy_name.match(file.name) and file.path not in known:
+                lines = lines if lines is not None else self.legacy_lines()
+                line = lines.get(file.name[:-4])
+                if line is None:
+                    continue
+                char, text = line
+                st = file.stat()
+                legacy.append((legacy_key(char, text), {'dest': file.path, 'size': st.st_size, 'last_access': st.st_mtime, 'char': char, 'text': text}))
+        if not legacy:
+            return
+        common.log(f"Adopting {len(legacy)} dub results of the previous layout into the dub cache")
+        with self.lock:
+            for key, entry in sorted(legacy, key=lambda item: item[1]['last_access'], reverse=True):
+                self.entries[key] = entry
+                self.entries.move_to_end(key, last=False)
+                self.total_bytes += entry['size']
+            evicted = self.evict()
+            self.dirty = True
+        self.remove(evicted)
+        self.save()
+
+
+    def evict(self) -> list[str]:
+        # called with the lock held, returns the files to remove once it is released
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old = self.entries.popitem(last=False)
+            self.total_bytes -= old['size']
+            self.evictions += 1
+            evicted.append(old['dest'])
+        return evicted
+
+
+    def remove(self, paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def save(self) -> None:
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = json.dumps({'entries': self.entries, 'prompts': self.prompts}, ensure_ascii=False)
+                self.dirty = False
+                self.last_save = time.time()
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_path.with_suffix('.tmp')
+            tmp.write_text(data)
+            os.replace(tmp, self.index_path)
+
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(str(self.root), f"{key}.aac")
+
+
+    def lookup(self, key: str) -> str | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not os.path.exists(entry['dest']):
+                # removed behind our back
+                self.total_bytes -= entry['size']
+                del self.entries[key]
+                self.dirty = True
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['last_access'] = time.time()
+            self.entries.move_to_end(key)
+            self.dirty = True
+            return entry['dest']
+
+
+    def claim_legacy(self, char: str, text: str, key: str) -> str | None:
+        """
+        Move the result of the previous layout for a line, if any, to the key the line was just looked up with.
+        Called after a missed lookup, a claimed result counts as a hit instead.
+
+        Args:
+            char (str): The character.
+            text (str): The text of the line.
+            key (str): The cache key of the line.
+
+        Returns:
+            str | None: Destination of the result, or None if there is none.
+        """
+        with self.lock:
+            entry = self.entries.pop(legacy_key(char, text), None)
+            if entry is None:
+                return None
+            self.dirty = True
+            dest = self.path_for(key)
+            try:
+                os.replace(entry['dest'], dest)
+            except OSError:
+                # removed behind our back
+                self.total_bytes -= entry['size']
+                return None
+            self.entries[key] = {**entry, 'dest': dest, 'last_access': time.time()}
+            self.hits += 1
+            self.misses -= 1
+            return dest
+
+
+    def prompt_for(self, char: str, text: str) -> tuple[str, str] | None:
+        with self.lock:
+            prompt = self.prompts.get(common.md5(f"{char}:{text}"))
+        return tuple(prompt) if prompt is not None else None
+
+
+    def remember_prompt(self, char: str, text: str, prompt: tuple[str, str]) -> None:
+        line = common.md5(f"{char}:{text}")
+        with self.lock:
+            if self.prompts.get(line) != list(prompt):
+                self.prompts[line] = list(prompt)
+                self.dirty = True
+
+
+    def store(self, key: str, content: bytes, char: str, text: str) -> str:
+        dest = self.path_for(key)
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(f"{dest}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(content)
+        os.replace(tmp, dest)
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous['size']
+            self.entries[key] = {
+                'dest': dest,
+                'size': len(content),
+                'last_access': time.time(),
+                'char': char,
+                'text': text
+            }
+            self.total_bytes += len(content)
+            evicted = self.evict()
+            self.dirty = True
+            should_save = time.time() - self.last_save > config.dub_cache_save_interval
+
+        self.remove(evicted)
+        if should_save:
+            self.save()
+        return dest
+
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+            }
+
+
+cache: DubCache = None
+cache_lock = threading.Lock()
+
+
+def get_cache() -> DubCache:
+    """
+    Get the process-wide dub cache, loading its index on first use.
+
+    Returns:
+        DubCache: The dub cache.
+    """
+    global cache
+    with cache_lock:
+        if cache is None:
+            cache = DubCache()
+            atexit.register(cache.save)
+        return cache
@@ -1,31 +1,52 @@
+import os
 import pathlib
 import json
 import config
 import common
-from transformers import pipeline
-import torch
+import manifest_store
+import model_registry
+import analysis_store
 import random
-import thirdparty.speechbrainModel
+import time
+import typing
+import atexit
+import threading
+import collections
+import concurrent.futures
 
-# Load the BERT-Emotions-Classifier
-use_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+# torch and transformers are only imported once a classifier is needed, see model_registry
 classifier = None
 audio_classifier = None
+text_model_name = "michellejieli/emotion_text_classifier"
+audio_model_name = "firdhokk/speech-emotion-recognition-with-openai-whisper-large-v3"
+
+
+def build_text_classifier():
+    import emotion_backends
+    return emotion_backends.build_pipeline("text-classification", text_model_name)
+
+
+def build_audio_classifier():
+    import emotion_backends
+    return emotion_backends.build_pipeline("audio-classification", audio_model_name)
+
+
+model_registry.get_registry().register("text_emotion", build_text_classifier)
+model_registry.get_registry().register("audio_emotion", build_audio_classifier)
 
 
-analysis_file = {}
 
 
 def load_bert_classifier():
     global classifier
     if classifier is None:
-        classifier = pipeline("text-classification", model="michellejieli/emotion_text_classifier", device=use_device)
+        classifier = model_registry.get_registry().get("text_emotion")
 
 
 def load_audio_classifier():
     global audio_classifier
     if audio_classifier is None:
-        audio_classifier = pipeline("audio-classification", model="firdhokk/speech-emotion-recognition-with-openai-whisper-large-v3", device=use_device)
+        audio_classifier = model_registry.get_registry().get("audio_emotion")
 
 def audio_classifier_mapping(results_audio: list[dict], results_text: list[dict]) -> tuple[str, float]:
     #  happy angry neutral disgust fearful surprised calm to joy anger neutral disgust fear surprise and neutral.
@@ -46,10 +67,138 @@ def audio_classifier_mapping(results_audio: list[dict], results_text: list[dict]
         return mapping[results_audio[0]['label']][0], results_audio[0]['score']
         
 
+class TextEmotionCache():
+    """
+    Bounded LRU of text classifier results, optionally persisted to disk.
+
+    Methods:
+        get(text: str) -> tuple[str, float] | None: The cached label and score of a text.
+        put(text: str, result: tuple[str, float]) -> None: Cache the label and score of a text.
+        save() -> None: Persist the cache.
+    """
+
+    def __init__(self, max_entries: int = None, path: str = None) -> None:
+        self.max_entries = max_entries if max_entries is not None else config.emotion_text_cache_size
+        path = path if path is not None else config.emotion_text_cache_dest
+        self.path = pathlib.Path(path) if path is not None else None
+        self.lock = threading.Lock()
+        # ordered from least to most recently used
+        self.entries: collections.OrderedDict[str, tuple[str, float]] = collections.OrderedDict()
+        self.dirty = False
+        if self.path is not None and self.path.exists():
+            try:
+                for text, (label, score) in json.loads(self.path.read_text()):
+                    self.entries[text] = (label, score)
+            except (ValueError, TypeError) as e:
+                common.log(f"Text emotion cache is corrupted due to {e}, starting over")
+
+
+    def get(self, text: str) -> tuple[str, float] | None:
+        with self.lock:
+            result = self.entries.get(text)
+            if result is not None:
+                self.entries.move_to_end(text)
+            return result
+
+
+    def put(self, text: str, result: tuple[str, float]) -> None:
+        with self.lock:
+            self.entries[text] = result
+            self.entries.move_to_end(text)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps([[text, list(result)] for text, result in self.entries.items()], ensure_ascii=False)
+            self.dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(data)
+        os.replace(tmp, self.path)
+
+
+text_cache: TextEmotionCache = None
+text_cache_lock = threading.Lock()
+
+
+def get_text_cache() -> TextEmotionCache:
+    """
+    Get the process-wide text emotion cache, loading it on first use.
+
+    Returns:
+        TextEmotionCache: The text emotion cache.
+    """
+    global text_cache
+    with text_cache_lock:
+        if text_cache is None:
+            text_cache = TextEmotionCache()
+            atexit.register(text_cache.save)
+        return text_cache
+
+
+def classify_texts_batch(texts: list[str], batch_size: int = None) -> list[tuple[str, float]]:
+    """
+    Classify the emotion of many texts, running the classifier once per unique uncached text, in batches.
+
+    Args:
+        texts (list[str]): The texts to classify.
+        batch_size (int, optional): Number of texts per forward pass. Defaults to `config.emotion_batch_size`.
+
+    Returns:
+        list[tuple[str, float]]: The label and score of every text, in order.
+    """
+    batch_size = batch_size if batch_size is not None else config.emotion_batch_size
+    cache = get_text_cache()
+    # the cache is bounded, results are kept here so that evictions during the call lose nothing
+    results: dict[str, tuple[str, float]] = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        cached = cache.get(text)
+        if cached is None:
+            missing.append(text)
+        else:
+            results[text] = cached
+    if missing:
+        load_bert_classifier()
+        start = time.time()
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            for text, output in zip(batch, classifier(batch, batch_size=len(batch), top_k=1)):
+                results[text] = (output[0]['label'], output[0]['score'])
+                cache.put(text, results[text])
+        common.log(f"Classified {len(missing)} texts in {time.time() - start:.2f}s")
+        cache.save()
+    return [results[text] for text in texts]
+
+
+def classify_text(text: str) -> tuple[str, float]:
+    """
+    Classify the emotion of a text, served from the text emotion cache when possible.
+
+    Args:
+        text (str): The text to classify.
+
+    Returns:
+        tuple[str, float]: The label and score.
+    """
+    result = get_text_cache().get(text)
+    if result is None:
+        load_bert_classifier()
+        results = classifier(text)
+        result = (results[0]['label'], results[0]['score'])
+        get_text_cache().put(text, result)
+    return result
+
+
 def classify_emotion(text) -> str:
-    load_bert_classifier()
-    results = classifier(text)
-    return results[0]['label']
+    return classify_text(text)[0]
 
 
 def classify_audio_emotion(audio_path: str) -> str:
@@ -57,109 +206,337 @@ def classify_audio_emotion(audio_path: str) -> str:
     results = audio_classifier(audio_path)
     return results[0]['label']
 
-def load_analysis_file():
-    if not pathlib.Path(config.sentiment_analysis_dest).exists():
-        initialize_analysis_file()
-    global analysis_file
-    analysis_file = json.loads(pathlib.Path(
-        config.sentiment_analysis_dest).read_text())
-    return analysis_file
+def load_analysis_file() -> analysis_store.AnalysisStore:
+    """
+    Open the analysis store, importing a legacy `sentiment_analysis.json` on first use.
+    Nothing is loaded, so this is cheap enough for every request.
+
+    Returns:
+        analysis_store.AnalysisStore: The analysis store.
+    """
+    return analysis_store.get_store()
 
 
 def initialize_analysis_file():
-    file_struct = {}
-    dataset = json.loads(pathlib.Path(
-        config.dataset_manifest_file_dest).read_text())
-    for char in dataset:
-        common.log(f"Initializing analysis file for {char}")
-        file_struct[char] = {
-            # anger	disgust	fear	joy	neutral	sadness	surprise
-            "anger": [],
-            "disgust": [],
-            "fear": [],
-            "joy": [],
-            "neutral": [],
-            "sadness": [],
-            "surprise": []
-        }
-    pathlib.Path(config.sentiment_analysis_dest).write_text(
-        json.dumps(file_struct))
-    global analysis_file
-    analysis_file = file_struct
-
-def save_analysis_file():
-    pathlib.Path(config.sentiment_analysis_dest).write_text(
-        json.dumps(analysis_file))
-
-
-def do_batch_classification(char):
+    common.log(f"Clearing the sentiment analysis")
+    analysis_store.get_store().clear()
+
+
+def sample_fingerprint(sample: manifest_store.Sample) -> str:
+    """
+    Fingerprint a sample by its audio file and text, the inputs of the classifiers.
+
+    Args:
+        sample (manifest_store.Sample): The sample.
+
+    Returns:
+        str: The fingerprint, which changes whenever the clip is rewritten or its text edited.
+    """
+    try:
+        st = os.stat(sample.dest)
+        return f"{st.st_size}:{st.st_mtime_ns}:{common.md5(sample.text)}"
+    except OSError:
+        return f"missing:{common.md5(sample.text)}"
+
+
+def diff_analysis(char: str, samples: list[manifest_store.Sample]) -> tuple[list[manifest_store.Sample], int]:
+    """
+    Drop the analysis entries of a character whose sample was removed or changed, and find the samples to classify.
+    Entries written before fingerprints were recorded are adopted as long as their sample still exists.
+
+    Args:
+        char (str): The character.
+        samples (list[manifest_store.Sample]): The samples of the character in the dataset manifest.
+
+    Returns:
+        tuple[list[manifest_store.Sample], int]: The samples to classify and the number of entries dropped.
+    """
+    store = analysis_store.get_store()
+    fingerprints = {sample.hash_id: sample_fingerprint(sample) for sample in samples}
+    stale = []
+    adopted = {}
+    kept = set()
+    for hash_id, recorded in store.fingerprints(char).items():
+        fingerprint = fingerprints.get(hash_id)
+        if fingerprint is None or (recorded is not None and recorded != fingerprint):
+            stale.append(hash_id)
+            continue
+        if recorded is None:
+            adopted[hash_id] = fingerprint
+        kept.add(hash_id)
+    store.remove(char, stale)
+    store.set_fingerprints(char, adopted)
+    return [sample for sample in samples if sample.hash_id not in kept], len(stale)
+
+
+def load_audio(path: str) -> dict[str, typing.Any]:
+    """
+    Decode an audio file to mono at the sample rate of the audio classifier.
+
+    Args:
+        path (str): Path of the audio file.
+
+    Returns:
+        dict[str, typing.Any]: The audio, in the input format of the audio classification pipeline.
+    """
+    import librosa
+    audio, sample_rate = librosa.load(path, sr=config.emotion_sample_rate, mono=True)
+    return {"raw": audio, "sampling_rate": sample_rate}
+
+
+def iter_batches(samples: list[manifest_store.Sample], batch_size: int, workers: int) -> typing.Iterator[list[tuple[manifest_store.Sample, dict[str, typing.Any]]]]:
+    """
+    Decode samples in a background loader pool and yield them in batches, keeping a couple of batches decoded ahead.
+    Samples which fail to decode are logged and left out.
+
+    Args:
+        samples (list[manifest_store.Sample]): The samples to decode.
+        batch_size (int): Number of samples per batch.
+        workers (int): Number of loader threads.
+
+    Yields:
+        list[tuple[manifest_store.Sample, dict[str, typing.Any]]]: Batches of samples with their decoded audio.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: collections.deque[tuple[manifest_store.Sample, concurrent.futures.Future]] = collections.deque()
+        remaining = iter(samples)
+        batch = []
+        while True:
+            while len(pending) < batch_size * 2:
+                sample = next(remaining, None)
+                if sample is None:
+                    break
+                pending.append((sample, executor.submit(load_audio, sample.dest)))
+            if not pending:
+                break
+            sample, future = pending.popleft()
+            try:
+                batch.append((sample, future.result()))
+            except Exception as e:
+                common.log(f"Error decoding {sample.hash_id} for {sample.char}: {e}, ignoring")
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def classify_batch(batch: list[tuple[manifest_store.Sample, dict[str, typing.Any]]]) -> list[tuple[str, float]]:
+    """
+    Classify a batch of samples with one forward pass of each classifier.
+
+    Args:
+        batch (list[tuple[manifest_store.Sample, dict[str, typing.Any]]]): Samples with their decoded audio.
+
+    Returns:
+        list[tuple[str, float]]: The label and score of every sample.
+    """
+    results_audio = audio_classifier([audio for _, audio in batch], batch_size=len(batch))
+    results_text = classifier([sample.text for sample, _ in batch], batch_size=len(batch), top_k=1)
+    return [audio_classifier_mapping(a, t) for a, t in zip(results_audio, results_text)]
+
+
+def do_batch_classification(char, batch_size: int = None, samples: list[manifest_store.Sample] = None, check_cancelled: typing.Callable[[], None] = None):
+    samples = samples if samples is not None else manifest_store.get_store().samples(char)
+    if not samples:
+        common.log(f"No sample of {char} to classify")
+        return
+    store = analysis_store.get_store()
     load_audio_classifier()
     load_bert_classifier()
-    dataset = json.loads(pathlib.Path(
-        config.dataset_manifest_file_dest).read_text())
-    if char not in dataset:
-        common.log(f"Character {char} not found in dataset")
-        return
-    for hash_id in dataset[char]:
+    batch_size = batch_size if batch_size is not None else config.emotion_batch_size
+    start = time.time()
+    classified = 0
+    for batch in iter_batches(samples, batch_size, config.emotion_loader_workers):
+        if check_cancelled is not None:
+            check_cancelled()
+        batch_start = time.time()
         try:
-            x = dataset[char][hash_id]
-            text = x
-            audio_emotion = audio_classifier(text["dest"])
-            text_emotion = classifier(text["text"])
-            label, score = audio_classifier_mapping(audio_emotion, text_emotion)
-            
-            analysis_file[char][label].append({
-                "text": text['text'],
-                "hash_id": hash_id,
-                "score": score,
-                "dest": x["dest"]
-            })
+            results = classify_batch(batch)
         except RuntimeError as e:
-            common.log(f"Error processing {hash_id} for {char}: {e}, ignoring")
+            # isolate the faulty samples
+            common.log(f"Error processing a batch of {char}: {e}, retrying one by one")
+            results = []
+            for item in batch:
+                try:
+                    results.extend(classify_batch([item]))
+                except RuntimeError as e:
+                    common.log(f"Error processing {item[0].hash_id} for {char}: {e}, ignoring")
+                    results.append(None)
+
+        # committed batch by batch, an interrupted run resumes after the last committed batch
+        entries = []
+        for (sample, _), result in zip(batch, results):
+            if result is None:
+                continue
+            label, score = result
+            entries.append(analysis_store.AnalysisEntry(char, sample.hash_id, label, score, sample.text, sample.dest, sample_fingerprint(sample)))
+        store.add(entries)
+        classified += len(entries)
+        elapsed = time.time() - batch_start
+        common.log(f"Classified a batch of {len(batch)} samples of {char} in {elapsed:.2f}s ({len(batch) / max(elapsed, 1e-6):.2f} samples/s)")
         
-    common.log(f"Classification of {char} complete")
+    elapsed = time.time() - start
+    common.log(f"Classification of {char} complete, {classified} of {len(samples)} samples in {elapsed:.2f}s")
     
 
-def choose_a_voice_by_text(char: str, text: str, randomed: bool = True) -> dict[str, str] | None:
+def choose_a_voice_by_text(char: str, text: str, randomed: bool = True, rng: random.Random = None) -> dict[str, str] | None:
     """
     Chooses a most representative voice for the given text based on the sentiment analysis file.
 
     Args:
         char (str): The character to dub
         text (str): The text to analyze
+        randomed (bool, optional): Draw weighted by score instead of taking the best scored voice. Defaults to True.
+        rng (random.Random, optional): The random generator to choose with. Defaults to a fresh one.
 
     Returns:
         dict[str, str] | None: A dictionary containing the hash_id, text, score, and destination of the most representative voice for the given text. If no suitable voice is found, returns None.
     """
-    load_bert_classifier()
-    result = classifier(text)[0]
-    label = result['label']
+    label, _ = classify_text(text)
+
+    import prompt_selection
+    selector = prompt_selection.get_selector()
+    if randomed:
+        candidate = selector.choose(char, label, rng)
+    else:
+        best = selector.top(char, label, 1)
+        candidate = best[0] if best else None
+    if candidate is None:
+        return None
+    return {
+        "hash_id": candidate.sample.hash_id,
+        "text": candidate.sample.text,
+        "score": candidate.score,
+        "dest": candidate.sample.dest
+    }
     
-    # rank the analysises by score
-    ranked_analysis = sorted(analysis_file[char][label], key=lambda x: x['score'], reverse=True)
-    def resolver(ranked_analysis):
-        result = []
-        for analysis in ranked_analysis:
+# set by the parent to stop the worker processes, see `classify_in_processes`
+worker_stop = None
+
+
+def init_worker(stop: typing.Any, logs: typing.Any) -> None:
+    global worker_stop
+    worker_stop = stop
+    if logs is not None:
+        # the logs of the worker go back to the log listener of the parent
+        common.log_listener.callback = logs.put
+
+
+def check_worker_stop() -> None:
+    if worker_stop is not None and worker_stop.is_set():
+        common.panic("Classification was cancelled")
+
+
+def classify_shard(char: str, samples: list[manifest_store.Sample], threads: int) -> int:
+    """
+    Classify a shard of the samples of a character in a worker process, results go straight to the analysis store.
+
+    Args:
+        char (str): The character.
+        samples (list[manifest_store.Sample]): The samples of the shard.
+        threads (int): Cpu threads budget of the worker.
+
+    Returns:
+        int: Number of samples of the shard.
+    """
+    import torch
+    torch.set_num_threads(threads)
+    do_batch_classification(char, samples=samples, check_cancelled=check_worker_stop)
+    return len(samples)
+
+
+def classify_in_processes(pending: dict[str, list[manifest_store.Sample]], workers: int, check_cancelled: typing.Callable[[], None] = None) -> None:
+    """
+    Shard the pending samples across worker processes, each committing its results to the analysis store.
+
+    Args:
+        pending (dict[str, list[manifest_store.Sample]]): The samples to classify, by character.
+        workers (int): Number of worker processes.
+        check_cancelled (typing.Callable[[], None], optional): Called while the shards run, stops the classification by raising.
+            The queued shards are dropped and the running ones stop after their current batch. Defaults to None.
+    """
+    import queue
+    import multiprocessing
+    threads = config.emotion_threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    shards = []
+    for char, samples in pending.items():
+        for i in range(0, len(samples), config.emotion_shard_size):
+            shards.append((char, samples[i:i + config.emotion_shard_size]))
+    # largest shards first, so that the workers stay busy until the end
+    shards.sort(key=lambda shard: len(shard[1]), reverse=True)
+    common.log(f"Classifying {len(shards)} shards across {workers} processes with {threads} threads each")
+
+    # spawned, the parent may hold cuda or loader threads which do not survive a fork
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    listener = getattr(common.log_listener, 'callback', None)
+    logs = context.Queue() if listener is not None else None
+
+    def forward_logs() -> None:
+        while logs is not None:
             try:
-                if not common.check_if_audio_exceeds_10s(analysis['dest']):
-                    result.append(analysis)
-            except Exception as e:
-                common.log(f"Error processing {analysis['hash_id']}: {e}, ignoring")
-        return result
-    
-    ranked_analysis = common.cached_data(f"ranked_analysis_{char}_{label}", lambda: resolver(ranked_analysis))
-    return random.choice(ranked_analysis) if len(ranked_analysis) > 0 else None
+                listener(logs.get_nowait())
+            except queue.Empty:
+                return
 
-    
-def do_classification():
+    poll = 1 if check_cancelled is not None or logs is not None else None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(stop, logs)) as executor:
+        futures = {executor.submit(classify_shard, char, samples, threads): char for char, samples in shards}
+        running = set(futures)
+        try:
+            while running:
+                done, running = concurrent.futures.wait(running, timeout=poll, return_when=concurrent.futures.FIRST_COMPLETED)
+                forward_logs()
+                for future in done:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # the batches it committed are kept, the next run classifies the rest
+                        common.log(f"Classification worker of {futures[future]} failed due to {e}, ignoring")
+                if check_cancelled is not None:
+                    check_cancelled()
+        except BaseException:
+            stop.set()
+            for future in running:
+                future.cancel()
+            raise
+    forward_logs()
+
+
+def do_classification(full: bool = False, workers: int = None, check_cancelled: typing.Callable[[], None] = None):
     """
     Do the sentiment analysis on all the characters in the dataset.
+    Only new or changed samples are classified, entries of removed samples are dropped.
+    Results are committed batch by batch, an interrupted run resumes where it stopped.
+
+    Args:
+        full (bool, optional): Start over and classify every sample. Defaults to False.
+        workers (int, optional): Number of worker processes. Defaults to `config.emotion_workers`.
+        check_cancelled (typing.Callable[[], None], optional): Called between batches, stops the classification by raising. Defaults to None.
     """
-    initialize_analysis_file()
-    dataset = json.loads(pathlib.Path(
-        config.dataset_manifest_file_dest).read_text())
-    common.log(f"Starting classification of {len(dataset)} characters")
+    workers = workers if workers is not None else config.emotion_workers
+    store = load_analysis_file()
+    if full:
+        initialize_analysis_file()
+    dataset = manifest_store.get_store().characters()
+    for char in store.characters():
+        if char not in dataset:
+            common.log(f"Dropping analysis of {char}, not in dataset anymore")
+            store.remove(char)
+
+    pending = {}
     for char in dataset:
-        do_batch_classification(char)
-    common.log(f"Classification of all characters complete")
-    save_analysis_file()
\ No newline at end of file
+        samples = manifest_store.get_store().samples(char)
+        pending[char], dropped = diff_analysis(char, samples)
+        if pending[char] or dropped:
+            common.log(f"{char}: {len(pending[char])} of {len(samples)} samples to classify, {dropped} stale entries dropped")
+    common.log(f"Starting classification of {sum(len(i) for i in pending.values())} samples of {len(dataset)} characters")
+    pending = {char: samples for char, samples in pending.items() if samples}
+    if workers > 1 and pending:
+        classify_in_processes(pending, workers, check_cancelled)
+    else:
+        for char, samples in pending.items():
+            do_batch_classification(char, samples=samples, check_cancelled=check_cancelled)
+    store.export_json(config.sentiment_analysis_dest)
+    common.log(f"Classification of all characters complete, {store.count()} samples classified")
@@ -0,0 +1,184 @@
+"""
+Inference backends of the emotion classifiers for AIDub.
+
+- "torch": the reference transformers pipelines, on the gpu if there is one.
+- "int8": the same pipelines with their linear layers dynamically quantized to int8, cpu only.
+- "onnx": the models exported to ONNX and run by onnxruntime, requires `optimum[onnxruntime]`.
+- "onnx-int8": the ONNX export dynamically quantized to int8.
+
+ONNX exports are cached in `config.emotion_onnx_dest`. Use `verify()` to check that a
+backend agrees with the reference pipelines on a sample of the dataset before switching
+`config.emotion_backend` to it. Each backend is measured in a fresh process, so that the
+memory it reports is its own and not left over from the other one.
+"""
+
+import os
+import time
+import random
+import typing
+import pathlib
+import multiprocessing
+import concurrent.futures
+
+import common
+import config
+import manifest_store
+import model_registry
+
+
+backends = ["torch", "int8", "onnx", "onnx-int8"]
+
+
+def current_rss() -> int | None:
+    """
+    Resident set size of the process in bytes, None where /proc is not available.
+    """
+    try:
+        pages = int(pathlib.Path('/proc/self/statm').read_text().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def export_onnx(task: str, model_name: str, quantize: bool) -> str:
+    """
+    Export a model to ONNX once, optionally quantized to int8, and return the directory of the export.
+
+    Args:
+        task (str): The pipeline task, "text-classification" or "audio-classification".
+        model_name (str): Name of the model on the hub.
+        quantize (bool): Whether to quantize the export.
+
+    Returns:
+        str: Directory of the export.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTModelForAudioClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    except ImportError:
+        common.panic("ONNX emotion backends require optimum[onnxruntime], install it with `pip install optimum[onnxruntime]`")
+
+    model_class = ORTModelForSequenceClassification if task == "text-classification" else ORTModelForAudioClassification
+    dest = pathlib.Path(config.emotion_onnx_dest) / common.md5(model_name)
+    if not (dest / "model.onnx").exists():
+        common.log(f"Exporting {model_name} to ONNX")
+        model_class.from_pretrained(model_name, export=True).save_pretrained(dest)
+    if not quantize:
+        return str(dest)
+
+    quantized = dest / "int8"
+    if not (quantized / "model_quantized.onnx").exists():
+        common.log(f"Quantizing the ONNX export of {model_name} to int8")
+        quantizer = ORTQuantizer.from_pretrained(str(dest))
+        quantizer.quantize(save_dir=quantized, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=True))
+    return str(quantized)
+
+
+def build_pipeline(task: str, model_name: str, backend: str = None) -> typing.Any:
+    """
+    Build a classification pipeline on the given backend.
+
+    Args:
+        task (str): The pipeline task, "text-classification" or "audio-classification".
+        model_name (str): Name of the model on the hub.
+        backend (str, optional): One of `backends`. Defaults to `config.emotion_backend`.
+
+    Returns:
+        typing.Any: The pipeline.
+    """
+    backend = backend if backend is not None else config.emotion_backend
+    if backend not in backends:
+        common.panic(f"Unknown emotion backend {backend}, expected one of {backends}")
+
+    from transformers import pipeline
+    if backend == "torch":
+        return pipeline(task, model=model_name, device=model_registry.get_device())
+
+    if backend == "int8":
+        import torch
+        pipe = pipeline(task, model=model_name, device='cpu')
+        pipe.model = torch.quantization.quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8)
+        return pipe
+
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTModelForAudioClassification
+    model_class = ORTModelForSequenceClassification if task == "text-classification" else ORTModelForAudioClassification
+    quantize = backend == "onnx-int8"
+    model = model_class.from_pretrained(export_onnx(task, model_name, quantize), file_name="model_quantized.onnx" if quantize else "model.onnx")
+    if task == "text-classification":
+        return pipeline(task, model=model, tokenizer=model_name)
+    return pipeline(task, model=model, feature_extractor=model_name)
+
+
+def measure(task: str, model_name: str, backend: str, inputs: list[typing.Any]) -> tuple[list[str], dict[str, typing.Any]]:
+    # rss grown from a fresh process, which includes importing the backend libraries
+    rss = current_rss()
+    start = time.time()
+    pipe = build_pipeline(task, model_name, backend)
+    load_seconds = time.time() - start
+    rss_after = current_rss()
+
+    start = time.time()
+    labels = []
+    for i in range(0, len(inputs), config.emotion_batch_size):
+        batch = inputs[i:i + config.emotion_batch_size]
+        labels.extend(r[0]['label'] for r in pipe(batch, batch_size=len(batch), top_k=1))
+    elapsed = time.time() - start
+    return labels, {
+        "load_seconds": load_seconds,
+        "samples_per_second": len(inputs) / max(elapsed, 1e-6),
+        "rss_bytes": rss_after - rss if rss is not None and rss_after is not None else None,
+    }
+
+
+def measure_in_process(task: str, model_name: str, backend: str, inputs: list[typing.Any]) -> tuple[list[str], dict[str, typing.Any]]:
+    """
+    Run `measure` in a fresh spawned process, so that nothing loaded before skews its memory.
+    """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(measure, task, model_name, backend, inputs).result()
+
+
+def verify(backend: str, sample_size: int = None) -> dict[str, dict[str, typing.Any]]:
+    """
+    Check the label agreement, throughput and memory of a backend against the reference pipelines on a sample of the dataset.
+
+    Args:
+        backend (str): The backend to verify.
+        sample_size (int, optional): Number of dataset samples to compare on. Defaults to `config.emotion_verify_samples`.
+
+    Returns:
+        dict[str, dict[str, typing.Any]]: For each classifier, the agreement and the measurements of both backends.
+    """
+    import emotion
+    sample_size = sample_size if sample_size is not None else config.emotion_verify_samples
+    store = manifest_store.get_store()
+    samples = [s for char in store.characters() for s in store.samples(char)]
+    samples = random.Random(0).sample(samples, min(sample_size, len(samples)))
+    if not samples:
+        common.panic("No dataset sample to verify the emotion backend with")
+
+    audios = []
+    texts = []
+    for sample in samples:
+        try:
+            audios.append(emotion.load_audio(sample.dest))
+            texts.append(sample.text)
+        except Exception as e:
+            common.log(f"Error decoding {sample.hash_id} for {sample.char}: {e}, ignoring")
+
+    report = {}
+    for name, task, model_name, inputs in [
+        ("text_emotion", "text-classification", emotion.text_model_name, texts),
+        ("audio_emotion", "audio-classification", emotion.audio_model_name, audios),
+    ]:
+        reference_labels, reference = measure_in_process(task, model_name, "torch", inputs)
+        labels, candidate = measure_in_process(task, model_name, backend, inputs)
+        agreement = sum(a == b for a, b in zip(reference_labels, labels)) / max(len(inputs), 1)
+        report[name] = {"agreement": agreement, "torch": reference, backend: candidate}
+        common.log(f"{name} on {backend}: {agreement:.2%} label agreement over {len(inputs)} samples, "
+                   f"{candidate['samples_per_second']:.2f} samples/s against {reference['samples_per_second']:.2f}, "
+                   f"rss {candidate['rss_bytes']} bytes against {reference['rss_bytes']}")
+        if agreement < config.emotion_min_agreement:
+            common.log(f"{name} on {backend} is below the {config.emotion_min_agreement:.2%} agreement threshold, do not use it")
+    return report
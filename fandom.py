@@ -1,5 +1,4 @@
 # fandom.com operations related
-import av
 import time
 import urllib
 import config
@@ -8,22 +7,28 @@ import requests
 import urllib.parse
 
 import common
+import http_policy
+import fandom_parse
 
 
-def fetch_quest_entries_from_chapter_page(page_url: str) -> list[str]:
+def fetch_page(page_url: str, max_retries: int = None) -> str:
     """
-    This function takes a chapter page URL and returns a list of quest entries present in the chapter.
+    This function takes a page URL and returns its HTML.
 
     Params:
-    page_url (str): URL of the chapter page.
+    page_url (str): URL of the page.
+    max_retries (int): Retries before giving up, see `http_policy`.
 
     Returns:
-    list[str]: List of quest entries present in the chapter.
+    str: HTML of the page.
     """
-    collection = []
-    req = common.request_retry_wrapper(lambda: requests.get(page_url))
+    req = http_policy.get(page_url, max_retries=max_retries)
     req.encoding = "utf-8"
-    document = bs4.BeautifulSoup(req.text, "html.parser")
+    return req.text
+
+
+def extract_quest_entries_from_chapter_page(document: bs4.BeautifulSoup, page_url: str) -> list[str]:
+    collection = []
     # find all <li> tags with ::marker
     # ol : list[bs4.element.Tag]
     li: bs4.element.Tag
@@ -46,14 +51,22 @@ def fetch_quest_entries_from_chapter_page(page_url: str) -> list[str]:
     return collection
 
 
-def fetch_quest_entries_from_lore_page(page_url: str) -> list[str]:
-    url = page_url
-    common.log(f"Fetching quest entries from lore page: {url}")
-    collection = []
+def fetch_quest_entries_from_chapter_page(page_url: str) -> list[str]:
+    """
+    This function takes a chapter page URL and returns a list of quest entries present in the chapter.
 
-    req = common.request_retry_wrapper(lambda: requests.get(page_url))
-    req.encoding = "utf-8"
-    document = bs4.BeautifulSoup(req.text, "html.parser")
+    Params:
+    page_url (str): URL of the chapter page.
+
+    Returns:
+    list[str]: List of quest entries present in the chapter.
+    """
+    document = fandom_parse.parse(fetch_page(page_url), fandom_parse.ordered_lists)
+    return extract_quest_entries_from_chapter_page(document, page_url)
+
+
+def extract_act_entries_from_lore_page(document: bs4.BeautifulSoup, page_url: str) -> list[str]:
+    collection = []
     # find all <li> tags with ::marker
     # ul : list[bs4.element.Tag]
     li: bs4.element.Tag
@@ -65,8 +78,19 @@ def fetch_quest_entries_from_lore_page(page_url: str) -> list[str]:
                     real_url = urllib.parse.urljoin(
                         page_url, label.get("href"))
                     common.log(f"Found act entry: {real_url}")
-                    collection.extend(
-                        fetch_quest_entries_from_chapter_page(real_url))
+                    collection.append(real_url)
+    return collection
+
+
+def fetch_quest_entries_from_lore_page(page_url: str) -> list[str]:
+    url = page_url
+    common.log(f"Fetching quest entries from lore page: {url}")
+    collection = []
+
+    document = fandom_parse.parse(fetch_page(page_url), fandom_parse.unordered_lists)
+    for real_url in extract_act_entries_from_lore_page(document, page_url):
+        collection.extend(
+            fetch_quest_entries_from_chapter_page(real_url))
 
     # remove duplicates
     collection = [item[0:item.rfind('#') + 1 if '#' in item else len(item)] for item in collection]
@@ -74,21 +98,8 @@ def fetch_quest_entries_from_lore_page(page_url: str) -> list[str]:
     return collection
 
 
-def fetch_quest_entries_from_tribe_quest_page(page_url: str) -> list[str]:
-    """
-    This function takes a tribe quest page URL and returns a list of quest entries present in the tribe quest.
-
-    Params:
-    page_url (str): URL of the tribe quest page.
-
-    Returns:
-    list[str]: List of quest entries present in the tribe quest.
-    """
+def extract_quest_entries_from_tribe_quest_page(document: bs4.BeautifulSoup, page_url: str) -> list[str]:
     collection = []
-    req = common.request_retry_wrapper(lambda: requests.get(page_url))
-
-    req.encoding = "utf-8"
-    document = bs4.BeautifulSoup(req.text, "html.parser")
     # find all <ul> tags
     li: bs4.element.Tag
     # start from div class="mw-parser-output"
@@ -108,6 +119,20 @@ def fetch_quest_entries_from_tribe_quest_page(page_url: str) -> list[str]:
     return collection
 
 
+def fetch_quest_entries_from_tribe_quest_page(page_url: str) -> list[str]:
+    """
+    This function takes a tribe quest page URL and returns a list of quest entries present in the tribe quest.
+
+    Params:
+    page_url (str): URL of the tribe quest page.
+
+    Returns:
+    list[str]: List of quest entries present in the tribe quest.
+    """
+    document = fandom_parse.parse(fetch_page(page_url), fandom_parse.content)
+    return extract_quest_entries_from_tribe_quest_page(document, page_url)
+
+
 def fetch_quest_entries(input: str):
     common.log(f"Fetching quest entries from {input}")
     if input.startswith('tribe:'):
@@ -125,24 +150,9 @@ def fetch_quest_entries(input: str):
         return fetch_quest_entries_from_chapter_page(input)
 
 
-def fetch_target_vo_from_quest_page(page_url: str, target_va: list[str]) -> dict[str, list[tuple[str, str]]]:
-    """
-    This function takes a quest page URL and returns the target VO of the quest.
-
-    Params:
-    page_url (str): URL of the quest page.
-
-    Returns:
-    dict[str, list[tuple[str, str]]]: Dictionary containing the VO of each target VA of the quest.
-    """
-
+def extract_target_vo(document: bs4.BeautifulSoup, target_va: list[str], page_url: str) -> dict[str, list[tuple[str, str]]]:
     collection = {}
 
-    req: requests.Response = common.request_retry_wrapper(
-        lambda: requests.get(page_url))
-
-    req.encoding = "utf-8"
-    document = bs4.BeautifulSoup(req.text, "html.parser")
     dialogueParts = document.find_all('div', {'class': 'dialogue'})
     common.log(f"Found {len(dialogueParts)} dialogue parts for {page_url}")
     if dialogueParts is None:
@@ -172,9 +182,10 @@ def fetch_target_vo_from_quest_page(page_url: str, target_va: list[str]) -> dict
                 text = i.get_text()
                 text = text[text.find(f'{char}: ') + len(f'{char}: '):]
                 for i in config.necessary_replacements:
-                    common.log(
-                        f"Replacing {i} with {config.necessary_replacements[i]} in text: {text}")
-                    text = text.replace(i, config.necessary_replacements[i])
+                    if i in text:
+                        common.log(
+                            f"Replacing {i} with {config.necessary_replacements[i]} in text: {text}")
+                        text = text.replace(i, config.necessary_replacements[i])
 
                 if collection.get(char) is None:
                     collection[char] = []
@@ -189,10 +200,11 @@ def fetch_target_vo_from_quest_page(page_url: str, target_va: list[str]) -> dict
             text = i.parent.get_text()
             text = text[text.find(f'{char}: ') + len(f'{char}: '):]
 
-            for i in config.necessary_replacements:
-                common.log(
-                    f"Replacing {i} with {config.necessary_replacements[i]} in text: {text}")
-                text = text.replace(i, config.necessary_replacements[i])
+            for k in config.necessary_replacements:
+                if k in text:
+                    common.log(
+                        f"Replacing {k} with {config.necessary_replacements[k]} in text: {text}")
+                    text = text.replace(k, config.necessary_replacements[k])
 
             aLabel = i.find('a')
             if aLabel is None:
@@ -209,6 +221,21 @@ def fetch_target_vo_from_quest_page(page_url: str, target_va: list[str]) -> dict
     return collection
 
 
+def fetch_target_vo_from_quest_page(page_url: str, target_va: list[str]) -> dict[str, list[tuple[str, str]]]:
+    """
+    This function takes a quest page URL and returns the target VO of the quest.
+
+    Params:
+    page_url (str): URL of the quest page.
+
+    Returns:
+    dict[str, list[tuple[str, str]]]: Dictionary containing the VO of each target VA of the quest.
+    """
+
+    document = fandom_parse.parse(fetch_page(page_url), fandom_parse.dialogue)
+    return extract_target_vo(document, target_va, page_url)
+
+
 def merge_voice_collections(collections: list[dict[str, list[tuple[str, str]]]]) -> dict[str, list[tuple[str, str]]]:
     """
     This function takes a list of collections and merge them into a single collection.
@@ -228,32 +255,15 @@ def merge_voice_collections(collections: list[dict[str, list[tuple[str, str]]]])
     return merged
 
 
-def fetch_target_subtitles(page_url: str, target_va: list[str]) -> dict[str, list[str]]:
-    """
-    This function takes a chapter page URL and returns the target VO of the chapter.
-
-    Params:
-    page_url (str): URL of the chapter page.
-
-    Returns:
-    dict[str, list[tuple[str, str]]]: Dictionary containing the VO of each target VA of the chapter.
-    """
+def extract_target_subtitles(document: bs4.BeautifulSoup, target_va: list[str], page_url: str) -> dict[str, list[str]]:
     collection = {}
 
-    req = common.request_retry_wrapper(lambda: requests.get(page_url))
-    req.encoding = "utf-8"
-    document = bs4.BeautifulSoup(req.text, "html.parser")
-    dialogueParts = document.find_all('div', {'class': 'dialogue'})
-    common.log(
-        f"Found {len(dialogueParts)} dialogue parts for target VA {target_va} in {page_url}")
-    if dialogueParts is None:
-        common.log(f"unexpected dialogue part: {page_url}")
-        return collection
-
     if True:
         dialoguePart = document
         ddLabels = dialoguePart.find_all(
             name='dd', recursive=True)  # search all nested too
+        common.log(
+            f"Found {len(ddLabels)} dialogue lines for target VA {target_va} in {page_url}")
         for i in ddLabels:
             bLabel = i.find('b')
             if bLabel is None:
@@ -297,6 +307,21 @@ def fetch_target_subtitles(page_url: str, target_va: list[str]) -> dict[str, lis
     return collection
 
 
+def fetch_target_subtitles(page_url: str, target_va: list[str]) -> dict[str, list[str]]:
+    """
+    This function takes a chapter page URL and returns the target VO of the chapter.
+
+    Params:
+    page_url (str): URL of the chapter page.
+
+    Returns:
+    dict[str, list[tuple[str, str]]]: Dictionary containing the VO of each target VA of the chapter.
+    """
+    # every <dd> of the page, not only the ones in dialogue parts
+    document = fandom_parse.parse(fetch_page(page_url), fandom_parse.dialogue_lines)
+    return extract_target_subtitles(document, target_va, page_url)
+
+
 def merge_subtitle_collections(collections: list[dict[str, list[str]]]):
     """
     This function takes a list of collections and merge them into a single collection.
@@ -330,10 +355,7 @@ def find_potentially_missing_voice_over_chars(page_url: str, target_va: list[str
     result = []
     threads = []
 
-    req = common.request_retry_wrapper(
-        lambda: requests.get(page_url), max_retries=2)
-    req.encoding = "utf-8"
-    document = bs4.BeautifulSoup(req.text, "html.parser")
+    document = fandom_parse.parse(fetch_page(page_url, max_retries=2), fandom_parse.dialogue)
     dialogueParts = document.find_all('div', {'class': 'dialogue'})
 
     if dialogueParts is None:
@@ -366,6 +388,7 @@ def find_potentially_missing_voice_over_chars(page_url: str, target_va: list[str
                     else:
                         def func():
                             try:
+                                import av
                                 src = x.find('a').attrs['href']
                                 audio = av.open(src)
                                 if audio.duration < 1:
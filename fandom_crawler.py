@@ -0,0 +1,205 @@
+"""
+Concurrent crawler of the fandom quest pages for AIDub.
+
+The chapter, lore, tribe and quest sources of `config.sources_to_fetch_voice` and
+`config.source_text_to_dub` are resolved level by level (source pages, then act pages,
+then quest pages), each level on a bounded pool of `config.fandom_crawler_workers`
+threads. Urls are deduplicated once their `#fragment` is dropped, every page is fetched
+at most once through a shared cache, and a quest page wanted for both voices and
+subtitles is parsed once and goes through both extractors.
+
+Requests are still rate limited per host by `http_policy`.
+"""
+
+import typing
+import threading
+import urllib.parse
+import concurrent.futures
+
+import common
+import config
+import fandom
+import fandom_parse
+
+
+def normalize_url(url: str) -> str:
+    return urllib.parse.urldefrag(url)[0]
+
+
+def is_fandom_source(source: str) -> bool:
+    # custom data providers and yatta are not crawled
+    return not source.startswith(('custom:', 'yatta:'))
+
+
+class FetchCache():
+    """
+    Fetch cache class, shared by every worker of a crawl. Concurrent requests of the same page wait for a single fetch.
+
+    Methods:
+        get(url: str) -> str: HTML of a page.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pages: dict[str, concurrent.futures.Future] = {}
+
+
+    def get(self, url: str) -> str:
+        key = normalize_url(url)
+        with self.lock:
+            future = self.pages.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.pages[key] = future
+        if owner:
+            try:
+                future.set_result(fandom.fetch_page(key))
+            except Exception as e:
+                # not cached, a later crawl may try again
+                with self.lock:
+                    del self.pages[key]
+                future.set_exception(e)
+        return future.result()
+
+
+class CrawlResult(typing.NamedTuple):
+    quests: list[str]
+    voices: dict[str, list[tuple[str, str]]]
+    subtitles: dict[str, list[str]]
+    failed: list[str]
+
+
+    def raise_for_failures(self) -> None:
+        """
+        Raise if any page failed to crawl, once the caller saved what was collected from the others.
+        """
+        if self.failed:
+            common.panic(f"Failed to crawl {len(self.failed)} pages, their voices and subtitles are missing, run again to retry them: {self.failed}")
+
+
+class Crawler():
+    """
+    Crawler class.
+
+    Attributes:
+        workers (int): Pages fetched and parsed at once.
+        cache (FetchCache): The fetch cache.
+
+    Methods:
+        quest_pages(sources: list[str]) -> list[str]: Resolve sources to their deduplicated quest pages.
+        crawl(voice_sources: list[str], subtitle_sources: list[str], target_va: list[str]) -> CrawlResult: Extract the voices and subtitles of every quest page of the sources.
+    """
+
+    def __init__(self, workers: int = None, cache: FetchCache = None) -> None:
+        self.workers = workers if workers is not None else config.fandom_crawler_workers
+        self.cache = cache if cache is not None else FetchCache()
+        self.failed: list[str] = []
+
+
+    def map(self, func: typing.Callable[[str], typing.Any], urls: list[str]) -> list[typing.Any]:
+        """
+        Run `func` on every url on the worker pool, in order. A url whose page failed gives None and is recorded in `failed`.
+        """
+        def run(url: str) -> typing.Any:
+            try:
+                return func(url)
+            except Exception as e:
+                common.log(f"Failed to crawl {url} due to {e}, skipping it")
+                self.failed.append(url)
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(common.carry_log_listener(run), urls))
+
+
+    def quest_pages(self, sources: list[str]) -> list[str]:
+        """
+        Resolve chapter (`<url>`), lore (`lore:<url>`), tribe (`tribe:<url>`) and quest (`quest:<url>`) sources to their quest pages.
+
+        Args:
+            sources (list[str]): The sources, custom providers and yatta ones are ignored.
+
+        Returns:
+            list[str]: The quest pages, without duplicates, in the order of the sources.
+        """
+        def resolve(source: str) -> tuple[list[str], list[str]]:
+            # (quest pages, act pages still to resolve)
+            if source.startswith('quest:'):
+                return [source[6:]], []
+            if source.startswith('tribe:'):
+                url = source[6:]
+                document = fandom_parse.parse(self.cache.get(url), fandom_parse.content)
+                return fandom.extract_quest_entries_from_tribe_quest_page(document, url), []
+            if source.startswith('lore:'):
+                url = source[5:]
+                document = fandom_parse.parse(self.cache.get(url), fandom_parse.unordered_lists)
+                return [], fandom.extract_act_entries_from_lore_page(document, url)
+            document = fandom_parse.parse(self.cache.get(source), fandom_parse.ordered_lists)
+            return fandom.extract_quest_entries_from_chapter_page(document, source), []
+
+        def resolve_act(url: str) -> list[str]:
+            document = fandom_parse.parse(self.cache.get(url), fandom_parse.ordered_lists)
+            return fandom.extract_quest_entries_from_chapter_page(document, url)
+
+        sources = unique([i for i in sources if is_fandom_source(i)])
+        quests: list[str] = []
+        acts: list[str] = []
+        for resolved in self.map(resolve, sources):
+            if resolved is not None:
+                quests.extend(resolved[0])
+                acts.extend(resolved[1])
+        for resolved in self.map(resolve_act, unique(acts)):
+            if resolved is not None:
+                quests.extend(resolved)
+        return unique(quests)
+
+
+    def crawl(self, voice_sources: list[str], subtitle_sources: list[str], target_va: list[str]) -> CrawlResult:
+        """
+        Extract the voices and subtitles of the target VAs from every quest page of the sources.
+
+        Args:
+            voice_sources (list[str]): Sources to collect voices from, e.g. `config.sources_to_fetch_voice`.
+            subtitle_sources (list[str]): Sources to collect subtitles from, e.g. `config.source_text_to_dub`.
+            target_va (list[str]): The characters.
+
+        Returns:
+            CrawlResult: The quest pages crawled, the collected voices and subtitles, and the pages which failed.
+        """
+        self.failed = []
+        voice_quests = self.quest_pages(voice_sources)
+        subtitle_quests = self.quest_pages(subtitle_sources)
+        quests = unique(voice_quests + subtitle_quests)
+        voice_quests, subtitle_quests = set(voice_quests), set(subtitle_quests)
+        common.log(f"Crawling {len(quests)} quest pages")
+
+        def extract(url: str) -> tuple[dict[str, list[tuple[str, str]]], dict[str, list[str]]]:
+            voice, subtitle = url in voice_quests, url in subtitle_quests
+            # the voices only read the dialogue parts, the subtitles every <dd>
+            only = fandom_parse.dialogue if not subtitle else fandom_parse.dialogue_lines if not voice else None
+            document = fandom_parse.parse(self.cache.get(url), only)
+            return (fandom.extract_target_vo(document, target_va, url) if voice else {},
+                    fandom.extract_target_subtitles(document, target_va, url) if subtitle else {})
+
+        results = [i for i in self.map(extract, quests) if i is not None]
+        return CrawlResult(
+            quests,
+            fandom.merge_voice_collections([i[0] for i in results]),
+            fandom.merge_subtitle_collections([i[1] for i in results]),
+            list(self.failed))
+
+
+def unique(urls: list[str]) -> list[str]:
+    seen = set()
+    result = []
+    for url in urls:
+        key = normalize_url(url)
+        if key not in seen:
+            seen.add(key)
+            result.append(key)
+    return result
+
+
+def crawl(voice_sources: list[str], subtitle_sources: list[str], target_va: list[str]) -> CrawlResult:
+    return Crawler().crawl(voice_sources, subtitle_sources, target_va)
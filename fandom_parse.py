@@ -0,0 +1,154 @@
+"""
+HTML parsing layer of the fandom scrapers for AIDub.
+
+Wiki pages are parsed with lxml, `config.fandom_parser`, and every extractor of
+`fandom` only builds the subtrees it reads, e.g. the `div.dialogue` parts of a quest
+page, through a `bs4.SoupStrainer`. The rest of the page (navigation, infoboxes,
+comments) is skipped while parsing instead of being turned into a tree.
+
+`benchmark()` checks on saved fixture pages that the extractors give the same output
+as with the full `html.parser` tree, and reports the speedup.
+"""
+
+import io
+import re
+import time
+import typing
+import pathlib
+import functools
+import contextlib
+import urllib.parse
+
+import bs4
+
+import common
+import config
+
+
+# the subtrees each extractor of `fandom` reads
+dialogue = bs4.SoupStrainer('div', attrs={'class': 'dialogue'})
+dialogue_lines = bs4.SoupStrainer('dd')
+ordered_lists = bs4.SoupStrainer('ol')
+unordered_lists = bs4.SoupStrainer('ul')
+content = bs4.SoupStrainer('div', attrs={'class': 'mw-parser-output'})
+
+
+@functools.lru_cache(maxsize=None)
+def parser_name() -> str:
+    if config.fandom_parser == "lxml":
+        try:
+            import lxml
+            return "lxml"
+        except ImportError:
+            common.log("lxml is not installed, parsing fandom pages with html.parser, install it with `pip install lxml`")
+    return "html.parser"
+
+
+def parse(html: str, only: bs4.SoupStrainer = None, parser: str = None) -> bs4.BeautifulSoup:
+    """
+    Parse a page.
+
+    Args:
+        html (str): HTML of the page.
+        only (bs4.SoupStrainer, optional): Only build the matching subtrees. Defaults to the whole page.
+        parser (str, optional): The bs4 tree builder. Defaults to `config.fandom_parser` if installed.
+
+    Returns:
+        bs4.BeautifulSoup: The document.
+    """
+    return bs4.BeautifulSoup(html, parser if parser is not None else parser_name(), parse_only=only)
+
+
+def save_fixture(page_url: str, dest: str = None) -> pathlib.Path:
+    """
+    Save a page as a benchmark fixture.
+
+    Args:
+        page_url (str): URL of the page.
+        dest (str, optional): Directory of the fixtures. Defaults to `config.fandom_fixtures_dest`.
+
+    Returns:
+        pathlib.Path: Path of the fixture.
+    """
+    import fandom
+    dest = pathlib.Path(dest if dest is not None else config.fandom_fixtures_dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    name = re.sub(r'[^\w-]', '_', urllib.parse.unquote(urllib.parse.urlsplit(page_url).path.rsplit('/', 1)[-1]))
+    path = dest / f"{name}.html"
+    path.write_text(fandom.fetch_page(page_url))
+    return path
+
+
+def speakers(document: bs4.BeautifulSoup) -> list[str]:
+    # every name the extractors may match, as written and as cleaned by the subtitle extractor
+    names = set()
+    for b in document.find_all('b'):
+        char = b.text[0:-1] if b.text.endswith(':') else b.text.strip()
+        names.update([char, b.text[0:-1], re.sub(r'[^\w]', ' ', char)])
+    return list(names)
+
+
+def normalize(result: typing.Any) -> typing.Any:
+    # subtitles are deduplicated through a set, their order is not meaningful
+    if isinstance(result, dict):
+        return {k: sorted(v) for k, v in result.items()}
+    return result
+
+
+def benchmark(fixtures: str = None, rounds: int = 5) -> dict[str, dict[str, typing.Any]]:
+    """
+    Compare the extractors of `fandom` on the full `html.parser` tree and on the strained fast parser, on every saved fixture page.
+
+    Args:
+        fixtures (str, optional): Directory of the fixtures. Defaults to `config.fandom_fixtures_dest`.
+        rounds (int, optional): Times each page is parsed and extracted. Defaults to 5.
+
+    Returns:
+        dict[str, dict[str, typing.Any]]: For each fixture, whether every extractor matched and the time of both paths.
+    """
+    import fandom
+    pages = sorted(pathlib.Path(fixtures if fixtures is not None else config.fandom_fixtures_dest).glob('*.html'))
+    if not pages:
+        common.panic("No fixture page to benchmark, save some with `cli.py fandom_benchmark --save <url>`")
+
+    page_url = "https://genshin-impact.fandom.com/wiki/Fixture"
+    extractors = [
+        ("vo", dialogue, lambda document, target_va: fandom.extract_target_vo(document, target_va, page_url)),
+        ("subtitles", dialogue_lines, lambda document, target_va: fandom.extract_target_subtitles(document, target_va, page_url)),
+        ("chapter", ordered_lists, lambda document, target_va: fandom.extract_quest_entries_from_chapter_page(document, page_url)),
+        ("lore", unordered_lists, lambda document, target_va: fandom.extract_act_entries_from_lore_page(document, page_url)),
+        ("tribe", content, lambda document, target_va: fandom.extract_quest_entries_from_tribe_quest_page(document, page_url)),
+    ]
+
+    report = {}
+    total_reference = total_fast = 0.0
+    for page in pages:
+        html = page.read_text()
+        target_va = speakers(parse(html, parser="html.parser"))
+        matches = {}
+        reference_seconds = fast_seconds = 0.0
+        # the extractors log every line they find
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, only, extract in extractors:
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    reference = extract(parse(html, parser="html.parser"), target_va)
+                reference_seconds += time.perf_counter() - start
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    fast = extract(parse(html, only), target_va)
+                fast_seconds += time.perf_counter() - start
+                matches[name] = normalize(reference) == normalize(fast)
+        report[page.name] = {
+            "size": len(html),
+            "matches": matches,
+            "reference_seconds": reference_seconds / rounds,
+            "fast_seconds": fast_seconds / rounds,
+            "speedup": reference_seconds / max(fast_seconds, 1e-9),
+        }
+        total_reference += reference_seconds
+        total_fast += fast_seconds
+        common.log(f"{page.name}: {report[page.name]['speedup']:.2f}x faster with {parser_name()}, "
+                   f"{'all extractors match' if all(matches.values()) else 'MISMATCH in ' + str([k for k, v in matches.items() if not v])}")
+    common.log(f"Parsed {len(pages)} fixture pages {total_reference / max(total_fast, 1e-9):.2f}x faster overall")
+    return report
@@ -3,18 +3,18 @@ import random
 import time
 
 import config
+import manifest_store
 import json
 import os
 
 def start():
     print("Preparing dataset...")
     download_model()
-    dataset_manifest = json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text())
-    for char in dataset_manifest:
-        for label in dataset_manifest[char]:
-            item = dataset_manifest[char][label]
-            path = item['dest']
-            text = item['text']
+    store = manifest_store.get_store()
+    for char in store.characters():
+        for sample in store.samples(char):
+            path = sample.dest
+            text = sample.text
             with open(pathlib.Path(path).with_suffix('.lab'), 'w+') as f:
                 f.write(text)
         extract_vq(char)
@@ -0,0 +1,368 @@
+"""
+Shared retry and rate limit policy of the outgoing requests of AIDub.
+
+Every scraper and downloader goes through the same per-host state:
+
+- a token bucket, `config.http_rate_limits`, so that hundreds of workers do not hit a
+  host at once;
+- exponential backoff with full jitter, at least as long as the `Retry-After` the host asked for;
+- retries only on transport errors and on `retryable_status`, anything else is raised
+  or returned to the caller at once;
+- a circuit breaker, a host failing `config.http_circuit_threshold` times in a row is
+  not contacted for `config.http_circuit_cooldown` seconds, then probed by a single request.
+  Requests meanwhile wait for the circuit to close again, for up to
+  `config.http_circuit_max_wait` seconds, unless they ask to fail fast.
+
+Per-host counters are available from `get_policy().stats()`.
+"""
+
+import time
+import random
+import typing
+import asyncio
+import functools
+import threading
+import email.utils
+import urllib.parse
+
+import common
+import config
+
+
+retryable_status = {408, 425, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """
+    An error worth retrying, optionally with the delay the host asked for.
+    """
+
+    def __init__(self, msg: str, retry_after: float | None = None) -> None:
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class RetriesExhausted(RuntimeError):
+    pass
+
+
+class CircuitOpen(RuntimeError):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_exceptions() -> tuple[type, ...]:
+    errors = [RetryableError, ConnectionError, TimeoutError, asyncio.TimeoutError]
+    try:
+        import requests
+        errors += [requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError]
+    except ImportError:
+        pass
+    try:
+        import aiohttp
+        errors += [aiohttp.ClientConnectionError, aiohttp.ClientPayloadError]
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Seconds to wait from a `Retry-After` header, given in seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def check_status(status: int, headers: typing.Mapping[str, str], url: str) -> None:
+    if status in retryable_status:
+        raise RetryableError(f"{url} answered with status code {status}", parse_retry_after(headers.get('Retry-After')))
+
+
+class HostPolicy():
+    """
+    Rate limit, circuit breaker and counters of a single host.
+
+    Attributes:
+        host (str): The host.
+        rate (float): Requests per second.
+        burst (float): Size of the token bucket.
+        state (str): Circuit state, one of "closed", "open" and "half-open".
+    """
+
+    def __init__(self, host: str, rate: float, burst: float) -> None:
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.counters = {
+            "requests": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "throttled": 0,
+            "circuit_opens": 0,
+            "circuit_wait_seconds": 0.0,
+            "rate_limit_wait_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+
+
+    def circuit_delay(self, waited: float, fail_fast: bool = False) -> float:
+        """
+        Seconds a request has to wait for the circuit, 0 if it may be sent now. Once the cooldown is over, the first caller is let through as the probe.
+
+        Args:
+            waited (float): Seconds the request already waited for the circuit.
+            fail_fast (bool, optional): Raise `CircuitOpen` instead of waiting. Defaults to False.
+
+        Returns:
+            float: Seconds to wait before asking again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "closed":
+                return 0.0
+            if self.state == "open" and now >= self.open_until:
+                # let a single probe through
+                self.state = "half-open"
+                return 0.0
+            remaining = config.http_circuit_max_wait - waited
+            if fail_fast or remaining <= 0:
+                raise CircuitOpen(f"Circuit of {self.host} is {self.state}" + (f" for {self.open_until - now:.1f}s more" if self.state == "open" else ", waiting for a probe request"))
+            # half-open until the probe answers, poll for it
+            delay = min(self.open_until - now if self.state == "open" else 1.0, remaining)
+            self.counters["circuit_wait_seconds"] += delay
+            return delay
+
+
+    def reserve(self) -> float:
+        """
+        Take a token for a request.
+
+        Returns:
+            float: Seconds to wait before sending it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, 0.0)
+            self.counters["requests"] += 1
+            self.counters["rate_limit_wait_seconds"] += wait
+            return wait
+
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.counters["successes"] += 1
+            self.consecutive_failures = 0
+            self.state = "closed"
+
+
+    def record_failure(self, error: Exception) -> None:
+        with self.lock:
+            self.counters["failures"] += 1
+            if isinstance(error, RetryableError) and error.retry_after is not None:
+                self.counters["throttled"] += 1
+            self.consecutive_failures += 1
+            if self.state == "half-open" or self.consecutive_failures >= config.http_circuit_threshold:
+                if self.state != "open":
+                    self.counters["circuit_opens"] += 1
+                    common.log(f"Opening the circuit of {self.host} for {config.http_circuit_cooldown}s after {self.consecutive_failures} failures")
+                self.state = "open"
+                self.open_until = time.monotonic() + config.http_circuit_cooldown
+
+
+    def record_retry(self, delay: float) -> None:
+        with self.lock:
+            self.counters["retries"] += 1
+            self.counters["backoff_seconds"] += delay
+
+
+    def stats(self) -> dict[str, typing.Any]:
+        with self.lock:
+            return {"state": self.state, "rate": self.rate, "burst": self.burst, **self.counters}
+
+
+class HttpPolicy():
+    """
+    Http policy class.
+
+    Methods:
+        host(url: str) -> HostPolicy: The policy of the host of a url.
+        backoff(attempt: int, retry_after: float = None) -> float: Delay before the given retry.
+        call(url: str, fetcher: typing.Callable[[], typing.Any], max_retries: int = None, fail_fast: bool = False) -> typing.Any: Run a fetcher under the policy of a host.
+        call_async(url: str, fetcher: typing.Callable[[], typing.Awaitable[typing.Any]], max_retries: int = None, fail_fast: bool = False) -> typing.Any: Coroutine counterpart of `call`.
+        get(url: str, **kwargs) -> requests.Response: GET a url under its policy, through a keep-alive session.
+        stats() -> dict[str, dict[str, typing.Any]]: Counters of every host.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.hosts: dict[str, HostPolicy] = {}
+        self.local = threading.local()
+
+
+    def host(self, url: str) -> HostPolicy:
+        host = urllib.parse.urlsplit(url).hostname or url
+        with self.lock:
+            if host not in self.hosts:
+                rate, burst = config.http_default_rate_limit
+                # most specific domain suffix first
+                for domain in sorted(config.http_rate_limits, key=len, reverse=True):
+                    if host == domain or host.endswith('.' + domain):
+                        rate, burst = config.http_rate_limits[domain]
+                        break
+                self.hosts[host] = HostPolicy(host, rate, burst)
+            return self.hosts[host]
+
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(config.http_backoff_cap, config.http_backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, config.http_backoff_cap))
+        return delay
+
+
+    def call(self, url: str, fetcher: typing.Callable[[], typing.Any], max_retries: int = None, fail_fast: bool = False) -> typing.Any:
+        """
+        Run a fetcher under the policy of a host, retrying it on retryable errors.
+
+        Args:
+            url (str): Url the fetcher requests, selects the host.
+            fetcher (typing.Callable[[], typing.Any]): Sends the request, raises `RetryableError` for retryable answers.
+            max_retries (int, optional): Defaults to `config.http_max_retries`.
+            fail_fast (bool, optional): Raise `CircuitOpen` at once while the circuit of the host is open instead of waiting for it. Defaults to False.
+
+        Returns:
+            typing.Any: What the fetcher returned.
+        """
+        host = self.host(url)
+        max_retries = max_retries if max_retries is not None else config.http_max_retries
+        for attempt in range(max_retries + 1):
+            waited = 0.0
+            while (delay := host.circuit_delay(waited, fail_fast)) > 0:
+                time.sleep(delay)
+                waited += delay
+            time.sleep(host.reserve())
+            try:
+                result = fetcher()
+            except retryable_exceptions() as e:
+                host.record_failure(e)
+                if attempt >= max_retries or (fail_fast and host.state == "open"):
+                    raise RetriesExhausted(f"Failed to fetch {url} after {attempt + 1} attempts due to {e}") from e
+                delay = self.backoff(attempt, getattr(e, 'retry_after', None))
+                host.record_retry(delay)
+                common.log(f"Failed to fetch {url} due to {e}, retrying in {delay:.2f}s...")
+                time.sleep(delay)
+            except Exception:
+                # the host answered, the caller could not use the answer
+                host.record_success()
+                raise
+            else:
+                host.record_success()
+                return result
+
+
+    async def call_async(self, url: str, fetcher: typing.Callable[[], typing.Awaitable[typing.Any]], max_retries: int = None, fail_fast: bool = False) -> typing.Any:
+        host = self.host(url)
+        max_retries = max_retries if max_retries is not None else config.http_max_retries
+        for attempt in range(max_retries + 1):
+            waited = 0.0
+            while (delay := host.circuit_delay(waited, fail_fast)) > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+            await asyncio.sleep(host.reserve())
+            try:
+                result = await fetcher()
+            except retryable_exceptions() as e:
+                host.record_failure(e)
+                if attempt >= max_retries or (fail_fast and host.state == "open"):
+                    raise RetriesExhausted(f"Failed to fetch {url} after {attempt + 1} attempts due to {e}") from e
+                delay = self.backoff(attempt, getattr(e, 'retry_after', None))
+                host.record_retry(delay)
+                common.log(f"Failed to fetch {url} due to {e}, retrying in {delay:.2f}s...")
+                await asyncio.sleep(delay)
+            except Exception:
+                # the host answered, the caller could not use the answer
+                host.record_success()
+                raise
+            else:
+                host.record_success()
+                return result
+
+
+    def session(self) -> typing.Any:
+        # requests sessions are not thread-safe, one per thread
+        import requests
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+
+    def get(self, url: str, max_retries: int = None, fail_fast: bool = False, **kwargs) -> typing.Any:
+        """
+        GET a url under its policy. Answers with a non retryable status are returned as is.
+
+        Args:
+            url (str): The url.
+            max_retries (int, optional): Defaults to `config.http_max_retries`.
+            fail_fast (bool, optional): Raise `CircuitOpen` at once while the circuit of the host is open. Defaults to False.
+            **kwargs: Passed to `requests.Session.get`.
+
+        Returns:
+            requests.Response: The response.
+        """
+        import requests
+        kwargs.setdefault('timeout', config.http_timeout)
+
+        def fetch() -> requests.Response:
+            # the python 3.10 adaption of config.py caches fandom pages by patching requests.get
+            send = requests.get if hasattr(requests, '_get') else self.session().get
+            response = send(url, **kwargs)
+            check_status(response.status_code, response.headers, url)
+            return response
+        return self.call(url, fetch, max_retries, fail_fast)
+
+
+    def stats(self) -> dict[str, dict[str, typing.Any]]:
+        with self.lock:
+            hosts = list(self.hosts.values())
+        return {host.host: host.stats() for host in hosts}
+
+
+policy: HttpPolicy = None
+policy_lock = threading.Lock()
+
+
+def get_policy() -> HttpPolicy:
+    """
+    Get the process-wide http policy.
+
+    Returns:
+        HttpPolicy: The http policy.
+    """
+    global policy
+    with policy_lock:
+        if policy is None:
+            policy = HttpPolicy()
+        return policy
+
+
+def get(url: str, max_retries: int = None, fail_fast: bool = False, **kwargs) -> typing.Any:
+    return get_policy().get(url, max_retries, fail_fast, **kwargs)
@@ -0,0 +1,270 @@
+"""
+Multi-backend inference pool for AIDub.
+
+Routes dub requests across the api_v2 servers declared in `config.gpt_sovits_backends`.
+A request goes to a backend which already has the weights of its character loaded,
+otherwise to an idle backend which is then swapped to those weights. Backends are
+health-checked in the background and skipped while they are down.
+"""
+
+import time
+import typing
+import threading
+import contextlib
+import subprocess
+
+import requests
+
+import common
+import config
+import GPTSoVits
+
+
+class Backend():
+    """
+    A single api_v2 server.
+
+    Attributes:
+        api_url (str): Url of the api server.
+        client (GPTSoVits.GPTSoVitsAPI): Pooled client of the api server.
+        model (tuple[str, str]): The `(ckpt, pth)` pair loaded or being loaded on the server.
+        inflight (int): Number of requests leased on the server.
+        healthy (bool): Whether the last health check succeeded.
+        last_used (float): Time of the last lease.
+    """
+
+    def __init__(self, api_url: str) -> None:
+        self.api_url = api_url
+        self.client = GPTSoVits.GPTSoVitsAPI(api_url, True)
+        self.model: tuple[str, str] = GPTSoVits.model_tracker.loaded(api_url)
+        self.inflight = 0
+        self.healthy = True
+        self.last_used = 0.0
+        self.served = 0
+
+
+class InferencePool():
+    """
+    Inference pool class.
+
+    Attributes:
+        backends (list[Backend]): The backends of the pool.
+        max_inflight (int): Maximum number of requests leased on a backend at once.
+
+    Methods:
+        acquire(ckpt: str, pth: str, weight: int = 1) -> Backend: Lease a backend with the given weights loaded, waiting if all are busy.
+        release(backend: Backend, weight: int = 1, failed: bool = False, key: tuple[str, str] = None) -> None: Return a leased backend.
+        lease(ckpt: str, pth: str, weight: int = 1) -> typing.Iterator[GPTSoVits.GPTSoVitsAPI]: Context manager around acquire and release.
+        check_health() -> None: Health-check every backend.
+        metrics() -> list[dict[str, typing.Any]]: Load and state of every backend.
+    """
+
+    def __init__(self, backends: list[dict[str, typing.Any]] = None, max_inflight: int = None) -> None:
+        """
+        Initialize the InferencePool.
+
+        Args:
+            backends (list[dict[str, typing.Any]], optional): Backend declarations. Defaults to `config.gpt_sovits_backends`.
+            max_inflight (int, optional): Maximum number of requests leased on a backend at once. Defaults to `config.dub_max_inflight`.
+        """
+        backends = backends if backends is not None else config.gpt_sovits_backends
+        self.backends = [Backend(get_backend_url(i)) for i in backends]
+        self.max_inflight = max_inflight if max_inflight is not None else config.dub_max_inflight
+        self.condition = threading.Condition()
+        # number of leases held or waited for, per (ckpt, pth) pair
+        self.demand: dict[tuple[str, str], int] = {}
+        self.checker: threading.Thread = None
+
+
+    def pick(self, key: tuple[str, str], weight: int) -> Backend | None:
+        healthy = [b for b in self.backends if b.healthy]
+        if not healthy:
+            common.panic("No healthy GPT-SoVITs backend available")
+
+        matched = [b for b in healthy if b.model == key]
+        best = min(matched, key=lambda b: b.inflight) if matched else None
+        if best is not None and best.inflight + weight <= self.max_inflight:
+            return best
+
+        # every backend with the weights is saturated or none has them,
+        # swap the least recently used idle backend. Backends whose weights are
+        # still wanted are only taken over if no backend has ours at all.
+        idle = [b for b in healthy if b.inflight == 0 and b.model != key]
+        unwanted = [b for b in idle if self.demand.get(b.model, 0) == 0]
+        idle = unwanted if unwanted or best is not None else idle
+        if idle:
+            backend = min(idle, key=lambda b: b.last_used)
+            backend.model = key
+            return backend
+
+        if best is not None and best.inflight == 0:
+            # the lease is heavier than max_inflight, let it through alone
+            return best
+        return None
+
+
+    def acquire(self, ckpt: str, pth: str, weight: int = 1) -> Backend:
+        """
+        Lease a backend with the given weights loaded, waiting if all are busy.
+
+        Args:
+            ckpt (str): Path to the GPT checkpoint.
+            pth (str): Path to the SoVITS weights.
+            weight (int, optional): Number of requests the lease accounts for. Defaults to 1.
+
+        Returns:
+            Backend: The leased backend, to be returned with `release`.
+        """
+        key = (ckpt, pth)
+        with self.condition:
+            all_down = not any(b.healthy for b in self.backends)
+        if all_down:
+            # the background checker may be disabled, give the backends a second chance, outside the lock
+            self.check_health()
+        with self.condition:
+            self.demand[key] = self.demand.get(key, 0) + 1
+            try:
+                while (backend := self.pick(key, weight)) is None:
+                    self.condition.wait()
+            except Exception:
+                self.demand[key] -= 1
+                raise
+            backend.inflight += weight
+            backend.last_used = time.time()
+
+        try:
+            # the model tracker skips the call if the weights are already loaded
+            backend.client.set_models(ckpt, pth)
+        except Exception as e:
+            if not isinstance(e, requests.exceptions.ConnectionError):
+                with self.condition:
+                    backend.model = GPTSoVits.model_tracker.loaded(backend.api_url)
+            self.release(backend, weight, isinstance(e, requests.exceptions.ConnectionError), key)
+            raise
+        return backend
+
+
+    def release(self, backend: Backend, weight: int = 1, failed: bool = False, key: tuple[str, str] = None) -> None:
+        """
+        Return a leased backend.
+
+        Args:
+            backend (Backend): The leased backend.
+            weight (int, optional): Number of requests the lease accounted for. Defaults to 1.
+            failed (bool, optional): Whether the backend failed during the lease, it is skipped until the next health check. Defaults to False.
+            key (tuple[str, str], optional): The `(ckpt, pth)` pair the lease was acquired for. Defaults to the weights of the backend.
+        """
+        with self.condition:
+            key = key if key is not None else backend.model
+            if self.demand.get(key, 0) > 0:
+                self.demand[key] -= 1
+            backend.inflight -= weight
+            backend.served += weight
+            if failed:
+                backend.healthy = False
+                backend.model = (None, None)
+                GPTSoVits.model_tracker.invalidate(backend.api_url)
+            self.condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def lease(self, ckpt: str, pth: str, weight: int = 1) -> typing.Iterator[GPTSoVits.GPTSoVitsAPI]:
+        backend = self.acquire(ckpt, pth, weight)
+        failed = False
+        try:
+            yield backend.client
+        except requests.exceptions.ConnectionError:
+            failed = True
+            raise
+        finally:
+            self.release(backend, weight, failed, (ckpt, pth))
+
+
+    def check_health(self) -> None:
+        """
+        Health-check every backend. Any http response counts as healthy, api_v2 has no dedicated endpoint.
+        The probes run without the lock, only their results are published under it.
+        """
+        results = []
+        for backend in self.backends:
+            try:
+                backend.client.session.get(f'{backend.api_url}/', timeout=(config.gpt_sovits_connect_timeout, 5))
+                results.append((backend, True))
+            except requests.exceptions.RequestException:
+                results.append((backend, False))
+        with self.condition:
+            for backend, healthy in results:
+                if healthy != backend.healthy:
+                    common.log(f"Backend {backend.api_url} is {'up' if healthy else 'down'}")
+                if not healthy:
+                    backend.model = (None, None)
+                    GPTSoVits.model_tracker.invalidate(backend.api_url)
+                backend.healthy = healthy
+            self.condition.notify_all()
+
+
+    def start_health_checker(self, interval: float) -> None:
+        def checker():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_health()
+                except Exception as e:
+                    common.log(f"Backend health check failed due to {e}")
+
+        if self.checker is None:
+            self.checker = threading.Thread(target=checker, daemon=True)
+            self.checker.start()
+
+
+    def metrics(self) -> list[dict[str, typing.Any]]:
+        with self.condition:
+            return [{
+                "api_url": b.api_url,
+                "healthy": b.healthy,
+                "model": b.model,
+                "inflight": b.inflight,
+                "served": b.served,
+            } for b in self.backends]
+
+
+def get_backend_url(backend: dict[str, typing.Any]) -> str:
+    return f"http://{backend['host']}:{backend['port']}"
+
+
+pool: InferencePool = None
+pool_lock = threading.Lock()
+
+
+def get_pool() -> InferencePool:
+    """
+    Get the process-wide inference pool, creating it on first use.
+
+    Returns:
+        InferencePool: The inference pool.
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = InferencePool()
+            if config.gpt_sovits_health_check_interval > 0:
+                pool.start_health_checker(config.gpt_sovits_health_check_interval)
+        return pool
+
+
+def run_backends() -> None:
+    """
+    Start an api_v2.py process for every backend declared in `config.gpt_sovits_backends` and wait for them.
+    """
+    processes: list[subprocess.Popen] = []
+    for backend in config.gpt_sovits_backends:
+        cmd = ["python", "thirdparty/GPTSoVITs/api_v2.py",
+               "-a", backend['host'], "-p", str(backend['port']),
+               "-c", backend.get('tts_infer_yaml', 'templates/tts_infer.yaml')]
+        if backend.get('numa_node') is not None:
+            cmd = ["numactl", f"--cpunodebind={backend['numa_node']}", f"--membind={backend['numa_node']}"] + cmd
+        common.log(f"Starting GPT-SoVITs backend {get_backend_url(backend)}")
+        processes.append(subprocess.Popen(cmd))
+
+    for p in processes:
+        p.wait()
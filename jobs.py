@@ -0,0 +1,342 @@
+"""
+Background job queue for AIDub.
+
+Long-running work (dataset download, emotion classification, GPT-SoVITs preprocessing and
+training) is submitted as a job and runs in a bounded executor instead of an HTTP handler.
+Every job kind belongs to a group with its own concurrency limit, see
+`config.jobs_group_limits`, so that e.g. only one job uses the gpu at a time. A job
+waiting for its group is held in the pending queue of the group and only handed to
+the executor once a slot frees up, so it never takes a worker thread away from the
+jobs of another group.
+
+Job state is persisted to `config.jobs_dest`. After a restart, queued jobs are queued
+again and jobs which were running are marked as interrupted.
+"""
+
+import os
+import json
+import time
+import uuid
+import typing
+import pathlib
+import threading
+import collections
+import concurrent.futures
+
+import common
+import config
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job():
+    """
+    A background job.
+
+    Attributes:
+        id (str): Id of the job.
+        kind (str): Kind of the job, as registered.
+        params (dict[str, typing.Any]): Keyword arguments of the job function.
+        state (str): One of "queued", "running", "succeeded", "failed", "cancelled" and "interrupted".
+        progress (float | None): Progress between 0 and 1, if the job reports it.
+        message (str | None): Last progress message.
+        result (typing.Any): Return value of the job function once succeeded.
+        error (str | None): Why the job failed.
+        logs (collections.deque[str]): Last lines logged by the job.
+    """
+
+    def __init__(self, kind: str, params: dict[str, typing.Any], id: str = None) -> None:
+        self.id = id if id is not None else uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.state = "queued"
+        self.progress: float | None = None
+        self.message: str | None = None
+        self.result: typing.Any = None
+        self.error: str | None = None
+        self.logs: collections.deque[str] = collections.deque(maxlen=config.jobs_max_log_lines)
+        # total number of lines logged, including the ones rotated out of `logs`
+        self.log_count = 0
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.cancel_requested = False
+        self.done = threading.Event()
+        self.future: concurrent.futures.Future = None
+
+
+    def log(self, msg: str) -> None:
+        self.logs.append(msg)
+        self.log_count += 1
+
+
+    def set_progress(self, progress: float | None, message: str = None) -> None:
+        self.progress = progress
+        if message is not None:
+            self.message = message
+            common.log(message)
+
+
+    def check_cancelled(self) -> None:
+        """
+        Raise `JobCancelled` if the job was asked to stop. Job functions call it between steps.
+        """
+        if self.cancel_requested:
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+
+    def finished_state(self) -> bool:
+        return self.state in ("succeeded", "failed", "cancelled", "interrupted")
+
+
+    def to_dict(self, with_logs: bool = False) -> dict[str, typing.Any]:
+        result = {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "state": self.state,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "log_count": self.log_count,
+        }
+        if with_logs:
+            result["logs"] = list(self.logs)
+        return result
+
+
+    @staticmethod
+    def from_dict(data: dict[str, typing.Any]) -> 'Job':
+        job = Job(data["kind"], data["params"], data["id"])
+        for key in ("state", "progress", "message", "result", "error", "created", "started", "finished", "log_count"):
+            setattr(job, key, data.get(key))
+        job.log_count = job.log_count or 0
+        job.logs.extend(data.get("logs", []))
+        if job.finished_state():
+            job.done.set()
+        return job
+
+
+class JobQueue():
+    """
+    Job queue class.
+
+    Methods:
+        register(kind: str, func: typing.Callable[..., typing.Any], group: str = None) -> None: Declare a job kind, `func` takes the job as first argument.
+        submit(kind: str, params: dict[str, typing.Any] = None) -> Job: Queue a job.
+        get(job_id: str) -> Job | None: A job by id.
+        list() -> list[Job]: Every known job, most recent first.
+        cancel(job_id: str) -> bool: Cancel a queued job, or ask a running one to stop.
+        wait(job_id: str, timeout: float = None) -> Job: Wait for a job to finish.
+    """
+
+    def __init__(self, path: str = None, max_workers: int = None, group_limits: dict[str, int] = None) -> None:
+        self.path = pathlib.Path(path if path is not None else config.jobs_dest)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else config.jobs_max_workers)
+        group_limits = group_limits if group_limits is not None else config.jobs_group_limits
+        self.groups = dict(group_limits)
+        self.group_running: dict[str, int] = collections.defaultdict(int)
+        self.group_pending: dict[str, collections.deque[Job]] = collections.defaultdict(collections.deque)
+        self.kinds: dict[str, tuple[typing.Callable[..., typing.Any], str | None]] = {}
+        self.jobs: dict[str, Job] = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.load()
+
+
+    def load(self) -> None:
+        if not self.path.exists():
+            return
+        try:
+            saved = json.loads(self.path.read_text())
+        except ValueError as e:
+            common.log(f"Job state is corrupted due to {e}, starting over")
+            return
+        for data in saved:
+            job = Job.from_dict(data)
+            if job.state == "running":
+                job.state = "interrupted"
+                job.error = "The server stopped while the job was running"
+                job.finished = time.time()
+                job.done.set()
+            self.jobs[job.id] = job
+
+
+    def resume(self) -> None:
+        """
+        Queue again the jobs which were queued when the server stopped, once their kinds are registered.
+        """
+        with self.lock:
+            pending = [job for job in self.jobs.values() if job.state == "queued" and job.future is None and job.kind in self.kinds]
+        for job in sorted(pending, key=lambda job: job.created):
+            common.log(f"Resuming queued job {job.id} ({job.kind})")
+            self.dispatch(job)
+
+
+    def save(self) -> None:
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps([job.to_dict(with_logs=True) for job in self.jobs.values()], ensure_ascii=False, default=str)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(data)
+            os.replace(tmp, self.path)
+
+
+    def register(self, kind: str, func: typing.Callable[..., typing.Any], group: str = None) -> None:
+        if group is not None and group not in self.groups:
+            self.groups[group] = 1
+        self.kinds[kind] = (func, group)
+
+
+    def submit(self, kind: str, params: dict[str, typing.Any] = None) -> Job:
+        """
+        Queue a job.
+
+        Args:
+            kind (str): Kind of the job.
+            params (dict[str, typing.Any], optional): Keyword arguments of the job function. Defaults to None.
+
+        Returns:
+            Job: The queued job.
+        """
+        if kind not in self.kinds:
+            common.panic(f"Unknown job kind {kind}, expected one of {list(self.kinds.keys())}")
+        job = Job(kind, params or {})
+        with self.lock:
+            self.jobs[job.id] = job
+        self.save()
+        self.dispatch(job)
+        common.log(f"Queued job {job.id} ({kind})")
+        return job
+
+
+    def dispatch(self, job: Job) -> None:
+        """
+        Hand a job to the executor if its group has a free slot, otherwise hold it in the pending queue of the group.
+        """
+        group = self.kinds[job.kind][1]
+        with self.lock:
+            if group is not None:
+                if self.group_running[group] >= self.groups[group]:
+                    self.group_pending[group].append(job)
+                    return
+                self.group_running[group] += 1
+            job.future = self.executor.submit(self.run, job)
+
+
+    def release(self, group: str | None) -> None:
+        """
+        Free a slot of a group, handing the next pending job of the group to the executor.
+        """
+        if group is None:
+            return
+        with self.lock:
+            self.group_running[group] -= 1
+            pending = self.group_pending[group]
+            if pending and self.group_running[group] < self.groups[group]:
+                job = pending.popleft()
+                self.group_running[group] += 1
+                job.future = self.executor.submit(self.run, job)
+
+
+    def run(self, job: Job) -> None:
+        func, group = self.kinds[job.kind]
+        try:
+            job.check_cancelled()
+            job.state = "running"
+            job.started = time.time()
+            self.save()
+            common.log_listener.callback = job.log
+            job.result = func(job, **job.params)
+            job.state = "succeeded"
+            job.progress = 1.0
+        except JobCancelled:
+            job.state = "cancelled"
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)
+            common.log(f"Job {job.id} ({job.kind}) failed due to {e}")
+        finally:
+            common.log_listener.callback = None
+            self.release(group)
+        job.finished = time.time()
+        self.save()
+        job.done.set()
+
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+
+    def list(self) -> list[Job]:
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created, reverse=True)
+
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued job, or ask a running one to stop at its next check.
+
+        Args:
+            job_id (str): Id of the job.
+
+        Returns:
+            bool: Whether the job was still queued or running.
+        """
+        job = self.get(job_id)
+        if job is None or job.finished_state():
+            return False
+        job.cancel_requested = True
+        group = self.kinds[job.kind][1] if job.kind in self.kinds else None
+        with self.lock:
+            pending = self.group_pending.get(group)
+            waiting = pending is not None and job in pending
+            if waiting:
+                # still waiting for a slot of its group
+                pending.remove(job)
+            future = job.future
+        if not waiting and future is not None:
+            if not future.cancel():
+                # running, stops at its next check
+                return True
+            # handed to the executor but never started, its slot is free again
+            self.release(group)
+        job.state = "cancelled"
+        job.finished = time.time()
+        job.done.set()
+        self.save()
+        return True
+
+
+    def wait(self, job_id: str, timeout: float = None) -> Job:
+        job = self.get(job_id)
+        if job is None:
+            common.panic(f"Unknown job {job_id}")
+        job.done.wait(timeout)
+        return job
+
+
+queue: JobQueue = None
+queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """
+    Get the process-wide job queue, loading the persisted job state on first use.
+
+    Returns:
+        JobQueue: The job queue.
+    """
+    global queue
+    with queue_lock:
+        if queue is None:
+            queue = JobQueue()
+        return queue
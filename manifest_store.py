@@ -0,0 +1,152 @@
+"""
+In-memory index of the dataset manifest for AIDub.
+
+`dataset_manifest.json` is parsed once and kept as compact per-character sample lists
+with a lookup by hash id. The file is only parsed again when its modification time or
+size changes, so every reader can go through `get_store()` on its hot path.
+"""
+
+import os
+import sys
+import json
+import typing
+import pathlib
+import threading
+
+import common
+import config
+
+
+class Sample(typing.NamedTuple):
+    hash_id: str
+    char: str
+    text: str
+    dest: str
+    url: typing.Any
+    duration: float | None = None
+    # any other key of the manifest entry, written back as is by `to_dict`
+    extra: dict[str, typing.Any] | None = None
+
+
+known_keys = {'text', 'dest', 'url', 'duration'}
+
+
+class ManifestStore():
+    """
+    Manifest store class.
+
+    Attributes:
+        path (pathlib.Path): Path of the dataset manifest.
+        generation (int): Incremented every time the manifest is parsed again.
+
+    Methods:
+        refresh() -> bool: Parse the manifest again if it changed on disk.
+        characters() -> list[str]: Characters of the dataset.
+        samples(char: str) -> list[Sample]: Samples of a character.
+        sample(char: str, hash_id: str) -> Sample | None: Sample of a character by hash id.
+        lookup(hash_id: str) -> Sample | None: Sample of any character by hash id.
+        to_dict() -> dict[str, dict[str, dict[str, typing.Any]]]: The manifest in its on-disk shape.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = pathlib.Path(path if path is not None else config.dataset_manifest_file_dest)
+        self.lock = threading.Lock()
+        self.signature: tuple[int, int] | None = None
+        self.generation = 0
+        self.by_char: dict[str, list[Sample]] = {}
+        self.by_hash: dict[tuple[str, str], Sample] = {}
+        self.by_hash_id: dict[str, Sample] = {}
+
+
+    def refresh(self) -> bool:
+        """
+        Parse the manifest again if its modification time or size changed.
+
+        Returns:
+            bool: Whether the manifest was parsed again.
+        """
+        try:
+            st = os.stat(self.path)
+            signature = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            signature = None
+
+        if signature == self.signature:
+            return False
+
+        with self.lock:
+            if signature == self.signature:
+                return False
+            raw = json.loads(self.path.read_text()) if signature is not None else {}
+            by_char: dict[str, list[Sample]] = {}
+            by_hash: dict[tuple[str, str], Sample] = {}
+            by_hash_id: dict[str, Sample] = {}
+            for char, entries in raw.items():
+                char = sys.intern(char)
+                samples = []
+                for hash_id, entry in entries.items():
+                    extra = {k: v for k, v in entry.items() if k not in known_keys} or None
+                    sample = Sample(hash_id, char, entry['text'], entry['dest'], entry.get('url'), entry.get('duration'), extra)
+                    samples.append(sample)
+                    by_hash[(char, hash_id)] = sample
+                    by_hash_id[hash_id] = sample
+                by_char[char] = samples
+            self.by_char, self.by_hash, self.by_hash_id = by_char, by_hash, by_hash_id
+            self.signature = signature
+            self.generation += 1
+            common.log(f"Loaded dataset manifest with {len(by_hash)} samples of {len(by_char)} characters")
+            return True
+
+
+    def characters(self) -> list[str]:
+        self.refresh()
+        return list(self.by_char.keys())
+
+
+    def samples(self, char: str) -> list[Sample]:
+        self.refresh()
+        return self.by_char.get(char, [])
+
+
+    def sample(self, char: str, hash_id: str) -> Sample | None:
+        self.refresh()
+        return self.by_hash.get((char, hash_id))
+
+
+    def lookup(self, hash_id: str) -> Sample | None:
+        self.refresh()
+        return self.by_hash_id.get(hash_id)
+
+
+    def to_dict(self) -> dict[str, dict[str, dict[str, typing.Any]]]:
+        self.refresh()
+        result = {}
+        for char, samples in self.by_char.items():
+            result[char] = {}
+            for sample in samples:
+                entry = {"text": sample.text, "url": sample.url, "dest": sample.dest}
+                if sample.duration is not None:
+                    entry["duration"] = sample.duration
+                if sample.extra is not None:
+                    entry.update(sample.extra)
+                result[char][sample.hash_id] = entry
+        return result
+
+
+store: ManifestStore = None
+store_lock = threading.Lock()
+
+
+def get_store() -> ManifestStore:
+    """
+    Get the process-wide manifest store, refreshed against the file on disk.
+
+    Returns:
+        ManifestStore: The manifest store.
+    """
+    global store
+    with store_lock:
+        if store is None:
+            store = ManifestStore()
+    store.refresh()
+    return store
@@ -14,6 +14,7 @@ includes the following functionalities:
 - Dubbing
 - GPT-SoVITs dataset preprocessing
 - GPT-SoVITs model training
+- Background jobs for all of the above, see `/jobs`
 
 To run the server, simply run the following command in the terminal:
 
@@ -21,12 +22,24 @@ To run the server, simply run the following command in the terminal:
 python middleware.py
 ```
 
-The server will be running on `http://localhost:2731`.
+The server will be running on `http://localhost:2731`. For production, serve it with waitress
+(threads, one process) or gunicorn (several processes, each with its own inference pool accounting):
+
+```
+python middleware.py --server waitress --threads 32
+python middleware.py --server gunicorn --workers 2 --threads 16
+```
+
+Background jobs are kept by a single process, with several gunicorn workers the `/jobs` routes
+are refused and the older long-running routes run in the request instead of being queued.
 """
 
 
 import os
 import pathlib
+import argparse
+import functools
+import threading
 import traceback
 import flask_cors
 import flask
@@ -34,11 +47,19 @@ import typing
 import config
 import common
 import fandom
+import fandom_crawler
 import voice_fetch
 import emotion
 import dub
 import importlib
 import communication
+import GPTSoVits
+import inference_pool
+import dub_cache
+import model_registry
+import dataset_registry
+import jobs
+import http_policy
 
 def run_gpt_sovits_server():
     os.system("cd GPT-SoVITs && python api_v2.py")
@@ -48,10 +69,9 @@ app = flask.Flask(__name__)
 
 @app.before_request
 def before_request():
-    config.models_path = common.get_available_model_path()
-    config.muted_characters = common.get_muted_chars()
-    config.models_path = common.get_available_model_path()
-    config.muted_characters = common.get_muted_chars()
+    # rebuilt only when the weights folders or the dataset manifest change, the registry swaps
+    # new objects into config instead of mutating the published ones
+    dataset_registry.get_registry().apply()
     emotion.load_analysis_file()
 
 def makeResult(ok: bool = True, data: typing.Any = None) -> dict:
@@ -60,54 +80,225 @@ def makeResult(ok: bool = True, data: typing.Any = None) -> dict:
         'data': data
     }
 
-def do_voice_collection():
+# long-running routes may only take this many server threads, the rest stay available for dub traffic
+long_running_slots = threading.BoundedSemaphore(config.middleware_max_long_running)
+
+
+def long_running(route: typing.Callable) -> typing.Callable:
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if not long_running_slots.acquire(blocking=False):
+            return makeResult(ok=False, data=f"Too many long-running requests in progress, try again later.")
+        try:
+            return route(*args, **kwargs)
+        finally:
+            long_running_slots.release()
+    return wrapper
+
+
+def do_voice_collection(muted_characters: list[str] = None, sources_to_fetch_voice: list[str] = None, check_cancelled: typing.Callable[[], None] = None):
+    muted_characters = muted_characters if muted_characters is not None else config.muted_characters
+    sources_to_fetch_voice = sources_to_fetch_voice if sources_to_fetch_voice is not None else config.sources_to_fetch_voice
     collections: dict[str, list[tuple[str, str]]] = {}
-    for i in config.sources_to_fetch_voice:
+    for i in sources_to_fetch_voice:
         if i.startswith('custom:'):
             providerName = i[7:i.index(':', 7)]
             url = i[i.index(':')+1:]
             provider = importlib.import_module(f'customDataProviders.{providerName}')
-            collections = fandom.merge_voice_collections([collections, provider.fetch_vo_urls(url, config.muted_characters)])
-        else:
-            quests = common.request_retry_wrapper(lambda: fandom.fetch_quest_entries(i))
-            
+            collections = fandom.merge_voice_collections([collections, provider.fetch_vo_urls(url, muted_characters)])
 
-            for quest in quests:
-                collection = fandom.fetch_target_vo_from_quest_page(quest, config.muted_characters)
+    # every fandom source at once
+    crawled = fandom_crawler.crawl(sources_to_fetch_voice, [], muted_characters)
+    collections = fandom.merge_voice_collections([collections, crawled.voices])
+    if check_cancelled is not None:
+        check_cancelled()
 
-                collections = fandom.merge_voice_collections([collections, collection])
-                
     # download voices
     # voice_fetch.reduce_collection(collections)
-    voice_fetch.fetch_collection(collections)
+    voice_fetch.fetch_collection(collections, check_cancelled)
     collections = voice_fetch.reduce_collection_by_size(collections)
     pathlib.Path(config.dataset_manifest_file_dest).write_text(voice_fetch.serialize_collection(collections))
 
     voice_fetch.generate_text_list()
-    
+    # the job fails with the pages missing from the dataset
+    crawled.raise_for_failures()
+
+
+
+def download_dataset_job(job: jobs.Job, char_names: list[str], sources_to_fetch: list[str]) -> str:
+    registry = dataset_registry.get_registry()
+    registry.refresh()
+    muted_characters = [i for i in set(char_names + registry.muted_characters)]
+    sources_to_fetch_voice = [i for i in set(sources_to_fetch + config.sources_to_fetch_voice)]
+    do_voice_collection(muted_characters, sources_to_fetch_voice, job.check_cancelled)
+    return f"Dataset for {char_names} downloaded successfully."
 
 
+def emotion_classification_job(job: jobs.Job, full: bool = False) -> str:
+    emotion.do_classification(full, check_cancelled=job.check_cancelled)
+    return ''
+
+
+def preprocess_job(job: jobs.Job, step: str, skip_trained: bool) -> str:
+    registry = dataset_registry.get_registry()
+    registry.refresh()
+    chars = registry.muted_characters
+    for index, char in enumerate(chars):
+        job.check_cancelled()
+        # skip if model already exists, assuming preprocessed
+        if skip_trained and char in registry.models_path:
+            continue
+        job.set_progress(index / max(len(chars), 1), f"Preprocessing ({step}) dataset for {char}")
+        try:
+            dest = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}")
+            list = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}/{char}.list")
+            communication.preprocess_dataset(step, char, str(list.absolute()), str(dest.absolute()), "0")
+        except Exception as e:
+            common.panic(f"Error while preprocessing dataset for {char}: {e}")
+    return f"Dataset for {chars} preprocessed successfully."
+
+
+def train_job(job: jobs.Job, stage: str, batch_size: int = None, total_epoch: int = 15) -> str:
+    registry = dataset_registry.get_registry()
+    registry.refresh()
+    chars = registry.muted_characters
+    # index of the trained weights in the (ckpt, pth) pair
+    weights = 0 if stage == 's1' else 1
+    for index, char in enumerate(chars):
+        job.check_cancelled()
+        if char in registry.models_path and registry.models_path[char][weights] != "":
+            continue
+        job.set_progress(index / max(len(chars), 1), f"Training the {'GPT' if stage == 's1' else 'SoVITS'} model of {char}")
+        try:
+            train = communication.train_s1 if stage == 's1' else communication.train_s2
+            train(char, "0", batch_size=batch_size, total_epoch=total_epoch)
+        except Exception as e:
+            traceback.print_exc()
+            common.panic(f"Error while training model for {char}: {e}")
+    return f"Model for {chars} trained successfully."
+
+
+job_kinds = {
+    'download_dataset': (download_dataset_job, 'network'),
+    'emotion_classification': (emotion_classification_job, 'gpu'),
+    'preprocess_dataset': (preprocess_job, 'gpu'),
+    'train_model': (train_job, 'gpu'),
+}
+job_queue: jobs.JobQueue = None
+job_queue_lock = threading.Lock()
+# jobs live in the memory of a single process, gunicorn workers would each run their own
+# queue over the same state file, so they are refused when serving with several workers
+jobs_enabled = True
+
+
+def get_job_queue() -> jobs.JobQueue:
+    """
+    Get the job queue of this process, registering the job kinds and resuming the queued jobs on first use.
+    Built by `serve()` once the server process is final, i.e. after the fork under gunicorn, never at import.
+    """
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            queue = jobs.get_queue()
+            for kind, (func, group) in job_kinds.items():
+                queue.register(kind, func, group)
+            queue.resume()
+            job_queue = queue
+        return job_queue
+
+
+def job_route(route: typing.Callable) -> typing.Callable:
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if not jobs_enabled:
+            return makeResult(ok=False, data=f"Background jobs need a single server process, serve the middleware with waitress or gunicorn --workers 1.")
+        return route(*args, **kwargs)
+    return wrapper
+
+
+def run_job(kind: str, params: dict[str, typing.Any]) -> dict:
+    """
+    Run a job for the routes which predate the job queue. It is queued and its id returned at once, poll it on `/jobs/<id>`.
+    Without a job queue, i.e. with several gunicorn workers, it runs in the request as it used to and its result is returned.
+    """
+    if jobs_enabled:
+        return makeResult(ok=True, data={'job_id': get_job_queue().submit(kind, params).id})
+    func = job_kinds[kind][0]
+    try:
+        return makeResult(ok=True, data=func(jobs.Job(kind, params), **params))
+    except Exception as e:
+        return makeResult(ok=False, data=str(e))
+
+
+@app.route('/jobs', methods=['POST'])
+@job_route
+def submit_job():
+    queue = get_job_queue()
+    form = flask.request.json
+    kind = form.get('kind')
+    if kind not in queue.kinds:
+        return makeResult(ok=False, data=f"Invalid request, kind must be one of {list(queue.kinds.keys())}.")
+    if kind == 'download_dataset' and (not form.get('params', {}).get('char_names') or not form.get('params', {}).get('sources_to_fetch')):
+        return makeResult(ok=False, data=f"Invalid request, char_names and sources_to_fetch are required.")
+    job = queue.submit(kind, form.get('params', {}))
+    return makeResult(ok=True, data={'job_id': job.id})
+
+
+@app.route('/jobs/list', methods=['POST', 'GET'])
+@job_route
+def list_jobs():
+    queue = get_job_queue()
+    return makeResult(ok=True, data=[job.to_dict() for job in queue.list()])
+
+
+@app.route('/jobs/<job_id>', methods=['POST', 'GET'])
+@job_route
+def job_status(job_id: str):
+    queue = get_job_queue()
+    job = queue.get(job_id)
+    if job is None:
+        return makeResult(ok=False, data=f"Job {job_id} not found.")
+    return makeResult(ok=True, data=job.to_dict())
+
+
+@app.route('/jobs/<job_id>/log', methods=['POST', 'GET'])
+@job_route
+def job_log(job_id: str):
+    queue = get_job_queue()
+    job = queue.get(job_id)
+    if job is None:
+        return makeResult(ok=False, data=f"Job {job_id} not found.")
+    # lines numbered from the start of the job, pass the last log_count back as `since` to tail
+    since = int(flask.request.args.get('since', 0))
+    logs = list(job.logs)
+    first = job.log_count - len(logs)
+    return makeResult(ok=True, data={'log_count': job.log_count, 'lines': logs[max(since - first, 0):]})
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@job_route
+def cancel_job(job_id: str):
+    queue = get_job_queue()
+    if not queue.cancel(job_id):
+        return makeResult(ok=False, data=f"Job {job_id} is not queued or running.")
+    return makeResult(ok=True, data=queue.get(job_id).to_dict())
+
 
 @app.route('/download_dataset', methods=['POST'])
+@long_running
 def download_dataset():
     request_form = flask.request.json
     char_names = request_form.get('char_names', [])
     sources_to_fetch = request_form.get('sources_to_fetch', [])
     if char_names == [] or sources_to_fetch == []:
         return makeResult(ok=False, data=f"Invalid request, char_names and sources_to_fetch are required.")
-    
-    config.muted_characters = [i for i in set(char_names + config.muted_characters)]
-    config.sources_to_fetch_voice = [i for i in set(sources_to_fetch + config.sources_to_fetch_voice)]
-    do_voice_collection()
-    
-    return makeResult(ok=True, data=f"Dataset for {char_names} downloaded successfully.")
-
+    return run_job('download_dataset', {'char_names': char_names, 'sources_to_fetch': sources_to_fetch})
 
 
 @app.route('/emotion_classification', methods=['POST'])
+@long_running
 def emotion_classification():
-    emotion.do_classification()
-    return makeResult(ok=True, data=f'')
+    return run_job('emotion_classification', {})
 
 
 @app.route('/dub', methods=['POST', 'GET'])
@@ -116,102 +307,46 @@ def dub_route():
         form = flask.request.json
         text = form['text']
         char_name = form['char_name']
-        ckpt, pth = dub.get_tts_models(char_name)
-        dub.setup_gpt_sovits_client(ckpt, pth)
-        r = dub.dub_one(text, char_name, True)
-        # resp = flask.make_response()
-        # resp.headers['Content-Type'] = r.headers['Content-Type']
-        # resp.data = r.iter_content(chunk_size=10*1024)
-        # return resp
-        headers = r.headers
+        headers, chunks = dub.stream_one(text, char_name)
         headers['Content-Disposition'] = f'attachment; filename={char_name}.aac'
-        return flask.Response(r.iter_content(chunk_size=10*1024), headers=headers)
+        return flask.Response(chunks, headers=headers)
     else:
         # check if body is application/json
         text = flask.request.args.get('text')
         char_name = flask.request.args.get('char_name')
-        ckpt, pth = dub.get_tts_models(char_name)
-        dub.setup_gpt_sovits_client(ckpt, pth)
-        r = dub.dub_one(text, char_name, True)
-        # resp = flask.make_response()
-        # resp.headers['Content-Type'] = r.headers['Content-Type']
-        # resp.data = r.iter_content(chunk_size=10*1024)
-        # return resp
-        headers = r.headers
+        headers, chunks = dub.stream_one(text, char_name)
         headers['Content-Disposition'] = f'attachment; filename={char_name}.aac'
-        return flask.Response(r.iter_content(chunk_size=10*1024), headers=headers)
+        return flask.Response(chunks, headers=headers)
 
 
 @app.route('/gpt_sovits/dataset_preprocessing/get_text', methods=['POST'])
+@long_running
 def get_text():
-    for char in config.muted_characters:
-        try:
-            dest = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}")
-            list = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}/{char}.list")
-            communication.preprocess_dataset("1a", char, str(list.absolute()), str(dest.absolute()), "0")
-        except Exception as e:
-            return makeResult(ok=False, data=f"Error while preprocessing dataset for {char}: {e}")
-    return makeResult(ok=True, data=f"Dataset for {config.muted_characters} preprocessed successfully.")
+    return run_job('preprocess_dataset', {'step': '1a', 'skip_trained': False})
 
 @app.route('/gpt_sovits/dataset_preprocessing/get_hubert_wav32k', methods=['POST'])
+@long_running
 def get_hubert_wav32k():
-    for char in config.muted_characters:
-        # check if model exists
-        if char in config.models_path:
-            continue
-        try:
-            dest = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}")
-            list = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}/{char}.list")
-            communication.preprocess_dataset("1b", char, str(list.absolute()), str(dest.absolute()), "0")
-        except Exception as e:
-            return makeResult(ok=False, data=f"Error while preprocessing dataset for {char}: {e}")
-    return makeResult(ok=True, data=f"Dataset for {config.muted_characters} preprocessed successfully.")
+    return run_job('preprocess_dataset', {'step': '1b', 'skip_trained': True})
 
 @app.route('/gpt_sovits/dataset_preprocessing/name_to_semantic', methods=['POST'])
+@long_running
 def name_to_semantic():
-    for char in config.muted_characters:
-        if char in config.models_path:
-            continue
-        try:
-            dest = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}")
-            list = pathlib.Path(f"{config.save_dest_for_downloaded_voice}/{char}/{char}.list")
-            communication.preprocess_dataset("1c", char, str(list.absolute()), str(dest.absolute()), "0")
-        except Exception as e:
-            return makeResult(ok=False, data=f"Error while preprocessing dataset for {char}: {e}")
-    return makeResult(ok=True, data=f"Dataset for {config.muted_characters} preprocessed successfully.")
+    return run_job('preprocess_dataset', {'step': '1c', 'skip_trained': True})
 
 
 @app.route('/gpt_sovits/train_model_gpt', methods=['POST'])
+@long_running
 def train_model_gpt():
     form = flask.request.json
-    print(config.models_path)
-    batch_size = form.get('batch_size', None)
-    total_epoch = form.get('total_epoch', 15)
-    for char in config.muted_characters:
-        try:
-            if char in config.models_path and config.models_path[char][0] != "":
-                continue
-            communication.train_s1(char, "0", batch_size=batch_size, total_epoch=total_epoch)
-        except Exception as e:
-            traceback.print_exc()
-            return makeResult(ok=False, data=f"Error while training model for {char}: {e}")
-    return makeResult(ok=True, data=f"Model for {config.muted_characters} trained successfully.")
+    return run_job('train_model', {'stage': 's1', 'batch_size': form.get('batch_size', None), 'total_epoch': form.get('total_epoch', 15)})
 
 
 @app.route('/gpt_sovits/train_model_sovits', methods=['POST'])
+@long_running
 def train_model_sovits():
     form = flask.request.json
-    batch_size = form.get('batch_size', None)
-    total_epoch = form.get('total_epoch', 15)
-    for char in config.muted_characters:
-        try:
-            if char in config.models_path and config.models_path[char][1] != "":
-                continue
-            communication.train_s2(char, "0", batch_size=batch_size, total_epoch=total_epoch)
-        except Exception as e:
-            return makeResult(ok=False, data=f"Error while training model for {char}: {e}")
-        
-    return makeResult(ok=True, data=f"Model for {config.muted_characters} trained successfully.")
+    return run_job('train_model', {'stage': 's2', 'batch_size': form.get('batch_size', None), 'total_epoch': form.get('total_epoch', 15)})
     
     
 @app.route('/sentiment', methods=['POST'])
@@ -231,9 +366,72 @@ def info():
         "status": "running",
         "models_path": config.models_path,
         "available_characters": config.muted_characters,
+        "dataset_generation": dataset_registry.get_registry().generation,
+        "model_swaps": GPTSoVits.model_tracker.metrics(),
+        "backends": inference_pool.get_pool().metrics(),
+        "dub_cache": dub_cache.get_cache().stats(),
+        "models": model_registry.get_registry().status(),
+        "http": http_policy.get_policy().stats(),
     })
     
 
+def serve(server: str, host: str, port: int, workers: int, threads: int):
+    """
+    Serve the middleware.
+
+    Args:
+        server (str): "flask" for the development server, "waitress" or "gunicorn".
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        workers (int): Number of processes, gunicorn only. Background jobs are only available with a single one.
+        threads (int): Number of request threads of each process.
+    """
+    global jobs_enabled
+    if server == 'flask':
+        model_registry.get_registry().prewarm(config.prewarm_models)
+        get_job_queue()
+        app.run(debug=False, host=host, port=port, threaded=True)
+    elif server == 'waitress':
+        import waitress
+        model_registry.get_registry().prewarm(config.prewarm_models)
+        get_job_queue()
+        waitress.serve(app, host=host, port=port, threads=threads)
+    elif server == 'gunicorn':
+        import gunicorn.app.base
+        jobs_enabled = workers == 1
+        if not jobs_enabled:
+            common.log(f"Serving with {workers} workers, background jobs and the routes running them are disabled")
+
+        def post_fork(arbiter, worker):
+            # models are warmed and queued jobs resumed in the worker, after the fork
+            model_registry.get_registry().prewarm(config.prewarm_models)
+            if jobs_enabled:
+                get_job_queue()
+
+        class Application(gunicorn.app.base.BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', workers)
+                self.cfg.set('threads', threads)
+                self.cfg.set('worker_class', 'gthread')
+                # dubs of long lines stream for a while
+                self.cfg.set('timeout', config.gpt_sovits_read_timeout)
+                self.cfg.set('post_fork', post_fork)
+
+            def load(self):
+                return app
+
+        Application().run()
+    else:
+        common.panic(f"Unknown server {server}")
+
+
 if __name__ == '__main__':
-    # dynamically load available models and muted characters, differ from the ones in config.py
-    app.run(debug=False, host='192.168.1.7', port=2731)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="AIDub Middleware")
+    parser.add_argument("--server", type=str, choices=["flask", "waitress", "gunicorn"], default=config.middleware_server, help=f"Server to run the middleware with (default: {config.middleware_server})")
+    parser.add_argument("--host", type=str, default=config.middleware_host, help=f"Address to listen on (default: {config.middleware_host})")
+    parser.add_argument("--port", type=int, default=config.middleware_port, help=f"Port to listen on (default: {config.middleware_port})")
+    parser.add_argument("--workers", type=int, default=config.middleware_workers, help=f"Number of processes, gunicorn only (default: {config.middleware_workers})")
+    parser.add_argument("--threads", type=int, default=config.middleware_threads, help=f"Number of request threads per process (default: {config.middleware_threads})")
+    args = parser.parse_args()
+    serve(args.server, args.host, args.port, args.workers, args.threads)
\ No newline at end of file
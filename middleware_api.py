@@ -10,6 +10,7 @@ Open-source under the MIT license.
 
 import requests
 import typing
+import time
 import os
 
 import urllib.parse
@@ -32,6 +33,13 @@ class AIDubMiddlewareAPI():
             raise AIDubAPIError(resp_json["data"])
         
         
+    def wait_legacy(self, data: typing.Any) -> typing.Any:
+        # the long-running routes queue a job and return its id, unless the server runs them in the request
+        if isinstance(data, dict) and "job_id" in data:
+            return self.wait_job(data["job_id"])
+        return data
+        
+        
     def info(self):
         try:
             response = requests.post(self.url + "/info")
@@ -44,7 +52,7 @@ class AIDubMiddlewareAPI():
         try:
             response = requests.post(self.url + "/download_dataset", json={"char_names": char_names, "sources_to_fetch": sources_to_fetch}, timeout=None)
             x = response.json()
-            return self.data_if_ok_else_raise_error(x)
+            return self.wait_legacy(self.data_if_ok_else_raise_error(x))
         except requests.exceptions.RequestException as e:
             raise AIDubAPIError(e)
             # raise e
@@ -53,7 +61,7 @@ class AIDubMiddlewareAPI():
     def emotion_classification(self):
         try:
             response = requests.post(self.url + "/emotion_classification", timeout=None)
-            return self.data_if_ok_else_raise_error(response.json())
+            return self.wait_legacy(self.data_if_ok_else_raise_error(response.json()))
         except requests.exceptions.RequestException as e:
             raise AIDubAPIError(e)
         
@@ -75,7 +83,7 @@ class AIDubMiddlewareAPI():
     def data_preprocessing_get_text(self):
         try:
             response = requests.post(self.url + "/gpt_sovits/dataset_preprocessing/get_text", timeout=None)
-            return self.data_if_ok_else_raise_error(response.json())
+            return self.wait_legacy(self.data_if_ok_else_raise_error(response.json()))
         except requests.exceptions.RequestException as e:
             raise AIDubAPIError(e)
         
@@ -83,7 +91,7 @@ class AIDubMiddlewareAPI():
     def data_preprocessing_get_hubert_wav32k(self):
         try:
             response = requests.post(self.url + "/gpt_sovits/dataset_preprocessing/get_hubert_wav32k", timeout=None)
-            return self.data_if_ok_else_raise_error(response.json())
+            return self.wait_legacy(self.data_if_ok_else_raise_error(response.json()))
         except requests.exceptions.RequestException as e:
             raise AIDubAPIError(e)
         
@@ -92,7 +100,7 @@ class AIDubMiddlewareAPI():
     def data_preprocessing_name_to_semantic(self):
         try:
             response = requests.post(self.url + "/gpt_sovits/dataset_preprocessing/name_to_semantic", timeout=None)
-            return self.data_if_ok_else_raise_error(response.json())
+            return self.wait_legacy(self.data_if_ok_else_raise_error(response.json()))
         except requests.exceptions.RequestException as e:
             raise AIDubAPIError(e)
         
@@ -101,7 +109,7 @@ class AIDubMiddlewareAPI():
     def train_model_gpt(self, batch_size: int = None, total_epoch: int = 15):
         try:
             response = requests.post(self.url + "/gpt_sovits/train_model_gpt", json={"batch_size": batch_size, "total_epoch": total_epoch}, timeout=None)
-            return self.data_if_ok_else_raise_error(response.json())
+            return self.wait_legacy(self.data_if_ok_else_raise_error(response.json()))
         except requests.exceptions.RequestException as e:
             raise AIDubAPIError(e)
         
@@ -110,6 +118,63 @@ class AIDubMiddlewareAPI():
     def train_model_sovits(self, batch_size: int = None, total_epoch: int = 15):
         try:
             response = requests.post(self.url + "/gpt_sovits/train_model_sovits", json={"batch_size": batch_size, "total_epoch": total_epoch}, timeout=None)
+            return self.wait_legacy(self.data_if_ok_else_raise_error(response.json()))
+        except requests.exceptions.RequestException as e:
+            raise AIDubAPIError(e)
+        
+        
+    # background jobs, see `jobs.py`
+    def submit_job(self, kind: str, params: dict[str, typing.Any] = None) -> str:
+        try:
+            response = requests.post(self.url + "/jobs", json={"kind": kind, "params": params or {}})
+            return self.data_if_ok_else_raise_error(response.json())["job_id"]
+        except requests.exceptions.RequestException as e:
+            raise AIDubAPIError(e)
+        
+        
+    def list_jobs(self) -> list[dict[str, typing.Any]]:
+        try:
+            response = requests.post(self.url + "/jobs/list")
+            return self.data_if_ok_else_raise_error(response.json())
+        except requests.exceptions.RequestException as e:
+            raise AIDubAPIError(e)
+        
+        
+    def job_status(self, job_id: str) -> dict[str, typing.Any]:
+        try:
+            response = requests.post(self.url + f"/jobs/{job_id}")
+            return self.data_if_ok_else_raise_error(response.json())
+        except requests.exceptions.RequestException as e:
+            raise AIDubAPIError(e)
+        
+        
+    def job_log(self, job_id: str, since: int = 0) -> dict[str, typing.Any]:
+        try:
+            response = requests.post(self.url + f"/jobs/{job_id}/log", params={"since": since})
             return self.data_if_ok_else_raise_error(response.json())
         except requests.exceptions.RequestException as e:
-            raise AIDubAPIError(e)
\ No newline at end of file
+            raise AIDubAPIError(e)
+        
+        
+    def cancel_job(self, job_id: str) -> dict[str, typing.Any]:
+        try:
+            response = requests.post(self.url + f"/jobs/{job_id}/cancel")
+            return self.data_if_ok_else_raise_error(response.json())
+        except requests.exceptions.RequestException as e:
+            raise AIDubAPIError(e)
+        
+        
+    def wait_job(self, job_id: str, poll_interval: float = 2, timeout: float = None) -> typing.Any:
+        """
+        Poll a job until it finishes, and return its result. Raises AIDubAPIError if the job did not succeed.
+        """
+        start = time.time()
+        while True:
+            status = self.job_status(job_id)
+            if status["state"] == "succeeded":
+                return status["result"]
+            if status["state"] in ("failed", "cancelled", "interrupted"):
+                raise AIDubAPIError(status["error"] or f"Job {job_id} {status['state']}")
+            if timeout is not None and time.time() - start > timeout:
+                raise AIDubAPIError(f"Timed out waiting for job {job_id}")
+            time.sleep(poll_interval)
@@ -0,0 +1,189 @@
+"""
+Shared model registry for AIDub.
+
+Models are registered with a loader and only built on first use, so importing a module
+which declares models does not pay for torch or transformers. The server may pre-warm
+selected models in a background thread at startup, see `config.prewarm_models`.
+"""
+
+import time
+import typing
+import threading
+
+import common
+
+
+class ModelEntry():
+    """
+    A registered model.
+
+    Attributes:
+        name (str): Name of the model.
+        loader (typing.Callable[[], typing.Any]): Builds the model, heavy imports belong inside it.
+        model (typing.Any): The model once loaded.
+        state (str): One of "unloaded", "loading", "loaded" and "failed".
+        load_seconds (float | None): Time taken to load the model.
+        memory_bytes (int | None): Size of the parameters and buffers of the model.
+        error (str | None): Why the last load failed.
+    """
+
+    def __init__(self, name: str, loader: typing.Callable[[], typing.Any]) -> None:
+        self.name = name
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.model = None
+        self.state = "unloaded"
+        self.load_seconds: float | None = None
+        self.memory_bytes: int | None = None
+        self.error: str | None = None
+
+
+def get_device() -> str:
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def measure_memory(model: typing.Any) -> int | None:
+    """
+    Size of the parameters and buffers of a torch module, or of the module behind a pipeline.
+
+    Args:
+        model (typing.Any): The model.
+
+    Returns:
+        int | None: The size in bytes, or None if the model is not a torch module.
+    """
+    module = getattr(model, 'model', model)
+    if not hasattr(module, 'parameters'):
+        return None
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry():
+    """
+    Model registry class.
+
+    Methods:
+        register(name: str, loader: typing.Callable[[], typing.Any]) -> None: Declare a model without loading it.
+        get(name: str) -> typing.Any: The model, loaded on first use.
+        prewarm(names: list[str]) -> threading.Thread: Load the given models in a background thread.
+        unload(name: str) -> None: Drop a loaded model.
+        status() -> dict[str, dict[str, typing.Any]]: Load state and memory of every model.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries: dict[str, ModelEntry] = {}
+
+
+    def register(self, name: str, loader: typing.Callable[[], typing.Any]) -> None:
+        with self.lock:
+            if name not in self.entries:
+                self.entries[name] = ModelEntry(name, loader)
+            else:
+                self.entries[name].loader = loader
+
+
+    def entry(self, name: str) -> ModelEntry:
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None:
+            common.panic(f"Model {name} is not registered")
+        return entry
+
+
+    def get(self, name: str) -> typing.Any:
+        """
+        Get a model, loading it on first use. Concurrent callers wait for the same load.
+
+        Args:
+            name (str): Name of the model.
+
+        Returns:
+            typing.Any: The model.
+        """
+        entry = self.entry(name)
+        if entry.model is not None:
+            return entry.model
+        with entry.lock:
+            if entry.model is not None:
+                return entry.model
+            common.log(f"Loading model {name}")
+            entry.state = "loading"
+            start = time.time()
+            try:
+                model = entry.loader()
+            except Exception as e:
+                entry.state = "failed"
+                entry.error = str(e)
+                raise
+            entry.load_seconds = time.time() - start
+            try:
+                entry.memory_bytes = measure_memory(model)
+            except Exception:
+                entry.memory_bytes = None
+            entry.model = model
+            entry.state = "loaded"
+            entry.error = None
+            common.log(f"Loaded model {name} in {entry.load_seconds:.2f}s")
+            return model
+
+
+    def prewarm(self, names: list[str]) -> threading.Thread:
+        """
+        Load the given models in a background thread, failures are logged.
+
+        Args:
+            names (list[str]): Names of the models.
+
+        Returns:
+            threading.Thread: The warm-up thread.
+        """
+        def warm():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    common.log(f"Failed to pre-warm model {name} due to {e}")
+
+        thread = threading.Thread(target=warm, daemon=True)
+        thread.start()
+        return thread
+
+
+    def unload(self, name: str) -> None:
+        entry = self.entry(name)
+        with entry.lock:
+            entry.model = None
+            entry.state = "unloaded"
+            entry.memory_bytes = None
+
+
+    def status(self) -> dict[str, dict[str, typing.Any]]:
+        with self.lock:
+            entries = list(self.entries.values())
+        return {e.name: {
+            "state": e.state,
+            "load_seconds": e.load_seconds,
+            "memory_bytes": e.memory_bytes,
+            "error": e.error,
+        } for e in entries}
+
+
+registry: ModelRegistry = None
+registry_lock = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    """
+    Get the process-wide model registry.
+
+    Returns:
+        ModelRegistry: The model registry.
+    """
+    global registry
+    with registry_lock:
+        if registry is None:
+            registry = ModelRegistry()
+        return registry
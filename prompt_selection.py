@@ -0,0 +1,219 @@
+"""
+Reference prompt selection engine for AIDub.
+
+For every character and emotion, the candidates of the sentiment analysis store whose
+duration fits the GPT-SoVITs reference window are precomputed once, sorted by score
+and turned into an alias table, so that a weighted random draw takes O(1). Pools are
+rebuilt per character, only when the dataset manifest or the analysis store changed
+for that character.
+
+Selection always terminates, falling back in order to:
+
+1. the pool of the requested emotion,
+2. the pool of every emotion of the character,
+3. every dataset sample of the character within the reference window,
+4. the dataset sample of the character closest to the reference window.
+"""
+
+import random
+import typing
+import threading
+
+import common
+import audio_index
+import manifest_store
+import analysis_store
+
+
+# reference window of GPT-SoVITs, in seconds
+min_prompt_duration = 4
+max_prompt_duration = 9
+
+
+class Candidate(typing.NamedTuple):
+    sample: manifest_store.Sample
+    score: float
+    duration: float
+
+
+class CandidatePool():
+    """
+    Candidates sorted by descending score, with an alias table for weighted draws.
+    """
+
+    def __init__(self, candidates: list[Candidate]) -> None:
+        self.candidates = sorted(candidates, key=lambda c: c.score, reverse=True)
+        self.prob: list[float] = []
+        self.alias: list[int] = []
+        self.build_alias_table([c.score for c in self.candidates])
+
+
+    def build_alias_table(self, weights: list[float]) -> None:
+        # Vose's alias method
+        n = len(weights)
+        total = sum(weights)
+        if n == 0 or total <= 0:
+            self.prob, self.alias = [1.0] * n, list(range(n))
+            return
+        scaled = [w * n / total for w in weights]
+        self.prob, self.alias = [0.0] * n, [0] * n
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            self.prob[i], self.alias[i] = 1.0, i
+
+
+    def __len__(self) -> int:
+        return len(self.candidates)
+
+
+    def draw(self, rng: random.Random) -> Candidate:
+        i = rng.randrange(len(self.candidates))
+        return self.candidates[i] if rng.random() < self.prob[i] else self.candidates[self.alias[i]]
+
+
+class CharacterPools(typing.NamedTuple):
+    # hash of the samples of the character, and its generation in the analysis store
+    signature: tuple[int, int]
+    by_emotion: dict[str, CandidatePool]
+    all_emotions: CandidatePool
+    dataset: CandidatePool
+    closest: manifest_store.Sample | None
+
+
+class PromptSelector():
+    """
+    Prompt selector class.
+
+    Methods:
+        refresh() -> None: Rebuild the pools of the characters whose data changed.
+        choose(char: str, label: str | None = None, rng: random.Random = None) -> Candidate | None: Draw a reference prompt.
+        top(char: str, label: str, k: int) -> list[Candidate]: Best scored candidates of an emotion.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pools: dict[str, CharacterPools] = {}
+        self.generations: tuple[int, int] = (-1, -1)
+
+
+    def duration(self, sample: manifest_store.Sample) -> float | None:
+        # recorded in the manifest when it was written, the audio index otherwise
+        if sample.duration is not None:
+            return sample.duration
+        try:
+            return audio_index.get_index().duration(sample.dest)
+        except Exception as e:
+            common.log(f"Failed to read duration of {sample.dest}: {e}, ignoring")
+            return None
+
+
+    def build(self, char: str, samples: list[manifest_store.Sample], analysis: dict[str, list[analysis_store.AnalysisEntry]], signature: tuple[int, int]) -> CharacterPools:
+        in_window = lambda d: d is not None and min_prompt_duration <= d <= max_prompt_duration
+        durations = {s.hash_id: self.duration(s) for s in samples}
+        by_hash = {s.hash_id: s for s in samples}
+
+        by_emotion = {}
+        everything = []
+        for label, entries in analysis.items():
+            candidates = []
+            for entry in entries:
+                sample = by_hash.get(entry.hash_id)
+                if sample is not None and in_window(durations[sample.hash_id]):
+                    candidates.append(Candidate(sample, entry.score, durations[sample.hash_id]))
+            by_emotion[label] = CandidatePool(candidates)
+            everything.extend(candidates)
+
+        # dataset samples are drawn uniformly
+        dataset = [Candidate(s, 1.0, durations[s.hash_id]) for s in samples if in_window(durations[s.hash_id])]
+        measured = [s for s in samples if durations[s.hash_id] is not None]
+        center = (min_prompt_duration + max_prompt_duration) / 2
+        closest = min(measured, key=lambda s: abs(durations[s.hash_id] - center)) if measured else None
+
+        common.log(f"Built prompt pools for {char}: {len(dataset)} of {len(samples)} samples within {min_prompt_duration}-{max_prompt_duration}s")
+        return CharacterPools(signature, by_emotion, CandidatePool(everything), CandidatePool(dataset), closest)
+
+
+    def refresh(self) -> None:
+        store = manifest_store.get_store()
+        analysis = analysis_store.get_store()
+        generations = (store.generation, analysis.generation())
+        if generations == self.generations:
+            return
+
+        with self.lock:
+            if generations == self.generations:
+                return
+            pools = {}
+            char_generations = analysis.char_generations()
+            for char in store.characters():
+                samples = store.samples(char)
+                # the rows of a character are only read again when its own generation moved
+                signature = (hash(tuple((s.hash_id, s.dest) for s in samples)), char_generations.get(char, 0))
+                previous = self.pools.get(char)
+                if previous is not None and previous.signature == signature:
+                    pools[char] = previous
+                else:
+                    pools[char] = self.build(char, samples, analysis.entries(char), signature)
+            self.pools = pools
+            self.generations = generations
+
+
+    def choose(self, char: str, label: str | None = None, rng: random.Random = None) -> Candidate | None:
+        """
+        Draw a reference prompt, weighted by score, going down the fallback chain if needed.
+
+        Args:
+            char (str): The character.
+            label (str | None, optional): The wanted emotion. Defaults to None.
+            rng (random.Random, optional): The random generator to draw with. Defaults to a fresh one.
+
+        Returns:
+            Candidate | None: The chosen candidate, or None if the character has no sample at all.
+        """
+        self.refresh()
+        rng = rng if rng is not None else random.Random()
+        pools = self.pools.get(char)
+        if pools is None:
+            return None
+
+        chain = [pools.by_emotion.get(label)] if label is not None else []
+        chain += [pools.all_emotions, pools.dataset]
+        for pool in chain:
+            if pool is not None and len(pool) > 0:
+                return pool.draw(rng)
+
+        if pools.closest is not None:
+            common.log(f"No prompt of {char} within {min_prompt_duration}-{max_prompt_duration}s, using the closest one")
+            return Candidate(pools.closest, 0.0, self.duration(pools.closest))
+        return None
+
+
+    def top(self, char: str, label: str, k: int) -> list[Candidate]:
+        self.refresh()
+        pools = self.pools.get(char)
+        pool = pools.by_emotion.get(label) if pools is not None else None
+        return pool.candidates[:k] if pool is not None else []
+
+
+selector: PromptSelector = None
+selector_lock = threading.Lock()
+
+
+def get_selector() -> PromptSelector:
+    """
+    Get the process-wide prompt selector, its pools are built on first use.
+
+    Returns:
+        PromptSelector: The prompt selector.
+    """
+    global selector
+    with selector_lock:
+        if selector is None:
+            selector = PromptSelector()
+        return selector
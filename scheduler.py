@@ -0,0 +1,230 @@
+"""
+Batched dubbing scheduler for AIDub.
+
+Builds a work queue from `dub_manifest.json`, groups the lines by the `(ckpt, pth)`
+pair they need, skips the lines found in the dub cache before any model is loaded,
+and keeps a bounded number of tts requests in flight for each loaded model.
+Groups are dubbed concurrently across the backends of the inference pool.
+"""
+
+import time
+import typing
+import asyncio
+import threading
+import concurrent.futures
+
+import common
+import config
+import dub
+import dub_cache
+import GPTSoVits
+import inference_pool
+
+
+class DubJob(typing.NamedTuple):
+    char: str
+    text: str
+    prompt: tuple[str, str]
+    key: str
+    dest: str | None
+
+
+class DubScheduler():
+    """
+    Dub scheduler class.
+
+    Attributes:
+        max_inflight (int): Maximum number of tts requests in flight for each loaded model.
+        dubbed (int): Number of lines synthesized in the last run.
+        skipped (int): Number of lines found in the dub cache in the last run.
+        failed (int): Number of lines failed in the last run.
+
+    Methods:
+        build_work_queue(collection: dict[str, list[str]]) -> tuple[dict[tuple[str, str], list[DubJob]], list[DubJob]]: Group the pending lines by model and collect the finished ones.
+        run(collection: dict[str, list[str]]) -> dict[str, dict[str, dict[str, str]]]: Dub the whole collection and return the dub result manifest.
+    """
+
+    def __init__(self, max_inflight: int = None) -> None:
+        """
+        Initialize the DubScheduler.
+
+        Args:
+            max_inflight (int, optional): Maximum number of tts requests in flight for each loaded model. Defaults to `config.dub_max_inflight`.
+        """
+        self.max_inflight = max_inflight if max_inflight is not None else config.dub_max_inflight
+        self.pool = inference_pool.get_pool()
+        self.lock = threading.Lock()
+        self.dubbed = 0
+        self.skipped = 0
+        self.failed = 0
+
+
+    def build_work_queue(self, collection: dict[str, list[str]]) -> tuple[dict[tuple[str, str], list[DubJob]], list[DubJob]]:
+        """
+        Build the work queue from the dub manifest.
+
+        Args:
+            collection (dict[str, list[str]]): The dub manifest, mapping characters to their lines.
+
+        Returns:
+            tuple[dict[tuple[str, str], list[DubJob]], list[DubJob]]: The pending jobs grouped by `(ckpt, pth)` pair, and the jobs already in the dub cache.
+        """
+        groups: dict[tuple[str, str], list[DubJob]] = {}
+        done: list[DubJob] = []
+        queued = set()
+        for char in collection:
+            models = tuple(dub.get_tts_models(char))
+            for text in collection[char]:
+                if (char, text) in queued:
+                    continue
+                queued.add((char, text))
+                # the remembered prompt of the line is looked up before any prompt selection
+                prompt, key, dest = dub.lookup_line(text, char)
+                job = DubJob(char, text, prompt, key, dest)
+                if dest is not None:
+                    done.append(job)
+                else:
+                    groups.setdefault(models, []).append(job)
+        return groups, done
+
+
+    def run_group(self, ckpt: str, pth: str, jobs: list[DubJob]) -> list[DubJob]:
+        """
+        Dub all the lines that need a model, routing each request through the inference pool.
+
+        Args:
+            ckpt (str): Path to the GPT checkpoint.
+            pth (str): Path to the SoVITS weights.
+            jobs (list[DubJob]): The jobs to dub.
+
+        Returns:
+            list[DubJob]: The jobs dubbed successfully.
+        """
+        workers = self.max_inflight * len(self.pool.backends)
+        finished = []
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures: dict[concurrent.futures.Future, DubJob] = {}
+            for job in jobs:
+                common.log(f"Dubbing {job.text} for {job.char}")
+                futures[executor.submit(self.synthesize, job, ckpt, pth)] = job
+            finished.extend(self.collect(futures, concurrent.futures.ALL_COMPLETED))
+
+        elapsed = time.time() - start
+        common.log(f"Dubbed {len(finished)} lines with {ckpt} in {elapsed:.2f}s ({len(finished) / max(elapsed, 1e-6):.2f} lines/s)")
+        return finished
+
+
+    def synthesize(self, job: DubJob, ckpt: str, pth: str) -> str:
+        with self.pool.lease(ckpt, pth) as client:
+            return dub.synthesize_one(job.text, job.char, job.prompt, job.key, client)
+
+
+    def run_group_async(self, ckpt: str, pth: str, jobs: list[DubJob]) -> list[DubJob]:
+        """
+        Dub all the lines that need a model through the asyncio client, on a single leased backend.
+
+        Args:
+            ckpt (str): Path to the GPT checkpoint.
+            pth (str): Path to the SoVITS weights.
+            jobs (list[DubJob]): The jobs to dub.
+
+        Returns:
+            list[DubJob]: The jobs dubbed successfully.
+        """
+        tts_requests = [GPTSoVits.TTSRequest(job.prompt[1], job.prompt[0], job.text, 'auto', dub.text_language) for job in jobs]
+        cache = dub_cache.get_cache()
+
+        async def run(api_url: str) -> tuple[list[DubJob], dict[str, dict[str, float]]]:
+            finished = []
+            async with GPTSoVits.AsyncGPTSoVitsAPI(api_url, True, ckpt, pth, self.max_inflight) as client:
+                async for index, resp in client.tts_many(tts_requests):
+                    job = jobs[index]
+                    if isinstance(resp, Exception) or resp.status_code != 200:
+                        common.log(f"Failed to dub {job.text} for {job.char}: {resp if isinstance(resp, Exception) else resp.text}, ignoring")
+                        with self.lock:
+                            self.failed += 1
+                        continue
+                    dest = cache.store(job.key, resp.content, job.char, job.text)
+                    finished.append(job._replace(dest=dest))
+                    with self.lock:
+                        self.dubbed += 1
+                return finished, client.latency_stats()
+
+        start = time.time()
+        # lease a whole backend for the group, the async client keeps max_inflight requests on it
+        with self.pool.lease(ckpt, pth, self.max_inflight) as client:
+            finished, stats = asyncio.run(run(client.api_url))
+        elapsed = time.time() - start
+        common.log(f"Dubbed {len(finished)} lines with {ckpt} in {elapsed:.2f}s ({len(finished) / max(elapsed, 1e-6):.2f} lines/s)")
+        common.log(f"Client latency: {stats}")
+        return finished
+
+
+    def collect(self, futures: dict[concurrent.futures.Future, DubJob], return_when: str) -> list[DubJob]:
+        """
+        Wait for the pending futures and pop the finished ones.
+
+        Args:
+            futures (dict[concurrent.futures.Future, DubJob]): The pending futures, mutated in place.
+            return_when (str): When to return, as for `concurrent.futures.wait`.
+
+        Returns:
+            list[DubJob]: The jobs dubbed successfully.
+        """
+        done, _ = concurrent.futures.wait(list(futures.keys()), return_when=return_when)
+        finished = []
+        for future in done:
+            job = futures.pop(future)
+            try:
+                finished.append(job._replace(dest=future.result()))
+                with self.lock:
+                    self.dubbed += 1
+            except Exception as e:
+                common.log(f"Failed to dub {job.text} for {job.char}: {e}, ignoring")
+                with self.lock:
+                    self.failed += 1
+        return finished
+
+
+    def run(self, collection: dict[str, list[str]]) -> dict[str, dict[str, dict[str, str]]]:
+        """
+        Dub the whole collection, loading each model once.
+
+        Args:
+            collection (dict[str, list[str]]): The dub manifest, mapping characters to their lines.
+
+        Returns:
+            dict[str, dict[str, dict[str, str]]]: The dub result manifest.
+        """
+        self.dubbed, self.skipped, self.failed = 0, 0, 0
+        groups, done = self.build_work_queue(collection)
+        self.skipped = len(done)
+        total = sum(len(jobs) for jobs in groups.values())
+        common.log(f"Scheduled {total} lines across {len(groups)} models, {len(done)} lines already dubbed")
+
+        start = time.time()
+        finished = list(done)
+        run_group = self.run_group_async if config.dub_client == 'async' else self.run_group
+        # largest groups first, so that the backends stay busy until the end
+        ordered = sorted(groups.items(), key=lambda item: len(item[1]), reverse=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.pool.backends)) as executor:
+            for result in executor.map(lambda item: run_group(item[0][0], item[0][1], item[1]), ordered):
+                finished.extend(result)
+        elapsed = time.time() - start
+        common.log(f"Dubbed {self.dubbed} lines in {elapsed:.2f}s ({self.dubbed / max(elapsed, 1e-6):.2f} lines/s), {self.skipped} skipped, {self.failed} failed")
+        for backend in self.pool.backends:
+            common.log(f"Backend {backend.api_url}: served {backend.served}, latency {backend.client.latency_stats()}")
+        dub_cache.get_cache().save()
+        common.log(f"Dub cache: {dub_cache.get_cache().stats()}")
+
+        dub_result_manifest = {}
+        for job in finished:
+            if dub_result_manifest.get(job.char) is None:
+                dub_result_manifest[job.char] = {}
+            dub_result_manifest[job.char][job.key] = {
+                "dest": job.dest,
+                "text": job.text,
+                "label": job.key
+            }
+        return dub_result_manifest
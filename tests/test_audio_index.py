@@ -0,0 +1,108 @@
+import io
+import struct
+
+import pytest
+
+import audio_index
+
+
+# MPEG1 layer III, 128 kbps, 44100 Hz, no padding
+stereo_header = 0xFFFB9000
+mono_header = stereo_header | 0b11 << 6
+frame_length = 144 * 128000 // 44100
+
+
+def frame(header: int = stereo_header, tag: bytes = b'', tag_offset: int = 0) -> bytes:
+    body = bytearray(frame_length - 4)
+    body[tag_offset:tag_offset + len(tag)] = tag
+    return struct.pack('>I', header) + bytes(body)
+
+
+def probe_mp3(data: bytes) -> audio_index.AudioInfo | None:
+    return audio_index.probe_mp3(io.BytesIO(data), len(data))
+
+
+def id3(size: int) -> bytes:
+    # ID3v2 header, the size is syncsafe
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b'ID3\x03\x00\x00' + syncsafe + b'\x00' * size
+
+
+def test_parse_frame_header():
+    assert audio_index.parse_frame_header(frame(), 0) == (0b11, 3, 9, 0, 0b00, frame_length)
+    assert audio_index.parse_frame_header(b'\xff\xfb\xf0\x00', 0) is None  # bad bitrate index
+    assert audio_index.parse_frame_header(b'\xff\xfb\x9c\x00', 0) is None  # reserved sample rate
+    assert audio_index.parse_frame_header(b'\xff\xfb', 0) is None
+
+
+def test_cbr_duration_from_the_stream_size():
+    info = probe_mp3(frame() * 100)
+    assert info.sample_rate == 44100 and info.channels == 2
+    assert info.duration == pytest.approx(100 * frame_length * 8 / 128000)
+
+
+def test_id3v2_and_id3v1_tags_are_not_counted():
+    data = id3(2000) + frame() * 100 + b'TAG' + b'\x00' * 125
+    assert probe_mp3(data).duration == pytest.approx(100 * frame_length * 8 / 128000)
+
+
+def test_xing_frame_count():
+    # mono MPEG1, the tag follows 17 bytes of side info
+    xing = b'Xing' + struct.pack('>II', 0x1, 1000)
+    data = frame(mono_header, xing, 17) + frame(mono_header) * 5
+    info = probe_mp3(data)
+    assert info.channels == 1
+    assert info.duration == pytest.approx(1000 * 1152 / 44100)
+
+
+def test_info_tag_without_frame_count_falls_back_to_cbr():
+    info_tag = b'Info' + struct.pack('>I', 0x0)
+    data = frame(stereo_header, info_tag, 32) + frame() * 9
+    assert probe_mp3(data).duration == pytest.approx(10 * frame_length * 8 / 128000)
+
+
+def test_vbri_frame_count():
+    vbri = b'VBRI' + b'\x00' * 10 + struct.pack('>I', 500)
+    data = frame(stereo_header, vbri, 32) + frame() * 5
+    assert probe_mp3(data).duration == pytest.approx(500 * 1152 / 44100)
+
+
+def test_stray_sync_is_not_a_stream():
+    # a frame sync with no second frame after it
+    data = b'\x00' * 100 + struct.pack('>I', stereo_header) + b'\x01' * 2000
+    assert probe_mp3(data) is None
+
+
+def wav(sample_rate: int, channels: int, bits: int, frames: int, extra_chunk: bytes = b'', data_size: int = None) -> bytes:
+    block = channels * bits // 8
+    fmt = struct.pack('<HHIIHH', 1, channels, sample_rate, sample_rate * block, block, bits)
+    data = b'\x00' * (frames * block)
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + extra_chunk
+    body += b'data' + struct.pack('<I', len(data) if data_size is None else data_size) + data
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def probe_wav(data: bytes) -> audio_index.AudioInfo | None:
+    return audio_index.probe_wav(io.BytesIO(data), len(data))
+
+
+def test_wav_duration():
+    assert probe_wav(wav(16000, 1, 16, 32000)) == audio_index.AudioInfo(2.0, 16000, 1, len(wav(16000, 1, 16, 32000)))
+
+
+def test_wav_odd_chunks_are_padded():
+    # a 3 byte LIST chunk is followed by a pad byte
+    extra = b'LIST' + struct.pack('<I', 3) + b'abc' + b'\x00'
+    info = probe_wav(wav(44100, 2, 16, 44100, extra))
+    assert info.duration == pytest.approx(1.0)
+    assert info.channels == 2
+
+
+def test_wav_unset_data_size_is_bounded_by_the_file():
+    info = probe_wav(wav(8000, 1, 8, 4000, data_size=0xFFFFFFFF))
+    assert info.duration == pytest.approx(0.5)
+
+
+def test_not_a_wav():
+    assert probe_wav(b'OggS' + b'\x00' * 40) is None
+    assert probe_wav(wav(8000, 1, 8, 10)[:30]) is None
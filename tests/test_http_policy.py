@@ -0,0 +1,164 @@
+import email.utils
+
+import pytest
+
+import config
+import http_policy
+
+
+class Clock():
+    # monotonic clock and sleep of the policy, advanced by hand
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(http_policy.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(http_policy.time, "sleep", clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def policy(monkeypatch, clock):
+    monkeypatch.setattr(config, "http_circuit_threshold", 3)
+    monkeypatch.setattr(config, "http_circuit_cooldown", 30)
+    monkeypatch.setattr(config, "http_circuit_max_wait", 60)
+    monkeypatch.setattr(config, "http_backoff_base", 1)
+    monkeypatch.setattr(config, "http_backoff_cap", 20)
+    # the full jitter always draws its upper bound
+    monkeypatch.setattr(http_policy.random, "uniform", lambda low, high: high)
+    return http_policy.HttpPolicy()
+
+
+def test_token_bucket_allows_a_burst_then_paces(clock):
+    host = http_policy.HostPolicy("example.com", rate=2.0, burst=3.0)
+    assert [host.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert host.reserve() == pytest.approx(0.5)
+    assert host.reserve() == pytest.approx(1.0)
+
+
+def test_token_bucket_refills_up_to_its_burst(clock):
+    host = http_policy.HostPolicy("example.com", rate=2.0, burst=3.0)
+    for _ in range(3):
+        host.reserve()
+    clock.now += 100
+    assert [host.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert host.reserve() == pytest.approx(0.5)
+
+
+def test_parse_retry_after():
+    assert http_policy.parse_retry_after("120") == 120.0
+    assert http_policy.parse_retry_after(None) is None
+    assert http_policy.parse_retry_after("soon") is None
+    assert http_policy.parse_retry_after(email.utils.formatdate(0, usegmt=True)) == 0.0
+    in_a_minute = email.utils.formatdate(http_policy.time.time() + 60, usegmt=True)
+    assert 55 <= http_policy.parse_retry_after(in_a_minute) <= 60
+
+
+def test_check_status():
+    http_policy.check_status(404, {}, "http://example.com")
+    with pytest.raises(http_policy.RetryableError) as error:
+        http_policy.check_status(429, {"Retry-After": "7"}, "http://example.com")
+    assert error.value.retry_after == 7.0
+
+
+def test_backoff_honours_retry_after(policy, monkeypatch):
+    assert policy.backoff(0) == 1
+    assert policy.backoff(3) == 8
+    assert policy.backoff(10) == 20
+    # jitter may draw 0, the host still gets the delay it asked for
+    monkeypatch.setattr(http_policy.random, "uniform", lambda low, high: low)
+    assert policy.backoff(0, retry_after=5) == 5
+    assert policy.backoff(0, retry_after=500) == 20
+
+
+def test_call_retries_with_retry_after(policy, clock):
+    answers = [http_policy.RetryableError("busy", retry_after=15), "page"]
+
+    def fetcher():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert policy.call("http://example.com/a", fetcher, max_retries=2) == "page"
+    assert 15 in clock.sleeps
+    assert policy.host("http://example.com").stats()["throttled"] == 1
+
+
+def test_call_raises_other_errors_at_once(policy):
+    calls = []
+
+    def fetcher():
+        calls.append(1)
+        raise ValueError("not json")
+
+    with pytest.raises(ValueError):
+        policy.call("http://example.com/a", fetcher, max_retries=5)
+    assert len(calls) == 1
+
+
+def test_circuit_opens_after_consecutive_failures(policy, clock):
+    def fetcher():
+        raise ConnectionError("refused")
+
+    with pytest.raises(http_policy.RetriesExhausted):
+        policy.call("http://example.com/a", fetcher, max_retries=2)
+    host = policy.host("http://example.com")
+    assert host.state == "open"
+    with pytest.raises(http_policy.CircuitOpen):
+        policy.call("http://example.com/b", lambda: "page", fail_fast=True)
+
+
+def test_circuit_probes_once_the_cooldown_is_over(policy, clock):
+    host = policy.host("http://example.com")
+    for _ in range(3):
+        host.record_failure(ConnectionError("refused"))
+    assert host.state == "open"
+
+    # waits for the cooldown, then goes through as the probe and closes the circuit
+    assert policy.call("http://example.com/a", lambda: "page") == "page"
+    assert sum(clock.sleeps) >= 30
+    assert host.state == "closed"
+
+
+def test_failed_probe_opens_the_circuit_again(policy, clock):
+    host = policy.host("http://example.com")
+    for _ in range(3):
+        host.record_failure(ConnectionError("refused"))
+    clock.now += 30
+    assert host.circuit_delay(0.0) == 0.0
+    assert host.state == "half-open"
+    # other requests wait for the probe
+    assert host.circuit_delay(0.0) == 1.0
+    host.record_failure(ConnectionError("refused"))
+    assert host.state == "open"
+    assert host.stats()["circuit_opens"] == 2
+
+
+def test_circuit_wait_is_bounded(policy, clock):
+    host = policy.host("http://example.com")
+    for _ in range(3):
+        host.record_failure(ConnectionError("refused"))
+    with pytest.raises(http_policy.CircuitOpen):
+        host.circuit_delay(60.0)
+
+
+def test_rate_limits_by_domain_suffix(policy, monkeypatch):
+    monkeypatch.setattr(config, "http_rate_limits", {"fandom.com": (5, 10), "static.fandom.com": (50, 100)})
+    monkeypatch.setattr(config, "http_default_rate_limit", (1, 1))
+    assert (policy.host("https://genshin.fandom.com/wiki").rate, policy.host("https://genshin.fandom.com/wiki").burst) == (5, 10)
+    assert policy.host("https://img.static.fandom.com/x.ogg").rate == 50
+    assert policy.host("https://example.org/").rate == 1
@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+import analysis_store
+import manifest_store
+import prompt_selection
+
+
+def table_masses(pool: prompt_selection.CandidatePool) -> list[float]:
+    # probability of drawing each candidate, read back from the alias table
+    n = len(pool.prob)
+    masses = [0.0] * n
+    for i in range(n):
+        masses[i] += pool.prob[i] / n
+        masses[pool.alias[i]] += (1.0 - pool.prob[i]) / n
+    return masses
+
+
+def candidate(hash_id: str, score: float, duration: float = 6.0) -> prompt_selection.Candidate:
+    sample = manifest_store.Sample(hash_id, "char", f"text {hash_id}", f"{hash_id}.mp3", None, duration)
+    return prompt_selection.Candidate(sample, score, duration)
+
+
+@pytest.mark.parametrize("scores", [[1.0], [0.5, 0.5], [0.9, 0.05, 0.05], [0.1, 0.2, 0.3, 0.4], [3.0, 1.0, 0.0, 2.0, 0.5]])
+def test_alias_table_matches_scores(scores):
+    pool = prompt_selection.CandidatePool([candidate(str(i), score) for i, score in enumerate(scores)])
+    expected = [c.score / sum(scores) for c in pool.candidates]
+    assert table_masses(pool) == pytest.approx(expected)
+
+
+def test_zero_scores_draw_uniformly():
+    pool = prompt_selection.CandidatePool([candidate(str(i), 0.0) for i in range(4)])
+    assert table_masses(pool) == pytest.approx([0.25] * 4)
+
+
+def test_candidates_are_sorted_by_score():
+    pool = prompt_selection.CandidatePool([candidate("a", 0.2), candidate("b", 0.9), candidate("c", 0.5)])
+    assert [c.sample.hash_id for c in pool.candidates] == ["b", "c", "a"]
+
+
+def test_draw_is_deterministic_and_follows_the_weights():
+    pool = prompt_selection.CandidatePool([candidate("heavy", 0.9), candidate("light", 0.1)])
+    draws = [pool.draw(random.Random(seed)).sample.hash_id for seed in range(2000)]
+    assert draws == [pool.draw(random.Random(seed)).sample.hash_id for seed in range(2000)]
+    assert 0.85 < draws.count("heavy") / len(draws) < 0.95
+
+
+def make_selector(samples: list[manifest_store.Sample], analysis: dict[str, list[analysis_store.AnalysisEntry]]) -> prompt_selection.PromptSelector:
+    selector = prompt_selection.PromptSelector()
+    selector.pools["char"] = selector.build("char", samples, analysis, (0, 0))
+    # pools are given, not read from the stores
+    selector.refresh = lambda: None
+    return selector
+
+
+def sample(hash_id: str, duration: float | None) -> manifest_store.Sample:
+    return manifest_store.Sample(hash_id, "char", f"text {hash_id}", f"{hash_id}.mp3", None, duration)
+
+
+def entry(hash_id: str, label: str, score: float) -> analysis_store.AnalysisEntry:
+    return analysis_store.AnalysisEntry("char", hash_id, label, score, f"text {hash_id}", f"{hash_id}.mp3", None)
+
+
+def test_requested_emotion_first():
+    samples = [sample("joy", 5.0), sample("sad", 6.0)]
+    selector = make_selector(samples, {"joy": [entry("joy", "joy", 0.9)], "sadness": [entry("sad", "sadness", 0.8)]})
+    for seed in range(20):
+        assert selector.choose("char", "sadness", random.Random(seed)).sample.hash_id == "sad"
+
+
+def test_falls_back_to_every_emotion():
+    samples = [sample("joy", 5.0), sample("plain", 6.0)]
+    selector = make_selector(samples, {"joy": [entry("joy", "joy", 0.9)]})
+    assert selector.choose("char", "anger", random.Random(0)).sample.hash_id == "joy"
+
+
+def test_falls_back_to_the_dataset():
+    # the only classified sample is too long to be a prompt
+    samples = [sample("long", 12.0), sample("plain", 6.0)]
+    selector = make_selector(samples, {"joy": [entry("long", "joy", 0.9)]})
+    chosen = selector.choose("char", "joy", random.Random(0))
+    assert chosen.sample.hash_id == "plain"
+    assert chosen.score == 1.0
+
+
+def test_falls_back_to_the_closest_sample():
+    samples = [sample("short", 2.0), sample("long", 10.0), sample("unknown", None)]
+    selector = make_selector(samples, {})
+    chosen = selector.choose("char", "joy", random.Random(0))
+    assert chosen.sample.hash_id == "long"
+    assert chosen.score == 0.0
+
+
+def test_unknown_character_or_no_sample():
+    selector = make_selector([sample("unknown", None)], {})
+    assert selector.choose("char", "joy", random.Random(0)) is None
+    assert selector.choose("nobody", "joy", random.Random(0)) is None
@@ -0,0 +1,37 @@
+import dub
+
+
+def test_short_text_is_one_segment():
+    assert dub.split_text("Hello there.", max_chars=50) == ["Hello there."]
+
+
+def test_sentences_are_packed_up_to_max_chars():
+    text = "One two. Three four. Five six. Seven eight."
+    assert dub.split_text(text, max_chars=22) == ["One two. Three four.", "Five six. Seven eight."]
+
+
+def test_segments_rejoin_to_the_text():
+    text = "First sentence here! Second one? Third; and the last one."
+    segments = dub.split_text(text, max_chars=25)
+    assert " ".join(segments) == text
+    assert all(len(segment) <= 25 for segment in segments)
+
+
+def test_long_sentence_is_split_at_clauses():
+    text = "a long clause, another long clause, and a third long clause."
+    assert dub.split_text(text, max_chars=20) == ["a long clause,", "another long clause,", "and a third long clause."]
+
+
+def test_clause_longer_than_max_chars_is_kept_whole():
+    text = "this clause is far longer than the limit"
+    assert dub.split_text(text, max_chars=10) == [text]
+
+
+def test_cjk_sentences_are_joined_without_spaces():
+    text = "你好。今天天气很好！我们出去吧。"
+    assert dub.split_text(text, max_chars=10) == ["你好。今天天气很好！", "我们出去吧。"]
+
+
+def test_empty_and_blank_text():
+    assert dub.split_text("", max_chars=10) == []
+    assert dub.split_text("   ", max_chars=10) == []
@@ -2,137 +2,40 @@ import asyncio
 import os
 import pathlib
 import subprocess
-
-import clint
-import requests
+import typing
 
 import common
 import config
 import fandom
+import audio_index
+import manifest_store
+import download_engine
 import json
-import threading
 
 def make_dirs():
     os.makedirs(config.save_dest_for_downloaded_voice, exist_ok=True)
 
-def download_task_wrapper(char: str, text: str, url: str):
-    def download_task():
-        out = pathlib.Path(config.save_dest_for_downloaded_voice) / char / f"{common.md5(text)}.mp3"
-        if out.exists() and not out.read_bytes().startswith(b"<?xml"):
-            
-            return
-        
-        if type(url) == dict:
-            os.rename(url['path'], str(out))
-        else:
-            r = requests.get(url, allow_redirects=True, stream=False, headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'})
-            if r.status_code == 403:
-                common.log(f"Failed to download {url} for {char} with status code {r.status_code}")
-                common.log(f"Skipping {char} for this time")
-                return
-            if r.status_code != 200:
-                common.log(f"Failed to download {url} for {char} with status code {r.status_code}")
-                raise Exception("Failed to download")
-            with open(out, 'wb+') as file:
-                total = int(r.headers.get('content-length'))
-                for i in clint.textui.progress.bar(r.iter_content(chunk_size=2391975), expected_size=(total / 1024) + 1):
-                    if i:
-                        file.write(i)
-    return common.request_retry_wrapper(lambda: download_task())
-
-
-def dispatch_download_task_with_fallback(char: str, text: str, furl: str, fallback_url: str, cache_path: str, index: int):
-    def download_task():
-        out = pathlib.Path(config.save_dest_for_downloaded_voice) / char / f"{common.md5(text)}.mp3"
-        url = furl
-        if out.exists() and not out.read_bytes().startswith(b"<?xml"):
-            return
-        
-        import time
-        pth = pathlib.Path(cache_path)
-        print(pth, pth.stat().st_mtime, time.time(), pth.stat().st_mtime > time.time() - 86400)
-        if pth.exists() and pth.stat().st_mtime > time.time() - 86400: # check whether the files modified today
-            # use cache to refresh url
-            try:
-                content = pth.read_text()
-                url = json.loads(content)['rows'][index]['row']['audio'][0]['src']
-                print(json.loads(content)['rows'][index], url)
-                assert url != ''
-            except:
-                # otherwise, use fallback url
-                print(f"Failed to load cache for {char}, using fallback url: {fallback_url}")
-                content = common.request_retry_wrapper(lambda: requests.get(fallback_url)).content
-                content = content.decode('utf-8')
-                pth.write_text(content)
-                url = json.loads(content)['rows'][index]['row']['audio'][0]['src']
-                print(json.loads(content)['rows'][index], url)
-                assert url != ''
-        else:
-            # otherwise, use fallback url
-            content = common.request_retry_wrapper(lambda: requests.get(fallback_url)).content
-            content = content.decode('utf-8')
-            pth.write_text(content)
-            url = json.loads(content)['rows'][index]['row']['audio'][0]['src']
-            print(json.loads(content)['rows'][index], url)
-            assert url != ''
-            
-        if type(url) == dict:
-            os.rename(url['path'], str(out))
-        else:
-            r = requests.get(url, allow_redirects=True, stream=False, headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'})
-            if r.status_code == 403:
-                common.log(f"Failed to download {url} for {char} with status code {r.status_code}")
-                common.log(f"Skipping {char} for this time")
-                return
-            if r.status_code != 200:
-                common.log(f"Failed to download {url} for {char} with status code {r.status_code}")
-                raise Exception("Failed to download")
-            with open(out, 'wb+') as file:
-                print(out, 'path')
-                total = int(r.headers.get('content-length'))
-                for i in clint.textui.progress.bar(r.iter_content(chunk_size=2391975), expected_size=(total / 1024) + 1):
-                    if i:
-                        file.write(i)
-    return common.request_retry_wrapper(lambda: download_task())
-
-
-def dispatch_download_task(char: str, text: str, url: str):
-    x = lambda: download_task_wrapper(char, text, url)
-    # common.run_in_parallel(, ())
-    x()
-
-
-def fetch_collection(collection: dict[str, list[tuple[str, str, str, str]]]):
+def fetch_collection(collection: dict[str, list[tuple[str, str, str, str]]], check_cancelled: typing.Callable[[], None] = None):
     make_dirs()
     for char in collection:
-        ths: list[threading.Thread] = []
         os.makedirs(pathlib.Path(config.save_dest_for_downloaded_voice) / char, exist_ok=True)
-        # seperate 8 list with same counts of elements
-        def split_list(lst, n):
-            common.log(f"{lst}")
-            return [lst[i:i+n] for i in range(0, len(lst), n)]
-        x = split_list(collection[char], 48)
-        
-        def dispatcher(lst):
-            for voice in lst:
-                # judge tuple size
-                if len(voice) == 5:
-                    text, url, fallback_url, cache_path, index = voice
-                    dispatch_download_task_with_fallback(char, text, url, fallback_url, cache_path, index)
-                else:
-                    text, url = voice
-                    dispatch_download_task(char, text, url)
-        for i in x:
-            ths.append(threading.Thread(target=dispatcher, args=(i,)))
-        for i in ths:
-            i.start()
-        for i in ths:
-            i.join()
+    # every character at once, the engine bounds the connections
+    download_engine.DownloadEngine().download_all(download_engine.tasks_from_collection(collection), check_cancelled)
+
+    # index the durations once, prompt selection reads them from the index
+    dests = []
+    for char in collection:
+        for voice in collection[char]:
+            dest = os.path.join(config.save_dest_for_downloaded_voice, char, f"{common.md5(voice[0])}.mp3")
+            if os.path.exists(dest):
+                dests.append(dest)
+    audio_index.get_index().build(dests)
 
 
 
 def serialize_collection(collection: dict[str, list[tuple[str, str, str, str]]]) -> str:
     result = {}
+    index = audio_index.get_index()
     for char in collection:
         for voice in collection[char]:
             label = common.md5(voice[0])
@@ -142,13 +45,18 @@ def serialize_collection(collection: dict[str, list[tuple[str, str, str, str]]])
                 text, url = voice
             if result.get(char) is None:
                 result[char] = {}
-            result[char][label] = {"text": text, "url": url, "dest": os.path.join(config.save_dest_for_downloaded_voice, char, f"{label}.mp3")}
+            dest = os.path.join(config.save_dest_for_downloaded_voice, char, f"{label}.mp3")
+            result[char][label] = {"text": text, "url": url, "dest": dest}
+            # indexed by `fetch_collection`, readers of the manifest get it without probing the file
+            if os.path.exists(dest):
+                try:
+                    result[char][label]["duration"] = index.duration(dest)
+                except Exception as e:
+                    common.log(f"Failed to read duration of {dest}: {e}, leaving it out of the manifest")
 
     # persist unicodes
     # merge with existing data
-    existing_data = {}
-    if pathlib.Path(config.dataset_manifest_file_dest).exists():
-        existing_data = json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text())
+    existing_data = manifest_store.get_store().to_dict()
     for char in list(existing_data.keys()) + list(result.keys()):
         if char in existing_data:
             if char in result:
@@ -160,7 +68,7 @@ def serialize_collection(collection: dict[str, list[tuple[str, str, str, str]]])
 
 def reduce_collection(collection: dict[str, list[tuple[str, str, str, str]]]) -> dict[str, list[tuple[str, str, str, str]]]:
     not_enough_data = []
-    former = json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text())
+    former = manifest_store.get_store().to_dict()
     for char in collection:
         # fetch 10 elements for each character
         save_keys = [i for i in collection[char]][0:300]
@@ -193,11 +101,11 @@ def reduce_collection_by_size(collection: dict[str, list[tuple[str, str, str, st
     return reduced_collection
     
 def generate_text_list(colab_project_prefix: pathlib.Path = pathlib.Path(config.save_dest_for_downloaded_voice)) -> list[str]:
-    collection = json.loads(pathlib.Path(config.dataset_manifest_file_dest).read_text())
-    for char in collection:
+    store = manifest_store.get_store()
+    for char in store.characters():
         generated = ""
-        for i in collection[char]:
-            text, dest = collection[char][i]['text'], collection[char][i]['dest']
+        for sample in store.samples(char):
+            text, dest = sample.text, sample.dest
             # vocal_path|speaker_name|language|text
             text = text.replace('\n', '')
             generated += f"{pathlib.Path(dest).name}|{char}|{common.extract_character_name(char)[1]}|{text}" + "\n"
@@ -1,11 +1,12 @@
 import json
 import requests
 import common
+import http_policy
 import config
 import typing
 
 def fetch_target_subtitles_quest(page_url: str, target_va: list[str]) -> dict[str, list[str]]:
-    data: dict[str, typing.Any] = common.request_retry_wrapper(lambda: requests.get(page_url).json())
+    data: dict[str, typing.Any] = http_policy.get(page_url).json()
     subtitles: dict[str, list[str]] = {}
     if data.get('data'):
         for i_k in data['data'].get('storyList', {}):
@@ -31,7 +32,7 @@ def fetch_target_subtitles_quest(page_url: str, target_va: list[str]) -> dict[st
     
 
 def fetch_target_quests(page_url: str, target_va: list[str]) -> dict[str, list[str]]:
-    data: dict[str, typing.Any] = common.request_retry_wrapper(lambda: requests.get('https://gi.yatta.moe/api/v2/EN/quest').json())
+    data: dict[str, typing.Any] = http_policy.get('https://gi.yatta.moe/api/v2/EN/quest').json()
     if data.get('data'):
         ids = []
         for i_k in data['data'].get('items', {}):